@@ -0,0 +1,265 @@
+"""
+Timings of the CPU hot paths on synthetic datasets, compared against a stored baseline.
+
+For every dataset shape (QuAC, CoQA, MultiWOZ), number of documents and number of turns, a synthetic
+dataset (see synthetic.py) is written to a temporary folder and these are timed:
+
+- preprocess: building the preprocessed files from the raw ones (one process by default)
+- load: `Dataset` opening them, decoding both splits and reading every document
+- extract_keyword_context: `ConvRef._extract_keyword_context` for the words of the last question of
+  every test sample, in each of its documents
+- remove_near_duplicates: `ConvRef._remove_near_duplicates` of the contexts found for each sample
+- scorer_relevance, scorer_retrieval: `Scorer.relevance` and `Scorer.retrieval` of perturbed labels
+- summary_tree_from_dict, summary_tree_to_dict: the summary trees of the documents
+- squad_f1, squad_exact: the `squad_eval` metrics of the answers
+
+The model is the stub backend, so nothing is loaded. Each timing is the fastest of `--repeat` runs.
+Results are written as JSON with `--out`, stored as the baseline with `--save_baseline`, and otherwise
+compared against the baseline: the exit code is 1 if any timing is more than `--threshold` slower.
+
+python -m benchmarks.hot_paths --docs 10 1000 --turns 1 10 --save_baseline
+python -m benchmarks.hot_paths --docs 10 1000 --turns 1 10 --threshold 0.2
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from benchmarks.synthetic import WRITERS, write_dataset
+from utils.constants import ANSWER_DELIM
+from utils.data import preprocess
+from utils.data.squad_eval import compute_exact, compute_f1
+from utils.dataset import Dataset
+from utils.graph.summary_tree import SummaryTree
+from utils.llm.stub_backend import StubBackend
+from utils.method import ConvRef
+from utils.scorer import Scorer
+from utils.structures import Label, Sample
+
+BASELINE_FP = os.path.join(os.path.dirname(__file__), "baseline.json")
+MAX_CHILDREN = 5  # Nodes per level of the synthetic summary trees, like SummaryTree.generate_from
+
+
+def _time(fn: Callable[[], Any], repeat: int, items: int) -> Dict[str, float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {
+        "seconds": best,
+        "median_seconds": statistics.median(times),
+        "items": items,
+        "us_per_item": best / max(items, 1) * 1e6,
+    }
+
+
+def _keywords(X: Sample) -> List[str]:
+    # The longer words of the last question, as the keyword prompt would list them
+    words = [word.strip("?.,!").lower() for word in X.conversation[-1]["content"].split()]
+    return [word for word in words if len(word) > 4][:3]
+
+
+def _perturbed(Y: List[Label], seed: int) -> List[Label]:
+    """Predictions that disagree with the labels on the relevance of a fifth of the samples, with partial answers."""
+    rng = random.Random(seed)
+    Y_hat = []
+    for y in Y:
+        relevant = y.document_relevant if rng.random() >= 0.2 else not y.document_relevant
+        answer = y.answer.split(ANSWER_DELIM)[0] if y.answer else None
+        if answer:
+            words = answer.split()
+            answer = " ".join(words[: rng.randint(1, len(words))])
+        Y_hat.append(Label(relevant, y.segments, answer))
+    return Y_hat
+
+
+def _tree_dict(document: str) -> Dict[str, Any]:
+    """A summary tree of a document, shaped like the ones SummaryTree.generate_from builds."""
+    chunks = [chunk for chunk in document.split("\n\n") if chunk.strip()]
+    if len(chunks) == 1:
+        sentences = document.split(". ")
+        chunks = [". ".join(sentences[i : i + 2]) for i in range(0, len(sentences), 2)]
+    level = [{"data": chunk, "children": []} for chunk in chunks]
+    while len(level) > MAX_CHILDREN:
+        level = [
+            {
+                # The summaries are keyword lists of the children
+                "data": ", ".join(" ".join(child["data"] for child in group).split()[:25]),
+                "children": group,
+            }
+            for group in (level[i : i + MAX_CHILDREN] for i in range(0, len(level), MAX_CHILDREN))
+        ]
+    return {"data": "", "children": level}
+
+
+def benchmark(root: str, name: str, num_docs: int, turns: int, repeat: int, workers: int) -> Dict[str, Dict[str, float]]:
+    """Timings of the hot paths on a synthetic dataset of `num_docs` documents and `turns` turns per conversation."""
+    fp = write_dataset(root, name, num_docs, turns)
+    results = {}
+    results["preprocess"] = _time(lambda: preprocess.preprocess([fp], workers=workers, force=True), repeat, num_docs)
+
+    def load() -> tuple:
+        dataset = Dataset(fp)
+        dataset.split("train")
+        X, Y = dataset.split("test")
+        docs = dataset.docs
+        return X, Y, {doc_id: docs[doc_id] for doc_id in docs}
+
+    X, Y, docs = load()
+    results["load"] = _time(load, repeat, len(docs))
+
+    method = ConvRef(StubBackend(), llm_only=False, strict=False)
+    pairs = [(docs[doc_id], keyword) for x in X for doc_id in x.document_ids for keyword in _keywords(x)]
+    results["extract_keyword_context"] = _time(
+        lambda: [method._extract_keyword_context(document, keyword) for document, keyword in pairs], repeat, len(pairs)
+    )
+
+    contexts = [
+        [
+            context
+            for doc_id in x.document_ids
+            for keyword in _keywords(x)
+            for context in method._extract_keyword_context(docs[doc_id], keyword)
+        ]
+        for x in X
+    ]
+    results["remove_near_duplicates"] = _time(
+        lambda: [method._remove_near_duplicates(strings) for strings in contexts], repeat, len(contexts)
+    )
+
+    scorer = Scorer(os.path.join(root, "scores"), evaluator=StubBackend())
+    Y_hat = _perturbed(Y, seed=num_docs + turns)
+    results["scorer_relevance"] = _time(lambda: scorer.relevance(Y_hat, Y), repeat, len(Y))
+    results["scorer_retrieval"] = _time(lambda: scorer.retrieval(Y_hat, Y), repeat, len(Y))
+
+    tree_dicts = {doc_id: _tree_dict(document) for doc_id, document in docs.items()}
+    trees = {doc_id: SummaryTree.from_dict(tree) for doc_id, tree in tree_dicts.items()}
+    results["summary_tree_from_dict"] = _time(
+        lambda: {doc_id: SummaryTree.from_dict(tree) for doc_id, tree in tree_dicts.items()}, repeat, len(trees)
+    )
+    results["summary_tree_to_dict"] = _time(
+        lambda: {doc_id: tree.to_dict() for doc_id, tree in trees.items()}, repeat, len(trees)
+    )
+
+    answers = [
+        (gold, y_hat.answer)
+        for y, y_hat in zip(Y, Y_hat)
+        if y.answer is not None and y_hat.answer is not None
+        for gold in y.answer.split(ANSWER_DELIM)
+    ]
+    results["squad_f1"] = _time(lambda: [compute_f1(gold, pred) for gold, pred in answers], repeat, len(answers))
+    results["squad_exact"] = _time(lambda: [compute_exact(gold, pred) for gold, pred in answers], repeat, len(answers))
+    return results
+
+
+def run(
+    datasets: List[str], docs: List[int], turns: List[int], repeat: int = 3, workers: int = 1, root: Optional[str] = None
+) -> Dict[str, Any]:
+    """Benchmark every combination of dataset, number of documents and number of turns.
+
+    Returns:
+        The environment under "meta", and the timings under "results", keyed by
+        "<dataset>/docs=<n>/turns=<n>/<benchmark>"
+    """
+    keep = root is not None
+    root = root or tempfile.mkdtemp(prefix="convqa-bench-")
+    results = {}
+    try:
+        for name in datasets:
+            for num_docs in docs:
+                for num_turns in turns:
+                    case = f"{name}/docs={num_docs}/turns={num_turns}"
+                    print(f"Benchmarking {case}", file=sys.stderr)
+                    timings = benchmark(os.path.join(root, case.replace("/", "_")), name, num_docs, num_turns, repeat, workers)
+                    for key, timing in timings.items():
+                        results[f"{case}/{key}"] = timing
+    finally:
+        if not keep:
+            shutil.rmtree(root, ignore_errors=True)
+    meta = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "repeat": repeat,
+        "workers": workers,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    return {"meta": meta, "results": results}
+
+
+def compare(
+    results: Dict[str, Any], baseline: Dict[str, Any], threshold: float, min_seconds: float = 0.01
+) -> List[Dict[str, Any]]:
+    """
+    Compare the timings with the baseline ones. A timing regressed when it is more than `threshold`
+    (e.g. 0.2 for 20%) slower, unless both are under `min_seconds`, where the noise dominates.
+    """
+    rows = []
+    for key, timing in results["results"].items():
+        before = baseline["results"].get(key)
+        row = {"benchmark": key, "seconds": timing["seconds"], "baseline_seconds": None, "ratio": None, "status": "new"}
+        if before is not None:
+            ratio = timing["seconds"] / max(before["seconds"], 1e-12)
+            regressed = ratio > 1 + threshold and max(timing["seconds"], before["seconds"]) >= min_seconds
+            row.update(baseline_seconds=before["seconds"], ratio=ratio, status="regression" if regressed else "ok")
+        rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the CPU hot paths on synthetic datasets.")
+    parser.add_argument("--datasets", nargs="+", default=list(WRITERS), choices=list(WRITERS))
+    parser.add_argument("--docs", nargs="+", type=int, default=[10, 1000], help="Numbers of documents, e.g. 10 1000 100000")
+    parser.add_argument("--turns", nargs="+", type=int, default=[1, 10], help="Numbers of turns per conversation, e.g. 1 10 50")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each benchmark, the fastest is kept")
+    parser.add_argument("--workers", type=int, default=1, help="Processes of the preprocessing")
+    parser.add_argument("--data_dir", default=None, help="Keep the synthetic datasets in this folder (default: a temporary one)")
+    parser.add_argument("--out", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--baseline", default=BASELINE_FP, help="Baseline results to compare against")
+    parser.add_argument("--save_baseline", action="store_true", help="Store the results as the baseline instead of comparing")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown over the baseline flagged as a regression")
+    parser.add_argument("--min_seconds", type=float, default=0.01, help="Timings under this (in seconds) are never flagged, as noise dominates them")
+    args = parser.parse_args()
+
+    results = run(args.datasets, args.docs, args.turns, args.repeat, args.workers, args.data_dir)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=4)
+
+    rows = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            rows = compare(results, json.load(f), args.threshold, args.min_seconds)
+
+    if args.json:
+        print(json.dumps(results if rows is None else {**results, "comparison": rows}, indent=4))
+    else:
+        print(f"{'benchmark':<56}{'seconds':>12}{'us/item':>12}{'baseline':>12}{'ratio':>8}  status")
+        statuses = {row["benchmark"]: row for row in rows or []}
+        for key, timing in results["results"].items():
+            row = statuses.get(key, {})
+            baseline = f"{row['baseline_seconds']:.4f}" if row.get("baseline_seconds") is not None else "-"
+            ratio = f"{row['ratio']:.2f}" if row.get("ratio") is not None else "-"
+            print(
+                f"{key:<56}{timing['seconds']:>12.4f}{timing['us_per_item']:>12.1f}{baseline:>12}{ratio:>8}  "
+                f"{row.get('status', '')}"
+            )
+
+    regressions = [row for row in rows or [] if row["status"] == "regression"]
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold:.0%}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,99 @@
+"""
+Memory held by the samples and labels of a dataset once loaded, per record.
+
+Every split of every dataset is loaded whole, as a worker does, and the Python heap it takes is
+measured with tracemalloc. The same records are then rebuilt in the layout the dataset used before
+the records were compacted (dataclasses with a `__dict__`, a copy of the document ids and of the whole
+conversation as dicts in every sample) for comparison.
+
+python -m benchmarks.memory data/QuAC data/CoQA data/MultiWOZ
+"""
+
+import argparse
+import gc
+import json
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+from utils.dataset import Dataset
+from utils.structures import DataClassEncoder
+
+SPLITS = ["train", "test"]
+
+
+@dataclass
+class _DictSample:
+    document_ids: List[str]
+    conversation: List[Dict[str, str]]
+
+
+@dataclass
+class _DictLabel:
+    document_relevant: bool
+    segments: Optional[List[str]]
+    answer: Optional[str]
+    time_taken: Optional[float] = None
+    document_relevant_prob: Optional[float] = None
+    dropped_context: Optional[Dict[str, int]] = None
+    spans: Optional[List[Dict[str, Any]]] = None
+
+
+def _measure(load: Callable[[], Any]) -> tuple:
+    """(bytes, result) of `load()`, the bytes still allocated by it when it returns."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = load()
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0] - before, result
+    finally:
+        tracemalloc.stop()
+
+
+def _dict_records(X: List[Any], Y: List[Any]) -> tuple:
+    # Decoded from JSON like the old files were, so no string is shared between records
+    samples = [
+        _DictSample(**json.loads(json.dumps({"document_ids": x.document_ids, "conversation": list(x.conversation)})))
+        for x in X
+    ]
+    labels = [_DictLabel(**json.loads(json.dumps(y, cls=DataClassEncoder))) for y in Y]
+    return samples, labels
+
+
+def benchmark(dataset_fp: str) -> Dict[str, Any]:
+    """Bytes per (sample, label) pair of the splits of a dataset, compact and in the old layout."""
+    dataset = Dataset(dataset_fp)
+    results = {"dataset": dataset_fp, "records": 0, "compact_bytes": 0, "dict_bytes": 0}
+    for split in SPLITS:
+        compact_bytes, (X, Y) = _measure(lambda: dataset.split(split))
+        dict_bytes, _ = _measure(lambda: _dict_records(X, Y))
+        results["records"] += len(X)
+        results["compact_bytes"] += compact_bytes
+        results["dict_bytes"] += dict_bytes
+        del X, Y
+
+    records = max(results["records"], 1)
+    results["compact_bytes_per_record"] = round(results["compact_bytes"] / records, 1)
+    results["dict_bytes_per_record"] = round(results["dict_bytes"] / records, 1)
+    results["ratio"] = round(results["dict_bytes"] / max(results["compact_bytes"], 1), 2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the memory of the loaded dataset records.")
+    parser.add_argument("datasets", nargs="+", help="Dataset folders, e.g. data/QuAC data/CoQA data/MultiWOZ")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    all_results = [benchmark(dataset_fp) for dataset_fp in args.datasets]
+    if args.json:
+        print(json.dumps(all_results, indent=4))
+    else:
+        print(f"{'dataset':<24}{'records':>10}{'compact B/rec':>16}{'dict B/rec':>14}{'ratio':>8}")
+        for r in all_results:
+            print(
+                f"{r['dataset']:<24}{r['records']:>10}{r['compact_bytes_per_record']:>16}"
+                f"{r['dict_bytes_per_record']:>14}{r['ratio']:>8}"
+            )
@@ -0,0 +1,171 @@
+"""
+Synthetic raw datasets shaped like QuAC, CoQA and MultiWOZ, at any scale.
+
+The text is drawn from a made-up vocabulary with a Zipf-like word frequency, so the documents,
+questions and answers have realistic lengths and word overlaps without the real downloads. Each
+document has one conversation of `turns` user questions, whose answers are spans of the document
+(10% of the questions cannot be answered). The files are written in the raw layout of each dataset, so
+`Dataset` preprocesses them exactly like the real ones.
+
+python -m benchmarks.synthetic /tmp/synthetic --docs 1000 --turns 10
+"""
+
+import argparse
+import json
+import os
+import random
+from typing import Any, Callable, Dict, List, Tuple
+
+from utils.structures import DatasetName
+
+VOCABULARY_SIZE = 5000
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "bra", "cle", "dro", "fli", "gra", "pro", "stu"]
+QUESTIONS = ["What is {}?", "Who was {}?", "Where did {} happen?", "When was {}?", "Why {}?", "What about {}?"]
+UNANSWERABLE = 0.1
+
+
+class TextGenerator:
+    """Deterministic (for a seed) words, sentences and documents."""
+
+    def __init__(self, seed: int = 0) -> None:
+        self.rng = random.Random(seed)
+        words = set()
+        while len(words) < VOCABULARY_SIZE:
+            words.add("".join(self.rng.choice(SYLLABLES) for _ in range(self.rng.randint(1, 4))))
+        self.words = sorted(words)
+        self.rng.shuffle(self.words)
+        self._weights = [1 / rank for rank in range(1, len(self.words) + 1)]
+
+    def sentence(self) -> str:
+        words = self.rng.choices(self.words, weights=self._weights, k=self.rng.randint(6, 20))
+        return " ".join(words).capitalize() + self.rng.choice([".", ".", ".", "!", "?"])
+
+    def document(self, sentences: int) -> str:
+        return " ".join(self.sentence() for _ in range(sentences))
+
+    def title(self) -> str:
+        return " ".join(self.rng.choices(self.words, k=self.rng.randint(1, 3))).title()
+
+    def question_answer(self, document: str) -> Tuple[str, str]:
+        """A question about a sentence of the document, and a span of that sentence answering it."""
+        sentence = self.rng.choice(document.split(". ")).rstrip(".!?").split()
+        start = self.rng.randrange(len(sentence))
+        answer = " ".join(sentence[start : start + self.rng.randint(2, 8)])
+        topic = " ".join(self.rng.sample(sentence, min(len(sentence), self.rng.randint(1, 3))))
+        template = self.rng.choice(QUESTIONS)
+        return template.format(topic.lower()), answer
+
+    def answerable(self) -> bool:
+        return self.rng.random() >= UNANSWERABLE
+
+
+def _split_sizes(num_docs: int) -> List[Tuple[str, int]]:
+    # Half of the documents (at least one) in each split
+    test = max(num_docs // 2, 1)
+    return [("train", max(num_docs - test, 1)), ("test", test)]
+
+
+def _write_json(fp: str, data: Any) -> None:
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    with open(fp, "w") as f:
+        json.dump(data, f)
+
+
+def write_quac(fp: str, num_docs: int, turns: int, seed: int = 0) -> None:
+    text = TextGenerator(seed)
+    for split, n in _split_sizes(num_docs):
+        articles = []
+        for _ in range(n):
+            context = text.document(text.rng.randint(8, 20))
+            qas = []
+            for _ in range(turns):
+                question, answer = text.question_answer(context)
+                answer = answer if text.answerable() else "CANNOTANSWER"
+                qas.append({"question": question, "answers": [{"text": answer}]})
+            articles.append({"title": text.title(), "paragraphs": [{"context": context, "qas": qas}]})
+        _write_json(os.path.join(fp, "train_v0.2.json" if split == "train" else "val_v0.2.json"), {"data": articles})
+
+
+def write_coqa(fp: str, num_docs: int, turns: int, seed: int = 0) -> None:
+    text = TextGenerator(seed)
+    story_id = 0
+    for split, n in _split_sizes(num_docs):
+        stories = []
+        for _ in range(n):
+            story = text.document(text.rng.randint(10, 30))
+            questions, answers = [], []
+            for turn in range(1, turns + 1):
+                question, span = text.question_answer(story)
+                span = span if text.answerable() else "unknown"
+                questions.append({"input_text": question, "turn_id": turn})
+                answers.append({"input_text": span.split()[0] if span != "unknown" else span, "span_text": span, "turn_id": turn})
+            stories.append({"id": f"s{story_id}", "story": story, "questions": questions, "answers": answers})
+            story_id += 1
+        _write_json(os.path.join(fp, "coqa-train-v1.0.json" if split == "train" else "coqa-dev-v1.0.json"), {"data": stories})
+
+
+def write_multiwoz(fp: str, num_docs: int, turns: int, seed: int = 0) -> None:
+    """Documents are the FAQs of the entities (hotels, restaurants, ...), dialogues ask about some of them."""
+    text = TextGenerator(seed)
+    knowledge: Dict[str, Dict[str, Any]] = {}
+    entities = []
+    for e in range(num_docs):
+        domain = ["hotel", "restaurant", "attraction", "taxi", "train"][e % 5]
+        faq = {
+            str(d): {"title": text.sentence().rstrip(".!") + "?", "body": text.sentence()}
+            for d in range(text.rng.randint(3, 10))
+        }
+        knowledge.setdefault(domain, {})[str(e)] = {"name": text.title(), "docs": faq}
+        entities.append((domain, str(e)))
+    _write_json(os.path.join(fp, "knowledge.json"), knowledge)
+
+    for split, n in _split_sizes(num_docs):
+        logs, labels = [], []
+        for _ in range(n):
+            domain, entity_id = text.rng.choice(entities)
+            log: List[Dict[str, str]] = []
+            for turn in range(turns):
+                if turn:
+                    log = log + [{"speaker": "S", "text": text.sentence()}]
+                log = log + [{"speaker": "U", "text": text.sentence()}]
+                logs.append(log)
+                if text.answerable():
+                    doc_id = text.rng.choice(list(knowledge[domain][entity_id]["docs"]))
+                    labels.append(
+                        {
+                            "target": True,
+                            "knowledge": [{"domain": domain, "entity_id": int(entity_id), "doc_id": int(doc_id)}],
+                            "response": text.sentence(),
+                        }
+                    )
+                else:
+                    labels.append({"target": False})
+        folder = os.path.join(fp, "train" if split == "train" else "val")
+        _write_json(os.path.join(folder, "logs.json"), logs)
+        _write_json(os.path.join(folder, "labels.json"), labels)
+
+
+WRITERS: Dict[str, Callable[[str, int, int, int], None]] = {
+    DatasetName.QUAC.value: write_quac,
+    DatasetName.COQA.value: write_coqa,
+    DatasetName.MULTIWOZ.value: write_multiwoz,
+}
+
+
+def write_dataset(root: str, name: str, num_docs: int, turns: int, seed: int = 0) -> str:
+    """Write the raw files of a synthetic dataset to `<root>/<name>` (the folder `Dataset` expects) and return it."""
+    fp = os.path.join(root, name)
+    WRITERS[name](fp, num_docs, turns, seed)
+    return fp
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic raw QuAC, CoQA and MultiWOZ datasets.")
+    parser.add_argument("root", help="Folder the datasets are written to, one subfolder per dataset")
+    parser.add_argument("--datasets", nargs="+", default=list(WRITERS), choices=list(WRITERS))
+    parser.add_argument("--docs", type=int, default=1000, help="Number of documents of each dataset")
+    parser.add_argument("--turns", type=int, default=10, help="Number of user turns of each conversation")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    for name in args.datasets:
+        print(write_dataset(args.root, name, args.docs, args.turns, args.seed))
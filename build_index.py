@@ -0,0 +1,53 @@
+import argparse
+import os
+
+from utils.dataset import Dataset
+from utils.llm.backend import BACKENDS, load_embedding_model
+from utils.retrieval.dense_index import DenseIndex
+
+"""
+Offline build of the sentence-window embedding index used by `main.py --stage1 dense`.
+Interrupted builds resume where they stopped when run again.
+
+CUDA_VISIBLE_DEVICES=3 python3 build_index.py --dataset data/MultiWOZ
+"""
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dataset",
+        required=True,
+        type=str,
+        help="Provide filepath to dataset",
+    )
+    parser.add_argument(
+        "--backend",
+        default="transformers",
+        choices=BACKENDS,
+        help="stub uses a deterministic bag-of-words embedding instead of jina-embeddings-v3.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        default=256,
+        type=int,
+        help="Number of sentence windows embedded at once.",
+    )
+    parser.add_argument(
+        "--output",
+        default="",
+        type=str,
+        help="Path of the index without extension. Defaults to <dataset>/sentence_embeddings.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    fp = args.output or os.path.join(args.dataset, "sentence_embeddings")
+
+    dataset = Dataset(args.dataset)
+    DenseIndex.build(
+        fp, dataset.sentence_index, load_embedding_model(args.backend), batch_size=args.batch_size
+    )
+    print(f"Dense index written to {fp}.npy ({len(DenseIndex(fp, dataset.sentence_index))} windows)")
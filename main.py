@@ -1,12 +1,21 @@
 import argparse
+import json
 import os
+import sys
+from typing import List, Optional
 
 from tqdm import tqdm
 
 from utils.dataset import Dataset
-from utils.evaluate import run_inference_and_evaluate
+from utils.evaluate import evaluate_queue, evaluate_shards, run_inference_and_evaluate, run_queue_worker
+from utils.history import HISTORY_POLICIES
+from utils.llm.backend import BACKENDS, load_backend, load_embedding_model
+from utils.llm.response_cache import CachedBackend, ResponseCache
 from utils.method import ConvRef
+from utils.retrieval.dense_index import DenseIndex
 from utils.scorer import Scorer
+from utils.sharding import incomplete_shards, launch_shards
+from utils.work_queue import WorkQueue
 from utils.structures import *
 
 """
@@ -22,6 +31,15 @@ def parse_args() -> Arguments:
     parser = argparse.ArgumentParser()
 
     parser.add_argument("--model", default="meta-llama/Llama-3.2-3B-Instruct", type=str)
+    parser.add_argument(
+        "--evaluator", default="meta-llama/Llama-3.2-1B-Instruct", type=str
+    )
+    parser.add_argument(
+        "--backend",
+        default="transformers",
+        choices=BACKENDS,
+        help="LLM backend. `stub` is a deterministic CPU backend that needs no model weights.",
+    )
 
     parser.add_argument(
         "--dataset",
@@ -34,7 +52,51 @@ def parse_args() -> Arguments:
     parser.add_argument("--llm_only", action="store_true")
     parser.add_argument("--strict", action="store_true")
     parser.add_argument("--no_summary_tree", action="store_true")
+    parser.add_argument(
+        "--tree_retrieval",
+        default=None,
+        choices=["keywords", "embeddings"],
+        help="Limit Stage 1 to the document chunks found by descending the summary trees, ranking nodes by keyword overlap or embedding similarity.",
+    )
+    parser.add_argument(
+        "--tree_top_k",
+        default=2,
+        type=int,
+        help="Number of children followed at every level of the summary trees with --tree_retrieval.",
+    )
+    parser.add_argument(
+        "--context_tokens",
+        default=0,
+        type=int,
+        help="Token budget of the documents in each prompt. Documents are truncated at sentence or FAQ entry boundaries, keeping what overlaps most with the conversation. 0 disables it.",
+    )
     # parser.add_argument("--no_dialogue_KG", action="store_true")
+    parser.add_argument(
+        "--history",
+        default="full",
+        choices=HISTORY_POLICIES,
+        help="How much of the conversation is sent with each prompt: all of it, the last --history_turns messages, the most recent messages within --history_tokens, or the last --history_turns messages plus a rolling summary of the older ones.",
+    )
+    parser.add_argument("--history_turns", default=6, type=int)
+    parser.add_argument("--history_tokens", default=1024, type=int)
+    parser.add_argument(
+        "--stage1",
+        default="keywords",
+        choices=["keywords", "bm25", "dense"],
+        help="Stage 1 engine: search for keywords generated by the LLM, or rank the sentence windows with BM25 or with the embedding index built by build_index.py (no LLM call).",
+    )
+    parser.add_argument(
+        "--retrieval_top_k",
+        default=10,
+        type=int,
+        help="Number of sentence windows kept by the bm25 and dense Stage 1.",
+    )
+    parser.add_argument(
+        "--retrieval_history_turns",
+        default=0,
+        type=int,
+        help="Number of earlier user turns added to the bm25 (at half weight) and dense queries.",
+    )
 
     # Stage 1 and Stage 2 ablation flags
     parser.add_argument(
@@ -48,46 +110,267 @@ def parse_args() -> Arguments:
         help="Flag for Stage 2 ablation. Use GT document relevancy instead of computing it.",
     )
 
+    # Inference
+    parser.add_argument(
+        "--batch_size",
+        default=1,
+        type=int,
+        help="Number of samples run through each stage at once. 1 disables batching.",
+    )
+    parser.add_argument(
+        "--pipeline_depth",
+        default=0,
+        type=int,
+        help="Overlap the CPU stages with the model calls, running them up to this many samples ahead. 0 disables it.",
+    )
+    parser.add_argument(
+        "--cpu_workers",
+        default=2,
+        type=int,
+        help="Number of threads of each CPU stage when --pipeline_depth > 0.",
+    )
+    parser.add_argument(
+        "--prefix_cache_size",
+        default=0,
+        type=int,
+        help="Number of prompt KV caches kept for reuse across turns of a conversation (transformers backend only, --batch_size 1). 0 disables it.",
+    )
+
+    parser.add_argument(
+        "--ner_processes",
+        default=1,
+        type=int,
+        help="Number of processes used to precompute the entities of the final queries with spaCy, a chunk of samples at a time.",
+    )
+
+    parser.add_argument(
+        "--yes_no_scoring",
+        default="generate",
+        choices=["generate", "logits"],
+        help="How YES/NO questions (relevancy checks, answer consistency) are answered: parse a generated response or compare the YES/NO next-token logits of one forward pass.",
+    )
+    parser.add_argument(
+        "--relevancy_threshold",
+        default=0.5,
+        type=float,
+        help="Minimum YES probability for a document to be relevant with --yes_no_scoring logits.",
+    )
+
+    # LLM response cache
+    parser.add_argument(
+        "--cache_path",
+        default="",
+        type=str,
+        help="SQLite file caching every LLM response across runs. Empty disables the cache.",
+    )
+    parser.add_argument("--cache_max_entries", default=1_000_000, type=int)
+    parser.add_argument(
+        "--cache_read_only",
+        action="store_true",
+        help="Serve responses from the cache but never write new ones to it.",
+    )
+
+    # Sharding
+    parser.add_argument(
+        "--num_shards",
+        default=1,
+        type=int,
+        help="Split the samples into this many shards, by conversation. Without --shard_id, runs the unfinished shards in local worker processes, then merges and scores them.",
+    )
+    parser.add_argument(
+        "--shard_id",
+        default=None,
+        type=int,
+        help="Only run the samples of this shard (0..num_shards-1), e.g. on one of several nodes, writing its own journal without scoring.",
+    )
+
+    # Work queue
+    parser.add_argument(
+        "--work_queue",
+        action="store_true",
+        help="Join the experiment as a worker of the SQLite work queue in its results folder, leasing conversations until all the samples are done. Any number of workers can join or leave.",
+    )
+    parser.add_argument(
+        "--lease_seconds",
+        default=300.0,
+        type=float,
+        help="Seconds without a heartbeat after which the samples leased by a worker are given to others.",
+    )
+
     # Results
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Also write the per-stage spans of the predictions as a Chrome trace (eval_trace.json), to open in Perfetto.",
+    )
     parser.add_argument("--exp_name", default="", type=str)
 
-    return Arguments(**vars(parser.parse_args()))
+    args = parser.parse_args()
+    if args.tree_retrieval and args.no_summary_tree:
+        parser.error("--tree_retrieval needs the summary trees, it cannot be used with --no_summary_tree")
+    if args.shard_id is not None and not 0 <= args.shard_id < args.num_shards:
+        parser.error("--shard_id must be in 0..num_shards-1")
+    if args.work_queue and args.num_shards > 1:
+        parser.error("--work_queue hands out the samples itself, it cannot be used with --num_shards")
+    if args.prefix_cache_size > 0 and args.batch_size > 1:
+        parser.error("--prefix_cache_size only applies to single-prompt generation, it cannot be used with --batch_size > 1")
+    return Arguments(**vars(args))
 
 
-if __name__ == "__main__":
-    args = parse_args()
+def load_scorer(args: Arguments, fp: str, cache: Optional[ResponseCache]) -> Scorer:
+    evaluator = load_backend(args.backend, args.evaluator)
+    if cache is not None:
+        evaluator = CachedBackend(evaluator, cache)
+    return Scorer(
+        fp,
+        evaluator=evaluator,
+        yes_no_scoring=args.yes_no_scoring,
+        batch_size=max(args.batch_size, 1),
+        trace=args.trace,
+    )
 
-    fp = "results"
-    if args.exp_name:
-        fp = os.path.join(fp, args.exp_name)
 
-    dataset = Dataset(args.dataset)
+def run_experiment(
+    args: Arguments,
+    fp: str,
+    dataset: Dataset,
+    X: List[Sample],
+    Y: List[Label],
+    scorer: Optional[Scorer],
+    cache: Optional[ResponseCache],
+    queue: Optional[WorkQueue] = None,
+) -> None:
+    """Run the method on the samples (those of shard `args.shard_id`, or those leased from `queue`) and score its predictions."""
+    backend_kwargs = {}
+    if args.backend == "transformers":
+        backend_kwargs["prefix_cache_size"] = args.prefix_cache_size
+    llm = load_backend(args.backend, args.model, **backend_kwargs)
+    if cache is not None:
+        llm = CachedBackend(llm, cache)
 
     method = ConvRef(
-        args.model,
+        llm,
         args.llm_only,
         args.strict,
         args.use_gt_segments,
         args.use_gt_doc_relevancy,
+        batch_size=args.batch_size,
+        yes_no_scoring=args.yes_no_scoring,
+        relevancy_threshold=args.relevancy_threshold,
+        stage1=args.stage1,
+        retrieval_top_k=args.retrieval_top_k,
+        retrieval_history_turns=args.retrieval_history_turns,
     )
-
-    scorer = Scorer(fp)
+    method.load_sentence_index(dataset.sentence_index)
+    emb_model = None  # Loaded at most once, for the dense index and/or the summary trees
+    if args.stage1 == "bm25":
+        print("Building BM25 index...")
+        method.load_bm25_index(dataset.bm25_index)
+    elif args.stage1 == "dense":
+        dense_index_fp = os.path.join(args.dataset, "sentence_embeddings")
+        if not os.path.exists(f"{dense_index_fp}.npy"):
+            raise FileNotFoundError(
+                f"{dense_index_fp}.npy not found, build it first with build_index.py --dataset {args.dataset}"
+            )
+        emb_model = load_embedding_model(args.backend)
+        method.load_dense_index(DenseIndex(dense_index_fp, dataset.sentence_index), emb_model)
+    if args.context_tokens > 0:
+        method.use_context_budget(args.context_tokens)
+    if args.history != "full":
+        method.use_history_policy(args.history, last_k=args.history_turns, max_tokens=args.history_tokens)
 
     if not args.no_summary_tree:
         summary_trees_fp = os.path.join(args.dataset, f"summary_trees.json")
+        needs_emb_model = not os.path.exists(summary_trees_fp) or args.tree_retrieval == "embeddings"
+        if emb_model is None and needs_emb_model:
+            emb_model = load_embedding_model(args.backend)
         if not os.path.exists(summary_trees_fp):
-            from transformers import AutoModel
-
-            model = AutoModel.from_pretrained(
-                "jinaai/jina-embeddings-v3", trust_remote_code=True
-            )
-            method.generate_summary_trees(summary_trees_fp, dataset.docs, model)
+            method.generate_summary_trees(summary_trees_fp, dataset.docs, emb_model)
         else:
             method.load_summary_trees(summary_trees_fp)
 
+        if args.tree_retrieval:
+            method.use_tree_retrieval(
+                dataset.docs,
+                emb_model if args.tree_retrieval == "embeddings" else None,
+                top_k=args.tree_top_k,
+            )
+
     print("Running inference and evaluation...")
-    X = dataset.test_X[:100]  # dataset.train_X + dataset.test_X
-    Y = dataset.test_Y[:100]  # dataset.train_Y + dataset.test_Y
-    run_inference_and_evaluate("", X, Y, dataset.docs, method, scorer, fp)
+    inference_kwargs = {
+        "batch_size": args.batch_size,
+        "pipeline_depth": args.pipeline_depth,
+        "cpu_workers": args.cpu_workers,
+        "ner_processes": args.ner_processes,
+    }
+    if queue is not None:
+        run_queue_worker(X, Y, dataset.docs, method, queue, **inference_kwargs)
+    else:
+        run_inference_and_evaluate(
+            "",
+            X,
+            Y,
+            dataset.docs,
+            method,
+            scorer,
+            fp,
+            num_shards=args.num_shards,
+            shard_id=args.shard_id,
+            **inference_kwargs,
+        )
+
+    if method.history_policy is not None:
+        print("History", method.history_policy.stats())
+    if method.context_packer is not None:
+        print("Context packer", method.context_packer.stats())
+    if method.tree_retriever is not None:
+        print("Tree retrieval", method.tree_retriever.stats())
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    fp = "results"
+    if args.exp_name:
+        fp = os.path.join(fp, args.exp_name)
+
+    dataset = Dataset(args.dataset)
+    # Only decodes the first 100 test samples and never opens the train split
+    X, Y = dataset.split("test", 0, 100)  # dataset.train_X + dataset.test_X
+
+    cache = None
+    if args.cache_path:
+        cache = ResponseCache(
+            args.cache_path, args.cache_max_entries, read_only=args.cache_read_only
+        )
+
+    if args.num_shards > 1 and args.shard_id is None:
+        summary_trees_fp = os.path.join(args.dataset, "summary_trees.json")
+        if not args.no_summary_tree and not os.path.exists(summary_trees_fp):
+            raise FileNotFoundError(
+                f"{summary_trees_fp} not found, generate it with a run without --num_shards first so the shards do not all build it"
+            )
+        # Run the unfinished shards in local processes (none if they all ran elsewhere), then merge and score them
+        shards = incomplete_shards(fp, "", X, args.num_shards)
+        print(f"Running shards {shards} of {args.num_shards}")
+        launch_shards([sys.executable] + sys.argv, shards)
+        evaluate_shards("", X, Y, load_scorer(args, fp, cache), fp, args.num_shards)
+    elif args.work_queue:
+        queue = WorkQueue(os.path.join(fp, "queue.sqlite"), lease_seconds=args.lease_seconds)
+        print(f"Joining the work queue {queue.fp} as {queue.worker}")
+        run_experiment(args, fp, dataset, X, Y, None, cache, queue)
+        # The first worker to find the queue finished scores it, while the others leave
+        if queue.claim_scoring():
+            with queue.heartbeats():
+                evaluate_queue("", X, Y, load_scorer(args, fp, cache), fp, queue)
+        print("Work queue", json.dumps(queue.progress(), indent=4))
+    elif args.shard_id is not None:
+        # Shards only write their predictions, the run that merges them scores them
+        run_experiment(args, fp, dataset, X, Y, None, cache)
+    else:
+        run_experiment(args, fp, dataset, X, Y, load_scorer(args, fp, cache), cache)
+
+    if cache is not None:
+        print("Response cache", cache.stats())
 
     print("Finished!")
@@ -0,0 +1,32 @@
+# Testing script for the synthetic datasets of the benchmarks and the comparison with a baseline
+
+import os
+
+import pytest
+
+from benchmarks import hot_paths, memory, synthetic
+from utils.dataset import Dataset
+
+
+@pytest.mark.parametrize("name", list(synthetic.WRITERS))
+def test_synthetic_datasets_preprocess_like_the_real_ones(tmp_path, name):
+    fp = synthetic.write_dataset(str(tmp_path), name, num_docs=4, turns=3)
+    dataset = Dataset(fp)
+    X, Y = dataset.split("test")
+    assert len(X) == len(Y) == 2 * 3  # Half of the documents, one conversation each
+    assert [len(x.conversation) for x in X[:3]] == ([1, 3, 5] if name == "MultiWOZ" else [1, 2, 3])
+    assert all(doc_id in dataset.docs for x in X for doc_id in x.document_ids)
+    assert any(y.document_relevant for y in Y)
+
+
+def test_regressions_are_flagged_above_threshold_and_noise_floor():
+    baseline = {"results": {"a": {"seconds": 1.0}, "b": {"seconds": 1.0}, "c": {"seconds": 0.001}}}
+    results = {"results": {"a": {"seconds": 1.1}, "b": {"seconds": 1.5}, "c": {"seconds": 0.005}, "d": {"seconds": 1.0}}}
+    rows = hot_paths.compare(results, baseline, threshold=0.2)
+    assert [row["status"] for row in rows] == ["ok", "regression", "ok", "new"]
+
+
+def test_memory_benchmark_rebuilds_the_labels_in_the_old_layout(tmp_path):
+    # Fails when a field added to Label is missing from the old layout
+    results = memory.benchmark(synthetic.write_dataset(str(tmp_path), "CoQA", num_docs=4, turns=3))
+    assert results["records"] == 12 and results["compact_bytes"] > 0 and results["dict_bytes"] > 0
@@ -0,0 +1,43 @@
+# Testing script for the policies deciding how much of a conversation is sent with every prompt
+
+import pytest
+
+from utils.history import HistoryPolicy
+from utils.llm.stub_backend import StubBackend
+
+
+def conversation(n):
+    # Three stub tokens per message
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"message number {i}"} for i in range(n)]
+
+
+def test_full_last_k_and_tokens_keep_the_latest_messages():
+    model = StubBackend()
+    messages = conversation(8)
+    assert HistoryPolicy("full", model).apply(messages) == (None, messages)
+    assert HistoryPolicy("last_k", model, last_k=3).apply(messages) == (None, messages[-3:])
+
+    summary, kept = HistoryPolicy("tokens", model, max_tokens=10).apply(messages)
+    assert summary is None and kept == messages[-3:]
+    assert sum(model.count_tokens(m["content"]) for m in kept) <= 10
+    # The final message is kept even when it alone is over the budget
+    assert HistoryPolicy("tokens", model, max_tokens=1).apply(messages) == (None, messages[-1:])
+
+    with pytest.raises(NotImplementedError):
+        HistoryPolicy("first_k", model)
+
+
+def test_summary_rolls_over_the_older_messages():
+    policy = HistoryPolicy("summary", StubBackend(), last_k=2)
+    assert policy.apply(conversation(2)) == (None, conversation(2))
+
+    summary, kept = policy.apply(conversation(6))
+    assert summary and kept == conversation(6)[-2:]
+    assert policy.stats()["summary_calls"] == 1 and policy.stats()["summarized_messages"] == 4
+
+    # Two turns later, only the two newly dropped messages are summarized, on top of the cached summary
+    summary, kept = policy.apply(conversation(8))
+    assert summary and kept == conversation(8)[-2:]
+    assert policy.stats() == {"summaries": 2, "summary_calls": 2, "summarized_messages": 6}
+    policy.apply(conversation(8))
+    assert policy.stats()["summary_calls"] == 2
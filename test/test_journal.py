@@ -0,0 +1,66 @@
+# Testing script for the append-only prediction journal, the resuming of runs from it and sharded runs
+
+import json
+import os
+
+from utils import sharding
+from utils.journal import PredictionJournal
+from utils.structures import ConversationStore, DataClassEncoder, Label, Turn
+
+
+def label(i):
+    return Label(i % 2 == 0, [f"s{i}"], f"a{i}", time_taken=0.1 * i)
+
+
+def test_resumes_from_any_subset_and_drops_torn_tail(tmp_path):
+    fp = os.path.join(str(tmp_path), "Y_hat.jsonl")
+    with PredictionJournal(fp, sync_every=2) as journal:
+        for i in [3, 0, 4]:
+            journal.append(i, label(i))
+    with open(fp, "ab") as f:
+        f.write(b'{"i":1,"label":{"document_rel')  # Killed in the middle of a write
+
+    journal = PredictionJournal(fp)
+    assert journal.dropped_bytes > 0
+    assert journal.missing(5) == [1, 2]
+    for i in journal.missing(5):
+        journal.append(i, label(i))
+    journal.close()
+
+    json_fp = os.path.join(str(tmp_path), "Y_hat.json")
+    assert PredictionJournal(fp).compact(json_fp, 5) == [label(i) for i in range(5)]
+    with open(json_fp, "r") as f:
+        assert [Label(**value) for value in json.load(f)] == [label(i) for i in range(5)]
+    with open(fp, "rb") as f:
+        assert len(f.read().splitlines()) == 5
+
+
+def test_seeds_journal_from_older_json(tmp_path):
+    json_fp = os.path.join(str(tmp_path), "Y_hat.json")
+    with open(json_fp, "w") as f:
+        json.dump([label(0), label(1)], f, cls=DataClassEncoder, indent=4)
+
+    journal = PredictionJournal.from_json(os.path.join(str(tmp_path), "Y_hat.jsonl"), json_fp)
+    assert journal.missing(3) == [2]
+    journal.close()
+
+
+def test_shards_partition_by_conversation_and_merge_in_order(tmp_path):
+    conversations = ConversationStore()
+    X = []
+    for length in [1, 4, 2]:
+        conversation_id, turns = conversations.new()
+        for turn in range(1, length + 1):
+            turns.append(Turn("user", f"q{turn}"))
+            X.append(conversations.sample(["d"], conversation_id, turn))
+
+    shards = [sharding.shard_indices(X, 2, k) for k in range(2)]
+    assert shards == [[1, 2, 3, 4], [0, 5, 6]]  # Largest conversation first, to the least loaded shard
+
+    fp = str(tmp_path)
+    for k in reversed(range(2)):
+        with PredictionJournal(sharding.shard_journal_fp(fp, "", 2, k)) as journal:
+            for i in reversed(shards[k]):
+                journal.append(i, label(i))
+    assert sharding.incomplete_shards(fp, "", X, 2) == []
+    assert sharding.merge_shards(fp, "", len(X), 2) == [label(i) for i in range(len(X))]
@@ -0,0 +1,44 @@
+# Testing script for the LRU of prompt KV caches reused across the turns of a conversation
+
+import numpy as np
+
+from utils.llm.kv_cache import PrefixKVCache
+
+
+def past_key_values(ids):
+    # Stands in for the (layers, tokens) key/value tensors of a prompt
+    return np.zeros((2, len(ids)))
+
+
+def test_lookup_returns_the_longest_common_prefix():
+    cache = PrefixKVCache(max_entries=4, min_prefix_tokens=3)
+    assert cache.lookup([1, 2, 3, 4]) == (0, None)
+
+    turn_1, turn_2 = [1, 2, 3, 4, 5], [1, 2, 3, 4, 5, 6, 7, 8]
+    cache.put(turn_1, past_key_values(turn_1))
+    cache.put(turn_2, past_key_values(turn_2))
+    prefix_len, cached = cache.lookup([1, 2, 3, 4, 5, 6, 7, 9])
+    assert prefix_len == 7 and cached.shape == (2, 8)
+
+    # At least one token is left for generation, even for a prompt that is fully cached
+    prefix_len, cached = cache.lookup(turn_1)
+    assert prefix_len == 4 and cached.shape == (2, 5)
+
+    # Prefixes shorter than min_prefix_tokens are misses
+    assert cache.lookup([1, 2, 9, 9, 9]) == (0, None)
+    assert cache.stats() == {"entries": 2, "hits": 2, "misses": 2, "reused_tokens": 11, "prompt_tokens": 22}
+
+
+def test_put_replaces_and_evicts_least_recently_used():
+    cache = PrefixKVCache(max_entries=2, min_prefix_tokens=1)
+    a, b, c = [1, 1, 1], [2, 2, 2], [3, 3, 3]
+    cache.put(a, past_key_values(a))
+    cache.put(b, past_key_values(b))
+    cache.put(a, past_key_values(a + [1]))  # Same prompt again, replaced
+    assert len(cache) == 2 and cache.lookup(a + [0])[1].shape == (2, 4)
+
+    assert cache.lookup([2, 2, 0])[0] == 2  # Now b is the most recently used
+    cache.put(c, past_key_values(c))
+    assert len(cache) == 2
+    assert cache.lookup([1, 1, 0]) == (0, None)
+    assert cache.lookup([2, 2, 0])[0] == 2 and cache.lookup([3, 3, 0])[0] == 2
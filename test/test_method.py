@@ -0,0 +1,60 @@
+# Testing script to ensure batched inference gives the same labels as running the samples one by one
+
+import re
+
+import pytest
+
+from benchmarks import synthetic
+from utils.dataset import Dataset
+from utils.llm.stub_backend import StubBackend
+from utils.method import ConvRef
+from utils.structures import ConversationStore, Label, Turn
+
+
+class CapitalizedWords:
+    # Stands in for the spaCy NER model of Stage 1
+    def entities(self, text):
+        return re.findall(r"\b[A-Z][a-z]+\b", text)
+
+
+@pytest.fixture(scope="module")
+def coqa(tmp_path_factory):
+    dataset = Dataset(synthetic.write_dataset(str(tmp_path_factory.mktemp("data")), "CoQA", num_docs=10, turns=4))
+    docs = dict(dataset.docs)
+
+    # Every other sample asks the same question about a document without the answer, so the samples
+    # of every batch branch both ways
+    docs["unrelated"] = "Tickets are sold at the door. The museum opens at noon."
+    conversations = ConversationStore()
+    X, Y = [], []
+    for x, y in zip(*dataset.split("test")):
+        conversation_id, turns = conversations.new()
+        turns.extend(Turn(m["role"], m["content"]) for m in x.conversation)
+        X += [x, conversations.sample(["unrelated"], conversation_id, len(turns))]
+        Y += [y, Label(False, None, None)]
+    return X, Y, docs
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"llm_only": True, "strict": False},
+        {"llm_only": True, "strict": False, "yes_no_scoring": "logits"},
+        {"llm_only": False, "strict": True},
+        {"llm_only": False, "strict": False},
+        {"llm_only": False, "strict": True, "yes_no_scoring": "logits", "stage1": "bm25"},
+        {"llm_only": False, "strict": False, "use_gt_segments": True},
+        {"llm_only": False, "strict": True, "use_gt_segments": True},
+        {"llm_only": False, "strict": False, "use_gt_doc_relevancy": True},
+    ],
+)
+def test_batch_call_matches_call(coqa, kwargs):
+    X, Y, docs = coqa
+    method = ConvRef(StubBackend(), batch_size=4, **kwargs)
+    method.ner = CapitalizedWords()
+
+    expected = [method(x, docs, y) for x, y in zip(X, Y)]
+    labels = [y_hat for i in range(0, len(X), 4) for y_hat in method.batch_call(X[i : i + 4], docs, Y[i : i + 4])]
+    fields = lambda y: (y.document_relevant, y.segments, y.answer, y.document_relevant_prob)
+    assert [fields(y) for y in labels] == [fields(y) for y in expected]
+    assert {y.document_relevant for y in expected} == {True, False}
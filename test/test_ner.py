@@ -0,0 +1,63 @@
+# Testing script for the lazily loaded spaCy NER and its bounded entity cache
+
+import re
+from types import SimpleNamespace
+
+import spacy
+
+from utils.ner import NON_NER_COMPONENTS, EntityExtractor
+
+
+class FakeNLP:
+    # Entities are the capitalized words
+    def __init__(self):
+        self.calls = []
+        self.pipes = []
+
+    def _doc(self, text):
+        return SimpleNamespace(ents=[SimpleNamespace(text=w) for w in re.findall(r"\b[A-Z][a-z]+\b", text)])
+
+    def __call__(self, text):
+        self.calls.append(text)
+        return self._doc(text)
+
+    def pipe(self, texts, n_process=1, batch_size=256):
+        self.pipes.append((list(texts), n_process, batch_size))
+        return (self._doc(text) for text in texts)
+
+
+def fake_spacy(monkeypatch):
+    nlp, loads = FakeNLP(), []
+    monkeypatch.setattr(spacy, "load", lambda name, exclude=(): loads.append((name, exclude)) or nlp)
+    return nlp, loads
+
+
+def test_prefetch_batches_the_texts_and_fills_the_cache(monkeypatch):
+    nlp, loads = fake_spacy(monkeypatch)
+    ner = EntityExtractor()
+    assert loads == []  # Nothing loaded until the first use
+
+    texts = ["Is Paris far from Rome?", "Where is Berlin?", "Is Paris far from Rome?"]
+    ner.prefetch(texts, n_process=2, batch_size=16)
+    assert loads == [("en_core_web_lg", NON_NER_COMPONENTS)]
+    assert nlp.pipes == [(["Is Paris far from Rome?", "Where is Berlin?"], 2, 16)]
+
+    assert ner.entities("Where is Berlin?") == ["Where", "Berlin"]
+    assert ner.entities("Is Paris far from Rome?") == ["Is", "Paris", "Rome"]
+    assert nlp.calls == []
+    # Only the texts that are not cached yet are computed, in one more batch
+    ner.prefetch(["Where is Berlin?", "Who lives in Oslo?"])
+    assert nlp.pipes[-1][0] == ["Who lives in Oslo?"] and len(loads) == 1
+
+
+def test_cache_keeps_the_most_recently_used_texts(monkeypatch):
+    nlp, _ = fake_spacy(monkeypatch)
+    ner = EntityExtractor(max_cached=2)
+    ner.prefetch(["Rome?", "Oslo?"])
+    ner.entities("Rome?")  # Now the most recently used
+    ner.entities("Paris?")
+    assert len(ner._cache) == 2 and nlp.calls == ["Paris?"]
+
+    ner.entities("Rome?")
+    ner.entities("Oslo?")
+    assert nlp.calls == ["Paris?", "Oslo?"]
@@ -0,0 +1,88 @@
+# Testing script for the staged pipeline overlapping the CPU and model stages of the method
+
+import random
+import threading
+import time
+
+import pytest
+
+from utils.llm.stub_backend import StubBackend
+from utils.method import ConvRef
+from utils.pipeline import Stage, StagePipeline
+from utils.structures import ConversationStore, Turn
+
+
+def test_results_come_back_in_input_order():
+    rng = random.Random(0)
+    delays = [rng.random() * 0.005 for _ in range(100)]
+
+    def slow_identity(i):
+        time.sleep(delays[i])
+        return i
+
+    pipeline = StagePipeline(
+        [Stage("wait", slow_identity, workers=4), Stage("add", lambda i: i * i + 1, workers=3)], max_queue_size=2
+    )
+    assert list(pipeline.run(range(100))) == [i * i + 1 for i in range(100)]
+    assert pipeline.metrics["wait"].items == pipeline.metrics["add"].items == 100
+
+
+def test_stage_exception_propagates_without_hanging():
+    def fail_on_three(i):
+        if i == 3:
+            raise ValueError("bad item")
+        return i
+
+    pipeline = StagePipeline([Stage("cpu", lambda i: i, workers=2), Stage("model", fail_on_three)], max_queue_size=1)
+    start = time.time()
+    with pytest.raises(ValueError, match="bad item"):
+        list(pipeline.run(range(1000)))
+    assert time.time() - start < 5
+
+
+def test_bounded_queues_hold_back_the_input():
+    fed = []
+    release = threading.Event()
+
+    def items():
+        for i in range(100):
+            fed.append(i)
+            yield i
+
+    def blocked(i):
+        release.wait()
+        return i
+
+    pipeline = StagePipeline([Stage("cpu", lambda i: i), Stage("model", blocked)], max_queue_size=2)
+    results = []
+    consumer = threading.Thread(target=lambda: results.extend(pipeline.run(items())))
+    consumer.start()
+    time.sleep(0.3)
+    # At most a full queue and an item in hand per stage, plus the item the feeder is putting
+    assert len(fed) <= 2 * (2 + 1) + 1
+    release.set()
+    consumer.join(timeout=5)
+    assert results == list(range(100))
+    assert max(metrics.max_queue_depth for metrics in pipeline.metrics.values()) <= 2
+
+
+def test_pipelined_call_counts_dedup_stats_like_call():
+    docs = {
+        str(i): " ".join(f"Guests may bring cats to room {i}. Cats get a bed in room {k}." for k in range(20))
+        for i in range(8)
+    }
+    conversations = ConversationStore()
+    samples = []
+    for i in range(40):
+        conversation_id, turns = conversations.new()
+        turns.append(Turn("user", f"Can I bring my cats to room {i % 8}?"))
+        samples.append(conversations.sample([str(i % 8)], conversation_id, 1))
+
+    # The bm25 Stage 1 needs no NER model, and its segments go through the near-duplicate removal
+    sequential = ConvRef(StubBackend(), llm_only=False, strict=False, stage1="bm25")
+    expected = [sequential(X, docs) for X in samples]
+    pipelined = ConvRef(StubBackend(), llm_only=False, strict=False, stage1="bm25")
+    labels = list(pipelined.pipelined_call(samples, docs, cpu_workers=4))
+
+    assert [y.answer for y in labels] == [y.answer for y in expected]
+    assert pipelined.dedup_stats == sequential.dedup_stats and sequential.dedup_stats.pairs > 0
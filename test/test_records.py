@@ -0,0 +1,181 @@
+# Testing script to ensure the binary dataset files round-trip the JSON ones
+
+import json
+import os
+import sys
+
+from utils.data import preprocess, records, stream
+from utils.dataset import Dataset
+from utils.structures import DataClassEncoder, Label, Sample, Turn
+
+
+def write_json_dataset(fp):
+    docs = {"d1": "Première phrase. Second sentence!", "d2": "", "d3": "Q: parking?\nA: Yes."}
+    train_X = [Sample(["d1"], [{"role": "user", "content": "hello"}])]
+    train_Y = [Label(True, ["Second sentence!"], "Second sentence!")]
+    test_X = [Sample(["d1", "d3"], [{"role": "user", "content": f"q{i} ✓"}]) for i in range(5)]
+    test_Y = [Label(False, None, None, time_taken=0.5) for _ in range(5)]
+    for name, value in [
+        ("docs", docs),
+        ("train_X", train_X),
+        ("train_Y", train_Y),
+        ("test_X", test_X),
+        ("test_Y", test_Y),
+    ]:
+        with open(os.path.join(fp, f"{name}.json"), "w") as f:
+            json.dump(value, f, cls=DataClassEncoder, indent=4)
+
+
+def test_binary_dataset_matches_json(tmp_path):
+    fp = str(tmp_path)
+    write_json_dataset(fp)
+    expected = Dataset(fp)
+
+    records.convert_dataset(fp)
+    dataset = Dataset(fp)
+
+    assert isinstance(dataset.docs, records.DocumentStore)
+    assert dict(dataset.docs) == expected.docs
+    for name in records.SPLIT_FILES:
+        assert list(getattr(dataset, name)) == getattr(expected, name)
+    assert list(dataset.test_X[1:4]) == expected.test_X[1:4]
+    assert dataset.test_Y[-1] == expected.test_Y[-1]
+
+
+def test_split_only_loads_requested_split(tmp_path):
+    fp = str(tmp_path)
+    write_json_dataset(fp)
+    records.convert_dataset(fp)
+    dataset = Dataset(fp)
+
+    X, Y = dataset.split("test", 1, 3)
+    assert [x.conversation[0]["content"] for x in X] == ["q1 ✓", "q2 ✓"]
+    assert len(Y) == 2
+    assert "train_X" not in dataset._data and "train_Y" not in dataset._data
+
+
+def write_raw_coqa(fp, questions):
+    os.makedirs(fp, exist_ok=True)
+    for name in ["coqa-train-v1.0.json", "coqa-dev-v1.0.json"]:
+        item = {
+            "id": name,
+            "story": "A story.",
+            "questions": [{"input_text": q} for q in questions],
+            "answers": [{"input_text": f"a{i}", "span_text": f"s{i}"} for i in range(len(questions))],
+        }
+        with open(os.path.join(fp, name), "w") as f:
+            json.dump({"data": [item]}, f)
+
+
+def test_conversations_are_shared(tmp_path):
+    fp = os.path.join(str(tmp_path), "CoQA")
+    write_raw_coqa(fp, ["q0", "q1", "q2"])
+    dataset = Dataset(fp)
+
+    # One turn list per conversation, every sample a view of it
+    X = dataset.test_X
+    assert X[0].conversation_id == X[2].conversation_id != dataset.train_X[0].conversation_id
+    assert X[2].conversation.turns is X[0].conversation.turns
+    assert [m["content"] for m in X[1].conversation] == ["q0", "q1"]
+    assert X[1].conversation[-1] == {"role": "user", "content": "q1"}
+
+    # Only the binary files are written, and their sample records are JSON lines without the conversation
+    names = ["docs", "train_conversations", "test_conversations"] + records.SPLIT_FILES
+    assert not any(os.path.exists(os.path.join(fp, f"{name}.json")) for name in names)
+    with open(os.path.join(fp, "test_X.bin"), "r") as f:
+        assert "conversation" not in json.loads(f.readline())
+
+    # JSON files written by older versions load the same samples
+    json_fp = os.path.join(str(tmp_path), "json")
+    os.makedirs(json_fp)
+    values = {"docs": dict(dataset.docs)}
+    for split in ["train", "test"]:
+        conversations = dataset._conversations(split)
+        values[f"{split}_conversations"] = {cid: [t.as_message() for t in conversations[cid]] for cid in conversations}
+    values.update({name: list(getattr(dataset, name)) for name in records.SPLIT_FILES})
+    for name, value in values.items():
+        with open(os.path.join(json_fp, f"{name}.json"), "w") as f:
+            json.dump(value, f, cls=DataClassEncoder, indent=4)
+    assert list(Dataset(json_fp).test_X) == list(X)
+
+
+def test_duplicate_documents_keep_the_last_text(tmp_path):
+    fp = os.path.join(str(tmp_path), "CoQA")
+    os.makedirs(fp)
+    def story(doc_id, text):
+        return {"id": doc_id, "story": text, "questions": [{"input_text": "q"}], "answers": [{"input_text": "a", "span_text": "s"}]}
+
+    raw = {
+        "coqa-train-v1.0.json": [story("a", "Train a."), story("b", "Train b."), story("b", "Train b again.")],
+        "coqa-dev-v1.0.json": [story("c", "Dev c."), story("a", "Dev a."), story("a", "Dev a.")],
+    }
+    for name, data in raw.items():
+        with open(os.path.join(fp, name), "w") as f:
+            json.dump({"data": data}, f)
+
+    # Like updating a dict with the documents of the train split, then those of the test split
+    expected = {}
+    for data in raw.values():
+        expected.update((item["id"], item["story"]) for item in data)
+    docs = Dataset(fp).docs
+    assert list(docs.items()) == list(expected.items())
+    assert os.path.exists(os.path.join(fp, stream.DOCS_DONE_FILE))
+
+
+def test_records_are_compact():
+    doc_id = "".join(["QuAC", "_doc"])  # Not a literal, so only interning makes it the same object
+    a = Sample([doc_id], [{"role": "user", "content": "hi"}])
+    b = Sample.from_dict(json.loads(json.dumps(a, cls=DataClassEncoder)))
+    assert not hasattr(a, "__dict__") and not hasattr(Label(True, None, None), "__dict__")
+    assert b.document_ids[0] is a.document_ids[0]
+    assert isinstance(b.conversation.turns[0], Turn) and b.conversation.turns[0].role is sys.intern("user")
+    assert b == a and json.dumps(b, cls=DataClassEncoder) == json.dumps(a, cls=DataClassEncoder)
+
+
+def test_preprocess_rebuilds_only_changed_splits(tmp_path):
+    fp = os.path.join(str(tmp_path), "CoQA")
+    write_raw_coqa(fp, ["q0", "q1"])
+    assert preprocess.preprocess([fp], workers=2) == {fp: ["train", "test"]}
+    assert preprocess.preprocess([fp], workers=2) == {fp: []}
+
+    with open(os.path.join(fp, "coqa-dev-v1.0.json"), "r") as f:
+        data = json.load(f)
+    data["data"][0]["questions"][0]["input_text"] = "changed"
+    with open(os.path.join(fp, "coqa-dev-v1.0.json"), "w") as f:
+        json.dump(data, f)
+    assert preprocess.preprocess([fp], workers=2) == {fp: ["test"]}
+    dataset = Dataset(fp)
+    assert dataset.test_X[0].conversation[0]["content"] == "changed"
+    assert dataset.train_X[0].conversation[0]["content"] == "q0"
+
+
+def test_unchanged_raw_files_are_not_hashed_again(tmp_path, monkeypatch):
+    fp = os.path.join(str(tmp_path), "CoQA")
+    write_raw_coqa(fp, ["q0", "q1"])
+    preprocess.preprocess([fp], workers=1)
+    hashed = []
+    file_hash = preprocess._file_hash
+    monkeypatch.setattr(preprocess, "_file_hash", lambda path: hashed.append(path) or file_hash(path))
+
+    Dataset(fp)
+    assert hashed == []
+    # Same contents with a new mtime: hashed once, not rebuilt, and not hashed on the next startup
+    raw_fp = os.path.join(fp, "coqa-train-v1.0.json")
+    os.utime(raw_fp, ns=(0, 0))
+    assert preprocess.preprocess([fp], workers=1) == {fp: []}
+    assert hashed == [raw_fp]
+    Dataset(fp)
+    assert hashed == [raw_fp]
+
+
+def test_iter_json_array_streams_elements(tmp_path):
+    data = [{"id": i, "text": "é" * i, "n": [1.5, -20, None, True]} for i in range(50)] + [12345, "x"]
+    fp = os.path.join(str(tmp_path), "raw.json")
+    with open(fp, "w") as f:
+        json.dump({"version": {"v": [1, 2]}, "data": data}, f, ensure_ascii=False, indent=2)
+
+    # Chunks smaller than the elements, so every element spans several reads
+    assert list(stream.iter_json_array(fp, key="data", chunk_size=7)) == data
+    with open(fp, "w") as f:
+        json.dump(data, f)
+    assert list(stream.iter_json_array(fp, chunk_size=3)) == data
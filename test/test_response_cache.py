@@ -0,0 +1,92 @@
+# Testing script for the persistent response cache and the backend wrapper serving from it
+
+import itertools
+import os
+
+import pytest
+
+from utils.llm import response_cache
+from utils.llm.response_cache import CachedBackend, ResponseCache
+from utils.llm.stub_backend import StubBackend
+
+
+class CountingBackend(StubBackend):
+    def __init__(self):
+        super().__init__()
+        self.prompts = []
+
+    def generate(self, messages, max_new_tokens=256):
+        self.prompts.append(messages[-1]["content"])
+        return super().generate(messages, max_new_tokens=max_new_tokens)
+
+    def batch_generate(self, histories, max_new_tokens=256, batch_size=8):
+        self.prompts.extend(history[-1]["content"] for history in histories)
+        return super().batch_generate(histories, max_new_tokens=max_new_tokens, batch_size=batch_size)
+
+
+def prompt(text):
+    return [{"role": "user", "content": text}]
+
+
+def test_hits_misses_and_keys(tmp_path):
+    model = CountingBackend()
+    cache = ResponseCache(os.path.join(str(tmp_path), "cache.sqlite"))
+    cached = CachedBackend(model, cache)
+
+    first = cached.generate(prompt("Is there free parking?"))
+    assert cached.generate(prompt("Is there free parking?")) == first
+    assert cached.batch_generate([prompt("Is there free parking?"), prompt("Where is the hotel?")]) == [
+        first,
+        model.generate(prompt("Where is the hotel?")),
+    ]
+    # Only the misses reached the model (the last call above is the reference, not cached)
+    assert model.prompts == ["Is there free parking?", "Where is the hotel?", "Where is the hotel?"]
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 2 and len(cache) == 2
+
+    # Different generation parameters, methods and models are different entries
+    key = cache.make_key("stub", prompt("a"), {"method": "generate", "max_new_tokens": 256})
+    assert key == cache.make_key("stub", prompt("a"), {"max_new_tokens": 256, "method": "generate"})
+    assert len({
+        key,
+        cache.make_key("stub", prompt("b"), {"method": "generate", "max_new_tokens": 256}),
+        cache.make_key("stub", prompt("a"), {"method": "generate", "max_new_tokens": 16}),
+        cache.make_key("stub", prompt("a"), {"method": "yes_no_probabilities"}),
+        cache.make_key("other", prompt("a"), {"method": "generate", "max_new_tokens": 256}),
+    }) == 5
+    cached.generate(prompt("Is there free parking?"), max_new_tokens=16)
+    assert model.prompts[-1] == "Is there free parking?" and len(cache) == 3
+
+
+def test_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(response_cache.time, "time", lambda: float(next(clock)))
+    cache = ResponseCache(os.path.join(str(tmp_path), "cache.sqlite"), max_entries=10)
+    for i in range(10):
+        cache.put(f"k{i}", "stub", f"r{i}")
+    assert cache.get("k0") == "r0"  # Now the most recently used
+
+    cache.put("k10", "stub", "r10")
+    # Down to 90% of the bound, dropping the least recently used
+    assert len(cache) == 9 and cache.stats()["evictions"] == 2
+    assert cache.get("k1") is None and cache.get("k2") is None
+    assert [cache.get(f"k{i}") for i in [0, 3, 10]] == ["r0", "r3", "r10"]
+
+
+def test_read_only_never_writes(tmp_path):
+    fp = os.path.join(str(tmp_path), "cache.sqlite")
+    with pytest.raises(FileNotFoundError):
+        ResponseCache(fp, read_only=True)
+
+    writer = ResponseCache(fp)
+    CachedBackend(StubBackend(), writer).generate(prompt("Is there free parking?"))
+    writer.close()
+
+    model = CountingBackend()
+    cache = ResponseCache(fp, read_only=True)
+    cached = CachedBackend(model, cache)
+    cached.generate(prompt("Is there free parking?"))
+    cached.generate(prompt("Where is the hotel?"))
+    cached.generate(prompt("Where is the hotel?"))
+    # The miss is answered by the model every time, and never stored
+    assert model.prompts == ["Where is the hotel?", "Where is the hotel?"]
+    assert len(cache) == 1 and cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
@@ -0,0 +1,271 @@
+# Testing script to ensure the retrieval helpers match the original keyword search
+
+import math
+import random
+import re
+from collections import Counter
+from difflib import SequenceMatcher
+
+import numpy as np
+import pytest
+
+from utils.graph.summary_tree import SummaryTree
+from utils.llm.stub_backend import StubBackend, StubEmbeddingModel
+from utils.method import ConvRef
+from utils.retrieval.bm25 import BM25Index, tokenize
+from utils.retrieval.context_packer import ContextPacker
+from utils.retrieval.dedup import DedupStats, remove_near_duplicates
+from utils.retrieval.dense_index import DenseIndex
+from utils.retrieval.sentence_index import KeywordMatcher, SentenceIndex
+from utils.retrieval.tree_retrieval import TreeRetriever
+from utils.structures import ConversationStore, Turn
+
+
+def extract_keyword_context(document, keyword):
+    # Reference implementation copied from ConvRef._extract_keyword_context
+    results = []
+    keyword = keyword.lower()
+    sentences = re.split(r"(?<=[.!?]) +", document)
+    for i, sentence in enumerate(sentences):
+        if keyword in sentence.lower():
+            before = sentences[i - 1] if i > 0 else ""
+            after = sentences[i + 1] if i < len(sentences) - 1 else ""
+            results.append(f"{before} {sentence} {after}".strip())
+    return results
+
+
+def random_docs(rng, n_docs=20):
+    words = ["Fox", "dog", "new", "new york", "York", "park", "parking", "free", "Q:", "A:"]
+    docs = {}
+    for i in range(n_docs):
+        sentences = []
+        for _ in range(rng.randint(1, 15)):
+            sentence = " ".join(rng.choice(words) for _ in range(rng.randint(1, 8)))
+            sentences.append(sentence + rng.choice([".", "!", "?", "\n", ""]))
+        docs[str(i)] = rng.choice([" ", "  "]).join(sentences)
+    return docs
+
+
+def test_find_contexts_matches_reference():
+    rng = random.Random(0)
+    docs = random_docs(rng)
+    index = SentenceIndex(docs)
+    for _ in range(50):
+        doc_ids = rng.sample(list(docs), 3)
+        keywords = rng.sample(["fox", "new", "new york", "york", "park", "a:", "dog fox"], 3)
+
+        expected = []
+        for keyword in keywords:
+            for doc_id in doc_ids:
+                expected.extend(extract_keyword_context(docs[doc_id], keyword))
+        assert index.find_contexts(doc_ids, keywords) == expected
+
+
+def test_keyword_matcher_overlapping_keywords():
+    matcher = KeywordMatcher(["New York", "new", " york ", ""])
+    assert matcher.keywords == ["new york", "new", "york"]
+    assert sorted(matcher.finditer("i love new york")) == [(0, 7), (1, 7), (2, 11)]
+
+
+def remove_near_duplicates_reference(strings, similarity_threshold=0.9):
+    # Reference implementation copied from ConvRef._remove_near_duplicates
+    strings = sorted(strings, key=len, reverse=True)
+    unique_strings = []
+    for s in strings:
+        if not any(
+            SequenceMatcher(None, s, unique).ratio() >= similarity_threshold
+            for unique in unique_strings
+        ):
+            unique_strings.append(s)
+    return unique_strings
+
+
+def test_remove_near_duplicates_matches_reference():
+    rng = random.Random(0)
+    docs = list(random_docs(rng, n_docs=10).values())
+    index = SentenceIndex(dict(enumerate(docs)))
+    for threshold in [0.5, 0.9, 1.0]:
+        strings = [w for i in range(len(docs)) for w in index[i].windows()]
+        strings += [s[:-1] for s in strings[::3]] + [s + "x" for s in strings[::5]] + ["", ""]
+        rng.shuffle(strings)
+
+        stats = DedupStats()
+        assert remove_near_duplicates(strings, threshold, stats) == (
+            remove_near_duplicates_reference(strings, threshold)
+        )
+        assert stats.skipped > 0
+
+
+def bm25_reference(windows, query, k1=1.5, b=0.75):
+    # Textbook Okapi BM25 of every window, with the windows as the collection
+    tokenized = [tokenize(window) for window in windows]
+    avg_length = sum(len(tokens) for tokens in tokenized) / len(tokenized)
+    df = Counter(token for tokens in tokenized for token in set(tokens))
+    scores = []
+    for tokens in tokenized:
+        tf = Counter(tokens)
+        score = 0.0
+        for token, count in Counter(tokenize(query)).items():
+            if token in tf:
+                idf = math.log(1 + (len(tokenized) - df[token] + 0.5) / (df[token] + 0.5))
+                norm = k1 * (1 - b + b * len(tokens) / avg_length)
+                score += count * idf * tf[token] * (k1 + 1) / (tf[token] + norm)
+        scores.append(score)
+    return scores
+
+
+def test_bm25_matches_reference():
+    rng = random.Random(0)
+    docs = random_docs(rng)
+    sentence_index = SentenceIndex(docs)
+    index = BM25Index(sentence_index)
+
+    windows = [(doc_id, window) for doc_id in docs for window in sentence_index[doc_id].windows()]
+    for _ in range(20):
+        query = " ".join(rng.choice(["fox", "dog", "new", "york", "park", "parking", "free"]) for _ in range(3))
+        doc_ids = rng.sample(list(docs), 5)
+        candidates = [window for doc_id in doc_ids for d, window in windows if d == doc_id]
+        scores = bm25_reference([window for _, window in windows], query)
+        by_window = {}
+        for (doc_id, window), score in zip(windows, scores):
+            if doc_id in doc_ids:
+                by_window.setdefault(doc_id, []).append(score)
+        candidate_scores = [score for doc_id in doc_ids for score in by_window[doc_id]]
+
+        expected = sorted(
+            (i for i, score in enumerate(candidate_scores) if score > 0),
+            key=lambda i: (-candidate_scores[i], i),
+        )[:10]
+        result = index.search(doc_ids, index.query_vector(query), top_k=10)
+        assert result == [candidates[i] for i in expected]
+
+
+def test_bm25_trailing_windows_without_terms():
+    # The last windows (and a last empty document) have only stopwords, or nothing at all
+    for docs in [{"a": "The cat sat.", "b": "the."}, {"a": "The cat sat. A dog ran.", "b": ""}]:
+        index = BM25Index(SentenceIndex(docs))
+        assert index.search(list(docs), index.query_vector("cat"), top_k=10)[0].startswith("The cat sat.")
+        assert index.search(["b"], index.query_vector("cat"), top_k=10) == []
+
+
+class InterruptedEmbedding(StubEmbeddingModel):
+    # Fails after `batches` calls, like a build killed halfway through
+    def __init__(self, batches):
+        super().__init__()
+        self.batches = batches
+        self.encoded = 0
+
+    def encode(self, texts, task=None):
+        if self.batches == 0:
+            raise KeyboardInterrupt
+        self.batches -= 1
+        self.encoded += len(texts)
+        return super().encode(texts, task=task)
+
+
+def test_dense_index_resumes_and_matches_brute_force(tmp_path):
+    rng = random.Random(0)
+    docs = random_docs(rng)
+    docs["copy"] = docs["0"]  # Identical windows, so tied scores
+    sentence_index = SentenceIndex(docs)
+    n_windows = sum(len(sentence_index[doc_id]) for doc_id in docs)
+
+    fp = str(tmp_path / "dense")
+    model = InterruptedEmbedding(batches=2)
+    try:
+        DenseIndex.build(fp, sentence_index, model, batch_size=7)
+    except KeyboardInterrupt:
+        pass
+    with pytest.raises(ValueError):
+        DenseIndex(fp, sentence_index)
+    model.batches = -1  # No more interruptions
+    DenseIndex.build(fp, sentence_index, model, batch_size=7)
+    assert model.encoded == n_windows  # The 14 windows of the first run are not embedded again
+
+    reference_fp = str(tmp_path / "reference")
+    DenseIndex.build(reference_fp, sentence_index, StubEmbeddingModel(), batch_size=1000)
+    index = DenseIndex(fp, sentence_index)
+    assert isinstance(index.embeddings, np.memmap) and index.embeddings.dtype == np.float16
+    assert np.array_equal(index.embeddings, DenseIndex(reference_fp, sentence_index).embeddings)
+
+    embedding_model = StubEmbeddingModel()
+    for _ in range(20):
+        query = embedding_model.encode([" ".join(rng.choice(["fox", "dog", "park", "free"]) for _ in range(3))])[0]
+        doc_ids = rng.sample(list(docs), 5) + ["0", "copy"]
+        windows = [window for doc_id in doc_ids for window in sentence_index[doc_id].windows()]
+        embeddings = embedding_model.encode(windows).astype(np.float16).astype(np.float32)
+        scores = embeddings @ query
+        expected = sorted(range(len(windows)), key=lambda i: (-scores[i], i))[:10]
+        assert index.search(doc_ids, query, top_k=10) == [windows[i] for i in expected]
+
+
+TOPIC_WORDS = ["cat", "kitten", "whiskers", "train", "rail", "station"]
+
+
+class WordCountEmbedding:
+    # Tiny embedding model: counts of a few topic words, plus a constant so no vector is zero
+    def encode(self, texts, task=None):
+        return np.array([[text.lower().count(word) for word in TOPIC_WORDS] + [0.1] for text in texts])
+
+
+def test_tree_retriever_follows_best_matching_summaries():
+    chunks = [
+        "Cats sleep most of the day.",
+        "A kitten has soft whiskers.",
+        "Cats chase a kitten toy.",
+        "The train leaves the station.",
+        "Trains run on rail tracks.",
+        "The station has a rail museum.",
+    ]
+    doc = "\n\n".join(chunks)
+    tree = SummaryTree(None)
+    tree.generate_from(doc, StubBackend(), WordCountEmbedding(), max_nodes_per_level=4)
+    # The chunks are clustered by topic, under keyword summaries written by the model
+    topics = {("cats" if "cats" in child.data else "station"): child for child in tree.root.children}
+    assert len(tree.root.children) == 2 and set(topics) == {"cats", "station"}
+    leaves = {topic: {leaf.data for leaf in TreeRetriever._leaves(node)} for topic, node in topics.items()}
+
+    for emb_model in [WordCountEmbedding(), None]:
+        retriever = TreeRetriever({"d": tree}, {"d": doc, "other": "Not summarized."}, emb_model=emb_model, top_k=1)
+        for query, topic in [("Where does the train stop at the station?", "station"), ("Is my kitten a cat?", "cats")]:
+            selected = retriever.select(["d", "other"], query)
+            texts = [retriever.chunks[chunk_id] for chunk_id in selected]
+            # Leaves under the best summary, then the whole document without a tree
+            assert texts[-1] == "Not summarized." and texts[:-1] and set(texts[:-1]) <= leaves[topic]
+    assert retriever.stats()["selected_chars"] < retriever.stats()["total_chars"]
+
+
+def test_context_packer_keeps_best_units_within_budget():
+    model = StubBackend()
+    texts = {
+        "a": "Cats sleep all day. Dogs bark at night. Cats purr softly.",
+        "b": "Q: Are cats allowed?\nA: No.\n\nQ: Is there parking?\nA: Yes, free parking.",
+    }
+    query = "Can I bring my cats?"
+    assert ContextPacker(model.count_tokens, 100).pack(texts, query) == (texts, {})
+
+    packer = ContextPacker(model.count_tokens, 20)
+    packed, dropped = packer.pack(texts, query)
+    # The units about cats are kept, in document order, and the others are dropped
+    assert packed == {"a": "Cats sleep all day. Cats purr softly.", "b": "Q: Are cats allowed?\nA: No."}
+    assert sum(model.count_tokens(text) for text in packed.values()) <= 20
+    assert dropped == {"a": model.count_tokens("Dogs bark at night."), "b": model.count_tokens(texts["b"]) - 10}
+
+    # A document with nothing kept is left out of the context
+    packed, dropped = ContextPacker(model.count_tokens, 9).pack(texts, query)
+    assert list(packed) == ["a"] and dropped["b"] == model.count_tokens(texts["b"])
+    assert packer.stats() == {"packed": 1, "truncated": 1}
+
+
+def test_dropped_context_is_recorded_on_the_label():
+    conversations = ConversationStore()
+    conversation_id, turns = conversations.new()
+    turns.append(Turn("user", "Can I bring my cats?"))
+    X = conversations.sample(["a"], conversation_id, 1)
+    docs = {"a": "Cats sleep all day. Dogs bark at night. Cats purr softly."}
+
+    # The LLM-only prompt has the documents too, without needing the NER model of Stage 1
+    method = ConvRef(StubBackend(), llm_only=True, strict=False)
+    assert method(X, docs).dropped_context is None
+    method.use_context_budget(10)
+    assert method(X, docs).dropped_context == {"a": 5}
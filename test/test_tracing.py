@@ -0,0 +1,38 @@
+# Testing script for the per-stage spans of the predictions, their statistics and the Chrome trace export
+
+import json
+import os
+
+from utils import tracing
+from utils.llm.stub_backend import StubBackend
+from utils.structures import DataClassEncoder, Label
+
+
+def test_spans_nest_count_tokens_and_round_trip(tmp_path):
+    model = tracing.TracedBackend(StubBackend())
+    model.generate([{"role": "user", "content": "not traced"}])
+    with tracing.trace() as spans:
+        with tracing.span("keywords"):
+            model.generate([{"role": "user", "content": "which keywords"}])
+        with tracing.span("generation"):
+            pass
+    assert [s.name for s in spans] == ["keywords", "keywords/generate", "generation"]
+    assert spans[1].prompt_tokens > 0 and spans[1].generated_tokens is not None
+    assert not tracing.is_tracing()
+
+    # Two samples of one batch share its spans, which are counted once
+    Y_hat = [Label(True, None, "a", spans=spans), Label(False, None, None, spans=list(spans))]
+    Y_hat = [Label(**value) for value in json.loads(json.dumps(Y_hat, cls=DataClassEncoder))]
+    assert Y_hat[0].spans == spans
+
+    stats = tracing.stage_stats(Y_hat)
+    assert stats["keywords"]["count"] == 1 and stats["keywords"]["p50"] >= stats["keywords/generate"]["p50"]
+    assert stats["keywords/generate"]["prompt_tokens"] == spans[1].prompt_tokens
+    assert "prompt_tokens" not in stats["generation"]
+
+    fp = os.path.join(str(tmp_path), "eval_trace.json")
+    tracing.save_chrome_trace(Y_hat, fp)
+    with open(fp, "r") as f:
+        events = json.load(f)["traceEvents"]
+    assert [e["name"] for e in events if e["ph"] == "X"] == ["keywords", "keywords/generate", "generation"]
+    assert events[0]["args"]["samples"] == [0, 1]
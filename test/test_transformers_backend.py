@@ -0,0 +1,115 @@
+# Testing script for the transformers backend, on a word-level fast tokenizer and a tiny model
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+from utils.llm import transformers_backend
+from utils.llm.transformers_backend import TransformersBackend
+from utils.method import ConvRef
+from utils.structures import ConversationStore, Turn
+
+WORDS = ["[PAD]", "[UNK]", "YES", "Yes", "yes", "NO", "No", "no", "cats", "dogs", "room"] + [f"w{i}" for i in range(200)]
+
+
+def word_tokenizer():
+    tokenizer = Tokenizer(models.WordLevel({w: i for i, w in enumerate(WORDS)}, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]", unk_token="[UNK]")
+    tokenizer.chat_template = "{% for message in messages %}{{ message['content'] }} {% endfor %}"
+    return tokenizer
+
+
+class TinyModel(torch.nn.Module):
+    """Hidden state: mean of the token embeddings so far plus a position embedding, so both the attention
+    mask and the position ids change the output."""
+
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.embeddings = torch.nn.Embedding(len(WORDS), 16)
+        self.positions = torch.nn.Embedding(4096, 16)
+        self.head = torch.nn.Linear(16, len(WORDS), bias=False)
+        self.generation_config = SimpleNamespace(pad_token_id=None)
+
+    @property
+    def device(self):
+        return torch.device("cpu")
+
+    def base_model(self, input_ids, attention_mask, position_ids):
+        mask = attention_mask.unsqueeze(-1).float()
+        summed = (self.embeddings(input_ids) * mask).cumsum(1)
+        mean = summed / mask.cumsum(1).clamp(min=1)
+        return SimpleNamespace(last_hidden_state=mean + self.positions(position_ids))
+
+    def get_output_embeddings(self):
+        return self.head
+
+
+class TinyPipeline:
+    def __init__(self):
+        self.tokenizer = word_tokenizer()
+        self.model = TinyModel()
+
+    def __call__(self, histories, max_new_tokens=256, batch_size=None):
+        # One history for generate(), a list of them for batch_generate()
+        batched = batch_size is not None
+        outputs = [
+            [{"generated_text": history + [{"role": "assistant", "content": "cats"}]}]
+            for history in (histories if batched else [histories])
+        ]
+        return outputs if batched else outputs[0]
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    monkeypatch.setattr(transformers_backend, "pipeline", lambda *args, **kwargs: TinyPipeline())
+    return TransformersBackend("tiny")
+
+
+def test_pipelined_context_budget_counts_tokens_beside_padded_batches(backend):
+    def sentence(i, k):
+        # Long sentences, every eighth one mentioning cats
+        return " ".join(f"w{(i * 7 + k + j) % 200}" for j in range(60)) + (" cats." if k % 8 == 0 else ".")
+
+    docs = {str(i): " ".join(sentence(i, k) for k in range(40)) for i in range(40)}
+    conversations = ConversationStore()
+    samples = []
+    for i in range(40):
+        conversation_id, turns = conversations.new()
+        turns.append(Turn("user", f"w{i} cats"))
+        samples.append(conversations.sample([str(i), str((i + 1) % 40)], conversation_id, 1))
+
+    # The prepare threads pack (count the tokens of) the documents of the next samples while the answer
+    # stage scores the relevancy with a padded batch
+    method = ConvRef(backend, llm_only=False, strict=True, yes_no_scoring="logits", relevancy_threshold=0.0)
+    method.ner = SimpleNamespace(entities=lambda text: [])  # No NER model needed
+    method.use_context_budget(100)
+    labels = list(method.pipelined_call(samples, docs, cpu_workers=4))
+    assert len(labels) == 40 and all(sum(y.dropped_context.values()) > 0 for y in labels)
+
+
+def test_yes_no_probabilities_of_left_padded_batches(backend):
+    histories = [
+        [{"role": "user", "content": "cats"}],
+        [{"role": "user", "content": "w1 w2 w3 w4 w5 w6 w7 dogs room"}],
+        [{"role": "system", "content": "w9 w8"}, {"role": "user", "content": "yes or no"}],
+    ]
+    batched = backend.yes_no_probabilities(histories, batch_size=3)
+    # The padding of the shorter prompts changes neither their positions nor what they attend to
+    assert batched == pytest.approx([backend.yes_no_probabilities([h], batch_size=1)[0] for h in histories], abs=1e-6)
+
+    # Reference: full softmax at the last position of the unpadded prompt, YES and NO summed over spellings
+    yes_ids = [WORDS.index(w) for w in ["YES", "Yes", "yes"]]
+    no_ids = [WORDS.index(w) for w in ["NO", "No", "no"]]
+    for history, probability in zip(histories, batched):
+        ids = torch.tensor([backend.tokenizer.apply_chat_template(history, add_generation_prompt=True, tokenize=True)])
+        positions = torch.arange(ids.shape[1]).unsqueeze(0)
+        with torch.no_grad():
+            hidden = backend.model.base_model(ids, torch.ones_like(ids), positions).last_hidden_state[0, -1]
+            probabilities = torch.softmax(backend.model.head(hidden), dim=-1)
+        yes, no = probabilities[yes_ids].sum().item(), probabilities[no_ids].sum().item()
+        assert probability == pytest.approx(yes / (yes + no), abs=1e-6)
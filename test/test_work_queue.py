@@ -0,0 +1,51 @@
+# Testing script for the SQLite work queue shared by the workers of an experiment
+
+import os
+import time
+
+from utils.structures import ConversationStore, Label, Turn
+from utils.work_queue import WorkQueue
+
+
+def samples(lengths):
+    conversations = ConversationStore()
+    X = []
+    for length in lengths:
+        conversation_id, turns = conversations.new()
+        for turn in range(1, length + 1):
+            turns.append(Turn("user", f"q{turn}"))
+            X.append(conversations.sample(["d"], conversation_id, turn))
+    return X
+
+
+def test_dead_worker_tasks_are_requeued_and_labels_recorded_once(tmp_path):
+    fp = os.path.join(str(tmp_path), "queue.sqlite")
+    X = samples([2, 1])
+    a = WorkQueue(fp, worker="a", lease_seconds=0.2)
+    b = WorkQueue(fp, worker="b", lease_seconds=0.2)
+    a.add(X)
+    b.add(X)
+
+    [task] = a.lease()
+    assert task.indices == [0, 1]  # One task per conversation
+    assert a.record(0, Label(True, None, "a0"))
+    # Worker a stops heartbeating: b gets the other conversation now, and a's one once its lease expires
+    other = b.lease(max_samples=10)
+    assert [t.indices for t in other] == [[2]]
+    assert b.lease() == []
+    time.sleep(0.3)
+    [taken] = b.lease()
+    assert taken.id == task.id and b.recorded(taken.indices) == [0]
+
+    assert b.record(1, Label(True, None, "b1")) and b.record(2, Label(False, None, None))
+    assert not a.record(1, Label(True, None, "late"))  # The first label of a sample is kept
+    a.done([task])  # a no longer holds the lease, so this changes nothing
+    assert not b.is_finished()
+    b.done([taken] + other)
+    assert b.is_finished()
+
+    assert [y.answer for y in b.labels(3)] == ["a0", "b1", None]
+    progress = b.progress()
+    assert progress["labeled"] == 3 and progress["workers"]["a"]["samples"] == 1
+    assert progress["workers"]["b"]["samples"] == 2
+    assert b.claim_scoring() and not WorkQueue(fp, worker="c").claim_scoring()
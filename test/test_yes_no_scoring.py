@@ -0,0 +1,74 @@
+# Testing script for the YES/NO questions scored from the next-token probabilities ("logits" scoring)
+
+from utils.llm.stub_backend import StubBackend
+from utils.method import ConvRef
+from utils.response import affirmative_prob, batch_affirmative_prob
+from utils.scorer import Scorer
+from utils.structures import ConversationStore, Label, Turn
+
+
+class FixedProbabilities(StubBackend):
+    """YES probability of every prompt given by the first of `probabilities` whose key is in the prompt."""
+
+    def __init__(self, probabilities):
+        super().__init__()
+        self.probabilities = probabilities
+        self.histories = []
+        self.batch_sizes = []
+
+    def yes_no_probabilities(self, histories, batch_size=8):
+        self.histories.extend(histories)
+        self.batch_sizes.append(batch_size)
+        texts = [" ".join(m["content"] for m in history) for history in histories]
+        return [next(p for key, p in self.probabilities.items() if key in text) for text in texts]
+
+
+def question(text):
+    return [{"role": "user", "content": text}]
+
+
+def test_affirmative_probability_comes_from_the_backend():
+    model = FixedProbabilities({"parking": 0.8, "pets": 0.3})
+    assert affirmative_prob(model, question("Is there parking?")) == 0.8
+    assert batch_affirmative_prob(model, [question("Any pets?"), question("Is there parking?")], batch_size=4) == [0.3, 0.8]
+    assert model.batch_sizes == [1, 4]
+    assert all(h[-1]["content"].endswith('Answer "YES" or "NO" only.') for h in model.histories)
+
+
+def samples_and_docs():
+    conversations = ConversationStore()
+    docs = {"hotel": "Parking is free. Pets are not allowed.", "museum": "Tickets are sold at the door."}
+    samples = []
+    for doc_id, query in [("hotel", "Is parking free?"), ("museum", "Can I buy tickets?"), ("hotel", "Can I bring pets?")]:
+        conversation_id, turns = conversations.new()
+        turns.append(Turn("user", query))
+        samples.append(conversations.sample([doc_id], conversation_id, 1))
+    return samples, docs
+
+
+def test_relevancy_applies_the_threshold():
+    samples, docs = samples_and_docs()
+    probabilities = {"parking": 0.9, "tickets": 0.6, "pets": 0.2}
+    for threshold, expected in [(0.5, [True, True, False]), (0.7, [True, False, False])]:
+        method = ConvRef(
+            FixedProbabilities(probabilities),
+            llm_only=True,
+            strict=True,
+            yes_no_scoring="logits",
+            relevancy_threshold=threshold,
+        )
+        for labels in [[method(X, docs) for X in samples], method.batch_call(samples, docs)]:
+            assert [y.document_relevant for y in labels] == expected
+            assert [y.document_relevant_prob for y in labels] == [0.9, 0.6, 0.2]
+            # Only the relevant samples get an answer
+            assert [y.answer is not None for y in labels] == expected
+
+
+def test_scorer_judges_consistency_at_one_half(tmp_path):
+    samples, _ = samples_and_docs()
+    Y = [Label(True, None, "Parking is free."), Label(True, None, "At the door."), Label(False, None, None)]
+    Y_hat = [Label(True, None, "Yes, parking is free."), Label(True, None, "Online."), Label(False, None, None)]
+    model = FixedProbabilities({"Yes, parking": 0.5, "Online": 0.49})
+    scores = Scorer(str(tmp_path), evaluator=model, yes_no_scoring="logits").answer(samples, Y_hat, Y)
+    # The third pair has no answer on both sides and is not judged by the model
+    assert scores["values"] == [1, 0, 1] and len(model.histories) == 2
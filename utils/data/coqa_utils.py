@@ -1,44 +1,44 @@
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, Iterator, Optional, Tuple
 
-from utils.structures import Label, Sample
+from utils.structures import ConversationStore, Label, Sample, Turn
 from utils.constants import ANSWER_DELIM
 
-def get_docs(data: Dict) -> Dict[str, str]:
-    """Extract the documents from CoQA dataset and return as a dictionary
-    where keys are the document IDs and values are the document text.
+def get_docs(data: Iterable[Dict]) -> Iterator[Tuple[str, str]]:
+    """Extract the documents from the stories of the CoQA dataset.
 
     Args:
-        data: Raw CoQA dataset dictionary (JSON)
+        data: Stories of the raw CoQA dataset (the "data" list of the JSON), e.g. streamed with
+            `stream.iter_json_array(fp, key="data")`
 
-    Returns:
-        Dictionary mapping document IDs to their text content
+    Yields:
+        Tuple of the document ID and the document text, for every story
     """
 
-    docs = {}
-    for item in data["data"]:
+    for item in data:
         doc_id = str(item["id"])
-        docs[doc_id] = item["story"]
+        yield doc_id, item["story"]
 
-    return docs
 
+def get_XY(
+    data: Iterable[Dict], conversations: Optional[ConversationStore] = None
+) -> Iterator[Tuple[Sample, Label]]:
+    """Extract input samples (X) and labels (Y) from the stories of the CoQA dataset.
 
-def get_XY(data: Dict) -> Tuple[List[Sample], List[Label]]:
-    """Extract input samples (X) and labels (Y) from CoQA dataset.
+    Samples are yielded story by story, once the whole conversation of the story is in the store.
 
     Args:
-        data: Raw CoQA dataset dictionary (JSON)
+        data: Stories of the raw CoQA dataset (the "data" list of the JSON)
+        conversations: Store the conversations are added to (shared by the splits of a dataset)
 
-    Returns:
-        Tuple containing:
-        - List of Sample objects (X) with conversation context
-        - List of Label objects (Y) with answers
+    Yields:
+        Tuple of a Sample (X) with conversation context and its Label (Y) with the answers
     """
     # Questions:
 
-    samples = []
-    labels = []
+    if conversations is None:
+        conversations = ConversationStore()
 
-    for item in data["data"]:
+    for item in data:
         doc_id = str(item["id"])
         questions = []
         all_answers = []    # 2d array. all_answers[i] = list of answers for question[i]. all_answers[i][j] represents the jth possible valid answer for the ith question
@@ -72,16 +72,20 @@ def get_XY(data: Dict) -> Tuple[List[Sample], List[Label]]:
                     i += 1                
 
         # Create samples and labels for each turn in conversation
-        conv_history = []
+        # Every sample is a view of its first turns, instead of a copy
+        conversation_id, conv_history = conversations.new()
+        samples = []
+        labels = []
         for question, curr_qs_answers in zip(questions, all_answers):
-            conv_history.append({"role": "user", "content": question})
+            conv_history.append(Turn("user", question))
 
             samples.append(
-                Sample(
+                conversations.sample(
                     document_ids=[doc_id],
-                    conversation=conv_history.copy(),
+                    conversation_id=conversation_id,
+                    turn=len(conv_history),
                 )
-            )            
+            )
                 
             labels.append(
                 Label(
@@ -90,5 +94,4 @@ def get_XY(data: Dict) -> Tuple[List[Sample], List[Label]]:
                     answer=ANSWER_DELIM.join([curr_ans["text"] for curr_ans in curr_qs_answers]),
                 )
             )
-
-    return samples, labels
+        yield from zip(samples, labels)
@@ -1,22 +1,20 @@
 from tqdm import tqdm
-from typing import Dict, List, Any, Tuple
+from typing import Dict, Iterable, Iterator, List, Any, Optional, Tuple
 
 from ..structures import *
 
 
-def preprocess_labels(labels: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def preprocess_labels(labels: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
     for label in labels:
         turn_documents = label.get("knowledge", [])
         for document in turn_documents:
             for key, value in document.items():
                 if type(value) != str:
                     document[key] = str(value)
-    return labels
+        yield label
 
 
-def get_docs(knowledge: Dict[str, Dict[str, Dict[str, str]]]) -> Dict[str, str]:
-    docs = {}
-
+def get_docs(knowledge: Dict[str, Dict[str, Dict[str, str]]]) -> Iterator[Tuple[str, str]]:
     for domain in knowledge:
         for doc in knowledge[domain]:
             key = f"{domain}_{doc}"
@@ -24,41 +22,57 @@ def get_docs(knowledge: Dict[str, Dict[str, Dict[str, str]]]) -> Dict[str, str]:
             qa = []
             for qa_item in doc_data["docs"].values():
                 qa.append(f"Q: {qa_item['title']}\nA: {qa_item['body']}")
-            docs[key] = f"FAQ FOR {doc_data['name']}\n\n" + "\n\n".join(qa)
+            yield key, f"FAQ FOR {doc_data['name']}\n\n" + "\n\n".join(qa)
+
 
-    return docs
+def _dialogue_XY(
+    conversations: ConversationStore,
+    conversation_id: str,
+    dialogue: List[Turn],
+    documents: List[str],
+    labels: List[Label],
+) -> Iterator[Tuple[Sample, Label]]:
+    # The samples of a dialogue share the documents of all its turns, so they are only known at its end.
+    # Deduplicated in order, so the output does not depend on the hash seed of the process
+    documents = list(dict.fromkeys(documents))
+    X = [
+        conversations.sample(
+            document_ids=documents,
+            conversation_id=conversation_id,
+            turn=i,
+        )
+        for i in range(1, len(dialogue) + 1, 2)
+    ]
+    yield from zip(X, labels)
 
 
 def get_XY(
-    logs: List[List[Dict[str, str]]],
-    labels: List[Dict[str, Any]],
+    logs: Iterable[List[Dict[str, str]]],
+    labels: Iterable[Dict[str, Any]],
     knowledge: Dict[str, Dict[str, Dict[str, str]]],
-    docs: Dict[str, str],
-) -> Tuple[List[Sample], List[Label]]:
-    X = []
-    Y = []
+    conversations: Optional[ConversationStore] = None,
+) -> Iterator[Tuple[Sample, Label]]:
+    if conversations is None:
+        conversations = ConversationStore()
 
-    dialogue = []
+    # Every sample is a view of the dialogue up to one of its user turns, instead of a copy
+    conversation_id, dialogue = conversations.new()
     documents = []
+    Y = []
     for log, label in zip(logs, labels):
         # Check if is new conversation
         if len(log) == 1:
             # Update X
-            documents = list(set(documents))
-            for i in range(1, len(dialogue) + 1, 2):
-                X.append(
-                    Sample(
-                        document_ids=documents,
-                        conversation=dialogue[:i],
-                    )
-                )
+            yield from _dialogue_XY(conversations, conversation_id, dialogue, documents, Y)
             # Is new conversation
-            dialogue = []
+            if dialogue:
+                conversation_id, dialogue = conversations.new()
             documents = []
+            Y = []
         if len(log) > 1:
             assert log[-2]["speaker"] == "S"
-            dialogue.append({"role": "assistant", "content": log[-2]["text"]})
-        dialogue.append({"role": "user", "content": log[-1]["text"]})
+            dialogue.append(Turn("assistant", log[-2]["text"]))
+        dialogue.append(Turn("user", log[-1]["text"]))
 
         turn_documents = label.get("knowledge", [])
         documents.extend(
@@ -89,13 +103,4 @@ def get_XY(
         )
 
     # Update X
-    documents = list(set(documents))
-    for i in range(1, len(dialogue) + 1, 2):
-        X.append(
-            Sample(
-                document_ids=documents,
-                conversation=dialogue[:i],
-            )
-        )
-
-    return X, Y
+    yield from _dialogue_XY(conversations, conversation_id, dialogue, documents, Y)
@@ -0,0 +1,314 @@
+"""
+Preprocessing of the raw datasets into the files `Dataset` loads, redone only for what changed.
+
+Every split is built on its own from its raw files, into `<split>_X`, `<split>_Y`,
+`<split>_conversations` and `<split>_docs`, and the documents of the splits are then merged into
+`docs`. `manifest.json` records the sha256 of the raw files of every split and of the source of the
+loader that converted them, so a split is rebuilt when either changes, and only then. The size and
+mtime of every raw file are recorded too, and a file is only hashed again when they change, so checking
+an up to date dataset does not read its raw files.
+
+The raw items of a split (QuAC articles, CoQA stories, MultiWOZ dialogues) are independent of each
+other, so they are converted in chunks by a process pool while the files of the split are written in
+the original order. The splits of all the datasets being preprocessed share the pool.
+
+python -m utils.data.preprocess data/QuAC data/CoQA data/MultiWOZ --workers 8
+"""
+
+import argparse
+import functools
+import hashlib
+import inspect
+import json
+import os
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import islice
+from types import ModuleType
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from utils.data import coqa_utils, multiwoz_utils, quac_utils, records, stream
+from utils.structures import ConversationStore, DatasetName, Label, Sample
+
+MANIFEST_FILE = "manifest.json"
+# Bump when the layout of the preprocessed files changes, to rebuild every dataset
+FORMAT_VERSION = 2
+CHUNK_SIZE = 64  # Raw items converted per task
+
+Converted = Tuple[Iterable[Tuple[str, str]], Iterable[Tuple[Sample, Label]]]
+
+
+def _convert_quac(dataset_fp: str, articles: List[Dict], conversations: ConversationStore) -> Converted:
+    return quac_utils.get_docs(articles), quac_utils.get_XY(articles, conversations)
+
+
+def _convert_coqa(dataset_fp: str, stories: List[Dict], conversations: ConversationStore) -> Converted:
+    return coqa_utils.get_docs(stories), coqa_utils.get_XY(stories, conversations)
+
+
+@functools.lru_cache(maxsize=4)
+def _multiwoz_knowledge(dataset_fp: str) -> Dict:
+    # Loaded whole (once per process), since the labels look up their segments in it
+    with open(os.path.join(dataset_fp, "knowledge.json"), "r") as f:
+        return json.load(f)
+
+
+def _convert_multiwoz(
+    dataset_fp: str, dialogues: List[List[Tuple[List[Dict], Dict]]], conversations: ConversationStore
+) -> Converted:
+    logs = [log for dialogue in dialogues for log, _ in dialogue]
+    labels = [label for dialogue in dialogues for _, label in dialogue]
+    knowledge = _multiwoz_knowledge(dataset_fp)
+    return [], multiwoz_utils.get_XY(logs, labels, knowledge, conversations)
+
+
+def _data_items(dataset_fp: str, inputs: List[str]) -> Iterator[Dict]:
+    return stream.iter_json_array(os.path.join(dataset_fp, inputs[0]), key="data")
+
+
+def _multiwoz_dialogues(dataset_fp: str, inputs: List[str]) -> Iterator[List[Tuple[List[Dict], Dict]]]:
+    """The (log, label) pairs of the turns of each dialogue. A dialogue starts with a log of one message."""
+    logs = stream.iter_json_array(os.path.join(dataset_fp, inputs[0]))
+    labels = multiwoz_utils.preprocess_labels(stream.iter_json_array(os.path.join(dataset_fp, inputs[1])))
+    dialogue = []
+    for log, label in zip(logs, labels):
+        if len(log) == 1 and dialogue:
+            yield dialogue
+            dialogue = []
+        dialogue.append((log, label))
+    if dialogue:
+        yield dialogue
+
+
+def _multiwoz_docs(dataset_fp: str) -> Iterator[Tuple[str, str]]:
+    return multiwoz_utils.get_docs(_multiwoz_knowledge(dataset_fp))
+
+
+@dataclass(frozen=True)
+class SplitSource:
+    """How a split of a dataset is built from its raw files.
+
+    Args:
+        split: "train" or "test"
+        inputs: Raw files of the split, relative to the dataset folder
+        loader: Module converting the raw data (its source is part of the manifest)
+        items: Streams the independent raw items of the split, given the dataset folder and `inputs`
+        convert: Converts a chunk of items into documents and (Sample, Label) pairs, with the
+            conversations in the given store. Runs in the worker processes, so it must be a
+            module-level function
+        docs: Documents of the split that do not come from its items, if any
+    """
+
+    split: str
+    inputs: List[str]
+    loader: ModuleType
+    items: Callable[[str, List[str]], Iterator[Any]]
+    convert: Callable[[str, List[Any], ConversationStore], Converted]
+    docs: Optional[Callable[[str], Iterable[Tuple[str, str]]]] = None
+
+
+SOURCES: Dict[str, List[SplitSource]] = {
+    DatasetName.QUAC: [
+        SplitSource("train", ["train_v0.2.json"], quac_utils, _data_items, _convert_quac),
+        SplitSource("test", ["val_v0.2.json"], quac_utils, _data_items, _convert_quac),
+    ],
+    DatasetName.COQA: [
+        SplitSource("train", ["coqa-train-v1.0.json"], coqa_utils, _data_items, _convert_coqa),
+        SplitSource("test", ["coqa-dev-v1.0.json"], coqa_utils, _data_items, _convert_coqa),
+    ],
+    DatasetName.MULTIWOZ: [
+        SplitSource(
+            split,
+            [f"{folder}/logs.json", f"{folder}/labels.json", "knowledge.json"],
+            multiwoz_utils,
+            _multiwoz_dialogues,
+            _convert_multiwoz,
+            _multiwoz_docs,
+        )
+        for split, folder in [("train", "train"), ("test", "val")]
+    ],
+}
+
+
+def is_supported(dataset_fp: str) -> bool:
+    return os.path.basename(dataset_fp) in SOURCES
+
+
+def has_raw_files(dataset_fp: str) -> bool:
+    """Whether all the raw files of a (supported) dataset are present."""
+    return all(
+        os.path.exists(os.path.join(dataset_fp, fp))
+        for source in SOURCES[os.path.basename(dataset_fp)]
+        for fp in source.inputs
+    )
+
+
+def _file_hash(fp: str) -> str:
+    sha = hashlib.sha256()
+    with open(fp, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _input_entry(fp: str, previous: Any) -> Dict[str, Any]:
+    """Hash, size and mtime of a raw file. Only hashed again when its size or mtime changed since `previous`."""
+    stat = os.stat(fp)
+    if (
+        isinstance(previous, dict)
+        and previous.get("size") == stat.st_size
+        and previous.get("mtime_ns") == stat.st_mtime_ns
+    ):
+        return previous
+    return {"sha256": _file_hash(fp), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _manifest_entry(dataset_fp: str, source: SplitSource, previous: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    previous_inputs = (previous or {}).get("inputs", {})
+    return {
+        "inputs": {
+            fp: _input_entry(os.path.join(dataset_fp, fp), previous_inputs.get(fp)) for fp in source.inputs
+        },
+        "loader": hashlib.sha256(inspect.getsource(source.loader).encode("utf-8")).hexdigest(),
+    }
+
+
+def _fingerprint(entry: Optional[Dict[str, Any]]) -> Optional[Tuple]:
+    """What a split is built from: the hashes of its raw files and of its loader (older manifests store bare hashes)."""
+    if entry is None:
+        return None
+    inputs = {fp: value if isinstance(value, str) else value["sha256"] for fp, value in entry["inputs"].items()}
+    return tuple(sorted(inputs.items())), entry["loader"]
+
+
+def _read_manifest(dataset_fp: str) -> Dict[str, Any]:
+    fp = os.path.join(dataset_fp, MANIFEST_FILE)
+    if os.path.exists(fp):
+        with open(fp, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("format") == FORMAT_VERSION:
+            return manifest
+    return {"format": FORMAT_VERSION, "splits": {}}
+
+
+def _has_split_files(dataset_fp: str, split: str) -> bool:
+    paths = [f"{split}_{name}.{ext}" for name in ["X", "Y"] for ext in ["bin", "idx"]]
+    paths += [f"{split}_{records.CONVERSATIONS_FILE}.{ext}" for ext in ["bin", "idx", "keys.json"]]
+    paths += [f"{split}_docs.{ext}" for ext in ["bin", "idx", "keys.json"]]
+    return all(os.path.exists(os.path.join(dataset_fp, fp)) for fp in paths)
+
+
+def _chunks(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    items = iter(items)
+    while chunk := list(islice(items, size)):
+        yield chunk
+
+
+def _convert_chunk(
+    convert: Callable, split: str, dataset_fp: str, index: int, chunk: List[Any]
+) -> stream.EncodedChunk:
+    """Convert and encode the chunk `index` of a split with `convert` (in a worker process)."""
+    # Conversation ids only depend on the position of the chunk, so the output is the same whatever
+    # the number of workers
+    conversations = ConversationStore(prefix=f"{split}/{index}.")
+    docs, XY = convert(dataset_fp, chunk, conversations)
+    return stream.encode_chunk(docs, XY)
+
+
+def _ordered_map(pool: Optional[Executor], fn: Callable, args: Iterable[Tuple], window: int) -> Iterator[Any]:
+    """`fn(*a)` for every `a` of `args`, in order, with at most `window` calls in flight on the pool."""
+    if pool is None:
+        for a in args:
+            yield fn(*a)
+        return
+    pending = deque()
+    for a in args:
+        pending.append(pool.submit(fn, *a))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _build_split(pool: Optional[Executor], dataset_fp: str, source: SplitSource, window: int) -> None:
+    writer = stream.SplitWriter(dataset_fp, source.split)
+    if source.docs is not None:
+        for doc_id, text in source.docs(dataset_fp):
+            writer.add_doc(doc_id, text)
+    chunks = _chunks(source.items(dataset_fp, source.inputs), CHUNK_SIZE)
+    args = ((source.convert, source.split, dataset_fp, index, chunk) for index, chunk in enumerate(chunks))
+    for chunk in _ordered_map(pool, _convert_chunk, args, window):
+        writer.add_chunk(chunk)
+    writer.close()
+
+
+def preprocess(dataset_fps: List[str], workers: Optional[int] = None, force: bool = False) -> Dict[str, List[str]]:
+    """
+    Bring the preprocessed files of the datasets up to date with their raw files and loaders.
+
+    Args:
+        dataset_fps: Dataset folders (named after a DatasetName, with the raw files in them)
+        workers: Number of processes converting the raw items, default the number of CPUs (1 converts
+            them in this process)
+        force: Rebuild every split, even the ones that are up to date
+
+    Returns:
+        The splits rebuilt for each dataset
+    """
+    workers = workers or os.cpu_count() or 1
+    manifests, stale, restated = {}, [], set()
+    for dataset_fp in dataset_fps:
+        manifests[dataset_fp] = _read_manifest(dataset_fp)
+        for source in SOURCES[os.path.basename(dataset_fp)]:
+            previous = manifests[dataset_fp]["splits"].get(source.split)
+            entry = _manifest_entry(dataset_fp, source, previous)
+            if (
+                force
+                or _fingerprint(previous) != _fingerprint(entry)
+                or not _has_split_files(dataset_fp, source.split)
+            ):
+                stale.append((dataset_fp, source, entry))
+            elif entry != previous:
+                # Same contents with a new mtime (e.g. copied): record it so the files are not hashed again
+                manifests[dataset_fp]["splits"][source.split] = entry
+                restated.add(dataset_fp)
+
+    if stale:
+        pool = ProcessPoolExecutor(workers) if workers > 1 else None
+        try:
+            # One thread per split streams its raw files and writes its outputs, the pool does the conversion
+            with ThreadPoolExecutor(len(stale)) as threads:
+                futures = [
+                    threads.submit(_build_split, pool, dataset_fp, source, 2 * workers)
+                    for dataset_fp, source, _ in stale
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    rebuilt = {dataset_fp: [] for dataset_fp in dataset_fps}
+    for dataset_fp, source, entry in stale:
+        rebuilt[dataset_fp].append(source.split)
+        manifests[dataset_fp]["splits"][source.split] = entry
+    for dataset_fp in dataset_fps:
+        if rebuilt[dataset_fp] or not os.path.exists(os.path.join(dataset_fp, stream.DOCS_DONE_FILE)):
+            stream.merge_docs(dataset_fp, [source.split for source in SOURCES[os.path.basename(dataset_fp)]])
+        if rebuilt[dataset_fp] or dataset_fp in restated:
+            # Written last, so an interrupted build is redone
+            with open(os.path.join(dataset_fp, f"{MANIFEST_FILE}.tmp"), "w") as f:
+                json.dump(manifests[dataset_fp], f, indent=4)
+            os.replace(os.path.join(dataset_fp, f"{MANIFEST_FILE}.tmp"), os.path.join(dataset_fp, MANIFEST_FILE))
+    return rebuilt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocess the raw datasets.")
+    parser.add_argument("datasets", nargs="+", help="Dataset folders, e.g. data/QuAC data/CoQA data/MultiWOZ")
+    parser.add_argument("--workers", type=int, default=None, help="Processes converting the raw data (default: all CPUs)")
+    parser.add_argument("--force", action="store_true", help="Rebuild every split, even the up to date ones")
+    args = parser.parse_args()
+    for dataset_fp, splits in preprocess(args.datasets, args.workers, args.force).items():
+        print(f"{dataset_fp}: rebuilt {', '.join(splits) if splits else 'nothing'}")
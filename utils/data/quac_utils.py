@@ -1,6 +1,6 @@
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, Iterator, Optional, Tuple
 
-from utils.structures import Label, Sample
+from utils.structures import ConversationStore, Label, Sample, Turn
 from utils.constants import ANSWER_DELIM
 
 def create_unique_doc_id(title: str, context: str) -> str:
@@ -10,47 +10,52 @@ def create_unique_doc_id(title: str, context: str) -> str:
     return f"{title}_{context[:50].replace(' ', '_')}"
 
 
-def get_docs(data: Dict) -> Dict[str, str]:
+def get_docs(data: Iterable[Dict]) -> Iterator[Tuple[str, str]]:
     """Extract documents from QuAC data.
 
     Args:
-        data: Raw QuAC data
+        data: Articles of the raw QuAC data (the "data" list of the JSON), e.g. streamed with
+            `stream.iter_json_array(fp, key="data")`
 
-    Returns:
-        Dictionary mapping section IDs to their text content
+    Yields:
+        Tuple of the section ID and its text content, for every paragraph
     """
 
-    docs = {}
-    for article in data["data"]:
+    for article in data:
         title = article["title"]
         for paragraph in article["paragraphs"]:
             context = paragraph["context"]
             # Create unique doc ID using title and first few words of context
             doc_id = create_unique_doc_id(title, context)
-            docs[doc_id] = context
-    return docs
+            yield doc_id, context
 
 
-def get_XY(data: Dict) -> Tuple[List[Sample], List[Label]]:
+def get_XY(
+    data: Iterable[Dict], conversations: Optional[ConversationStore] = None
+) -> Iterator[Tuple[Sample, Label]]:
     """Convert QuAC data into X (samples) and Y (labels) pairs.
 
+    The samples of a paragraph are only yielded after its last question, when its conversation is complete.
+
     Args:
-        data: Raw QuAC data
+        data: Articles of the raw QuAC data (the "data" list of the JSON)
+        conversations: Store the conversations are added to (shared by the splits of a dataset)
 
-    Returns:
-        Tuple containing:
-        - List of Sample objects (X)
-        - List of Label objects (Y)
+    Yields:
+        Tuple of a Sample (X) and its Label (Y)
     """
-    x_samples = []
-    y_labels = []
+    if conversations is None:
+        conversations = ConversationStore()
 
-    for article in data["data"]:
+    for article in data:
         title = article["title"]
         for paragraph in article["paragraphs"]:
             context = paragraph["context"]
             doc_id = create_unique_doc_id(title, context)
-            conv_history = []
+            # Every sample is a view of its first turns, instead of a copy
+            conversation_id, conv_history = conversations.new()
+            x_samples = []
+            y_labels = []
 
             for qa in paragraph["qas"]:
                 question = qa["question"]
@@ -59,18 +64,14 @@ def get_XY(data: Dict) -> Tuple[List[Sample], List[Label]]:
                 answers = qa["answers"]
 
                 # add the current question to the conversation history
-                conv_history.append(
-                    {
-                        "role": "user",
-                        "content": question,
-                    }
-                )
+                conv_history.append(Turn("user", question))
 
                 x_samples.append(
-                    Sample(
+                    conversations.sample(
                         # For QuAC, there is only one relevant context/document, not multiple
                         document_ids=[doc_id],
-                        conversation=conv_history.copy()
+                        conversation_id=conversation_id,
+                        turn=len(conv_history),
                     )
                 )
 
@@ -87,5 +88,4 @@ def get_XY(data: Dict) -> Tuple[List[Sample], List[Label]]:
                         answer = ANSWER_DELIM.join([ans["text"] for ans in answers]),
                     )
                 )
-
-    return x_samples, y_labels
+            yield from zip(x_samples, y_labels)
@@ -0,0 +1,258 @@
+"""
+Compact binary layout of the preprocessed dataset files.
+
+Every `<name>.json` file becomes `<name>.bin`, the records back to back, and `<name>.idx`, a raw
+uint64 array of n + 1 byte offsets (record i is bin[idx[i]:idx[i + 1]]). Samples and labels are
+stored as compact JSON lines (so the split `.bin` files are also valid JSONL), documents as raw UTF-8
+text with their ids in `docs.keys.json`. The messages of each conversation are stored once, as a JSON
+line of `<split>_conversations.bin` (ids in `<split>_conversations.keys.json`), and samples only
+reference them.
+
+Both files are memory-mapped, so loading only maps them and a record is decoded when it is accessed.
+Reading records i..j only touches their bytes, so a run on a slice of a split never reads the rest.
+
+python -m utils.data.records data/QuAC  # one-shot conversion of the JSON files of a dataset
+"""
+
+import json
+import mmap
+import os
+import sys
+from collections.abc import Mapping, Sequence
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from utils.structures import DataClassEncoder, Label, Sample, Turn, to_turns
+
+
+SPLIT_FILES = ["train_X", "train_Y", "test_X", "test_Y"]
+SPLIT_TYPES = {"train_X": Sample, "train_Y": Label, "test_X": Sample, "test_Y": Label}
+CONVERSATIONS_FILE = "conversations"
+# Conversations of each split, and the single file of datasets preprocessed before the splits were built separately
+CONVERSATIONS_FILES = ["train_conversations", "test_conversations", CONVERSATIONS_FILE]
+
+
+class RecordWriter:
+    """Writes records one at a time to `<fp>.bin` and their offsets to `<fp>.idx`.
+
+    Both files are written under a `.tmp` name and only replace the previous files on `close`.
+    """
+
+    def __init__(self, fp: str) -> None:
+        self.fp = fp
+        self.count = 0
+        self._offset = 0
+        self._bin = open(f"{fp}.bin.tmp", "wb")
+        self._idx = open(f"{fp}.idx.tmp", "wb")
+        self._idx.write(np.uint64(0).tobytes())
+
+    def append(self, record: bytes) -> None:
+        self._bin.write(record)
+        self._offset += len(record)
+        self._idx.write(np.uint64(self._offset).tobytes())
+        self.count += 1
+
+    def close(self) -> None:
+        self._bin.close()
+        self._idx.close()
+        # Only replace the previous files once both are complete
+        os.replace(f"{self.fp}.bin.tmp", f"{self.fp}.bin")
+        os.replace(f"{self.fp}.idx.tmp", f"{self.fp}.idx")
+
+
+def write_records(fp: str, records: Iterable[bytes]) -> int:
+    """Write already encoded records to `<fp>.bin` and their offsets to `<fp>.idx`. Returns the count."""
+    writer = RecordWriter(fp)
+    for record in records:
+        writer.append(record)
+    writer.close()
+    return writer.count
+
+
+def encode_record(record: Any) -> bytes:
+    """One compact JSON line."""
+    line = json.dumps(record, cls=DataClassEncoder, separators=(",", ":"), ensure_ascii=False)
+    return f"{line}\n".encode("utf-8")
+
+
+class _RecordBlob:
+    """The memory-mapped `.bin` and `.idx` files of one record file."""
+
+    def __init__(self, fp: str) -> None:
+        self.offsets = np.memmap(f"{fp}.idx", dtype=np.uint64, mode="r")
+        self.blob = b""  # mmap cannot map empty files
+        if os.path.getsize(f"{fp}.bin"):
+            with open(f"{fp}.bin", "rb") as f:
+                self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.blob[int(self.offsets[i]) : int(self.offsets[i + 1])]
+
+
+class RecordList(Sequence):
+    """Read-only list of dataclass records (e.g. Samples) backed by a memory-mapped record file.
+
+    Every access decodes the record and builds a new object, so nothing but the offsets is held in
+    memory. Slices are views over the same files.
+
+    Args:
+        fp: Path of the record file without extension
+        factory: Builds a record from its decoded JSON (e.g. `lambda v: Sample(**v)`)
+    """
+
+    def __init__(
+        self, fp: str, factory: Callable[[Any], Any], _blob: Optional[_RecordBlob] = None, _range: Optional[range] = None
+    ) -> None:
+        self.fp = fp
+        self.factory = factory
+        self._blob = _blob if _blob is not None else _RecordBlob(fp)
+        self._range = _range if _range is not None else range(len(self._blob))
+
+    def __len__(self) -> int:
+        return len(self._range)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return RecordList(self.fp, self.factory, self._blob, self._range[i])
+        return self.factory(json.loads(self._blob[self._range[i]]))
+
+    def __iter__(self) -> Iterator[Any]:
+        for i in self._range:
+            yield self.factory(json.loads(self._blob[i]))
+
+    def __add__(self, other: Iterable[Any]) -> List[Any]:
+        return list(self) + list(other)
+
+    def __radd__(self, other: Iterable[Any]) -> List[Any]:
+        return list(other) + list(self)
+
+    def __repr__(self) -> str:
+        return f"<RecordList {self.fp} ({len(self)} records)>"
+
+
+class DocumentStore(Mapping):
+    """Read-only mapping from document id to text backed by a memory-mapped record file.
+
+    Args:
+        fp: Path of the record file without extension (the ids are in `<fp>.keys.json`)
+    """
+
+    def __init__(self, fp: str) -> None:
+        self.fp = fp
+        with open(f"{fp}.keys.json", "r") as f:
+            self._positions = {doc_id: i for i, doc_id in enumerate(json.load(f))}
+        self._blob = _RecordBlob(fp)
+
+    def __getitem__(self, doc_id: str) -> str:
+        return self._blob[self._positions[doc_id]].decode("utf-8")
+
+    def __contains__(self, doc_id: object) -> bool:
+        return doc_id in self._positions
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._positions)
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __repr__(self) -> str:
+        return f"<DocumentStore {self.fp} ({len(self)} documents)>"
+
+
+class ConversationRecords(DocumentStore):
+    """Read-only mapping from conversation id to its messages backed by a memory-mapped record file.
+
+    A conversation is decoded once, on first access, and kept so the samples of all its turns share it.
+    """
+
+    def __init__(self, fp: str) -> None:
+        super().__init__(fp)
+        self._decoded: Dict[str, List[Turn]] = {}
+
+    def __getitem__(self, conversation_id: str) -> List[Turn]:
+        if conversation_id not in self._decoded:
+            self._decoded[conversation_id] = to_turns(json.loads(self._blob[self._positions[conversation_id]]))
+        return self._decoded[conversation_id]
+
+    def __repr__(self) -> str:
+        return f"<ConversationRecords {self.fp} ({len(self)} conversations)>"
+
+
+def save_docs(fp: str, docs: Dict[str, str]) -> None:
+    write_records(fp, (text.encode("utf-8") for text in docs.values()))
+    with open(f"{fp}.keys.json", "w") as f:
+        json.dump(list(docs), f)
+
+
+def save_conversations(fp: str, conversations: Dict[str, List[Dict[str, str]]]) -> None:
+    write_records(fp, (encode_record(turns) for turns in conversations.values()))
+    with open(f"{fp}.keys.json", "w") as f:
+        json.dump(list(conversations), f)
+
+
+def has_conversations(dataset_fp: str, name: str = CONVERSATIONS_FILE) -> bool:
+    """Whether the binary files of a dataset store the conversations `name` separately (older files inline them)."""
+    fp = os.path.join(dataset_fp, name)
+    return all(os.path.exists(f"{fp}.{ext}") for ext in ["bin", "idx", "keys.json"])
+
+
+def has_binary_files(dataset_fp: str) -> bool:
+    names = ["docs"] + SPLIT_FILES
+    return os.path.exists(os.path.join(dataset_fp, "docs.keys.json")) and all(
+        os.path.exists(os.path.join(dataset_fp, f"{name}.{ext}")) for name in names for ext in ["bin", "idx"]
+    )
+
+
+def load_split(
+    dataset_fp: str, name: str, conversations: Optional[Mapping[str, List[Turn]]] = None
+) -> RecordList:
+    """Memory-mapped view of the split file `name` (one of SPLIT_FILES) of a dataset.
+
+    `conversations` resolves the conversation references of the samples (see ConversationStore).
+    """
+    if SPLIT_TYPES[name] is Sample:
+        return RecordList(os.path.join(dataset_fp, name), lambda v: Sample.from_dict(v, conversations))
+    cls = SPLIT_TYPES[name]
+    return RecordList(os.path.join(dataset_fp, name), lambda v: cls(**v))
+
+
+def save_dataset(
+    dataset_fp: str,
+    docs: Dict[str, str],
+    splits: Dict[str, Iterable[Any]],
+    conversations: Optional[Dict[str, Dict[str, List[Dict[str, str]]]]] = None,
+) -> None:
+    """Write the documents, the splits (keyed by SPLIT_FILES names) and the conversations (keyed by
+    CONVERSATIONS_FILES names) of a dataset in the binary layout."""
+    save_docs(os.path.join(dataset_fp, "docs"), docs)
+    for name, values in (conversations or {}).items():
+        save_conversations(os.path.join(dataset_fp, name), values)
+    for name, split in splits.items():
+        write_records(os.path.join(dataset_fp, name), (encode_record(record) for record in split))
+
+
+def convert_dataset(dataset_fp: str) -> None:
+    """Convert the preprocessed JSON files of a dataset folder to the binary layout, next to them."""
+    with open(os.path.join(dataset_fp, "docs.json"), "r") as f:
+        docs = json.load(f)
+    conversations = {}
+    for name in CONVERSATIONS_FILES:
+        if os.path.exists(os.path.join(dataset_fp, f"{name}.json")):
+            with open(os.path.join(dataset_fp, f"{name}.json"), "r") as f:
+                conversations[name] = json.load(f)
+    splits = {}
+    for name in SPLIT_FILES:
+        with open(os.path.join(dataset_fp, f"{name}.json"), "r") as f:
+            splits[name] = json.load(f)
+    save_dataset(dataset_fp, docs, splits, conversations)
+    for name in SPLIT_FILES:
+        print(f"{name}: {len(splits[name])} records")
+
+
+if __name__ == "__main__":
+    for dataset_fp in sys.argv[1:]:
+        convert_dataset(dataset_fp)
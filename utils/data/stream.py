@@ -0,0 +1,260 @@
+"""
+Streaming reading and writing of the dataset files, so preprocessing runs in bounded memory.
+
+`iter_json_array` parses the elements of a JSON array (e.g. the "data" list of the raw QuAC and CoQA
+files, or the MultiWOZ logs) one at a time from a file, and `SplitWriter` writes the preprocessed
+binary files (see records.py) of a split record by record as they are produced.
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, TextIO, Tuple
+
+from utils.data import records
+from utils.structures import DataClassEncoder, Label, Sample, Turn
+
+_WHITESPACE = " \t\n\r"
+# Written by `merge_docs` once the documents of every split are merged, so the dataset is preprocessed
+DOCS_DONE_FILE = "docs.done"
+
+
+class _JsonStream:
+    """Text of a JSON file read in chunks, with a cursor that never needs more than one value buffered."""
+
+    def __init__(self, f: TextIO, chunk_size: int) -> None:
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read(self, size: int) -> None:
+        # Drop what was already consumed, so the buffer only holds the current value
+        self.buffer = self.buffer[self.pos :]
+        self.pos = 0
+        chunk = self.f.read(size)
+        self.eof = not chunk
+        self.buffer += chunk
+
+    def peek(self) -> str:
+        """Next non-whitespace character, without consuming it ("" at the end of the file)."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos : self.pos + 1]
+            self._read(self.chunk_size)
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Expected one of {chars!r} at offset {self.pos} of {self.f.name}, got {char!r}.")
+        self.pos += 1
+        return char
+
+    def value(self) -> Any:
+        """Decode the next value, reading more of the file until it is complete."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number (or anything) ending exactly at the end of the buffer may continue in the file
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Read at least as much again as is buffered, so long values are decoded in linear time
+            self._read(max(self.chunk_size, len(self.buffer) - self.pos))
+
+
+def iter_json_array(fp: str, key: Optional[str] = None, chunk_size: int = 1 << 20) -> Iterator[Any]:
+    """
+    Iterate over the elements of a JSON array in a file without loading the whole file.
+
+    Args:
+        fp: Path of the JSON file
+        key: Key of the array in the top-level object (e.g. "data"), or None if the file is the array
+        chunk_size: Number of characters read at a time
+
+    Yields:
+        The decoded elements, in order. Only the current element (and, with `key`, the value of one
+        other top-level key at a time while looking for it) is held in memory.
+    """
+    with open(fp, "r", encoding="utf-8") as f:
+        stream = _JsonStream(f, chunk_size)
+        if key is not None:
+            stream.expect("{")
+            while True:
+                if stream.peek() == "}":
+                    raise KeyError(f"{key} not found in {fp}.")
+                name = stream.value()
+                stream.expect(":")
+                if name == key:
+                    break
+                stream.value()  # Skip the other top-level values
+                if stream.expect(",}") == "}":
+                    raise KeyError(f"{key} not found in {fp}.")
+
+        stream.expect("[")
+        if stream.peek() == "]":
+            return
+        while True:
+            yield stream.value()
+            if stream.expect(",]") == "]":
+                return
+
+
+def encode_pretty(value: Any) -> str:
+    """`value` as formatted in the preprocessed JSON files."""
+    return json.dumps(value, cls=DataClassEncoder, indent=4)
+
+
+class JsonWriter:
+    """Writes a JSON array one element at a time, formatted like `json.dump(..., indent=4)`."""
+
+    def __init__(self, fp: str) -> None:
+        self.fp = fp
+        self.count = 0
+        self.f = open(f"{fp}.tmp", "w")
+        self.f.write("[")
+
+    def append(self, value: Any, encoded: Optional[str] = None) -> None:
+        """Append a value to the array (`encoded` is its `encode_pretty`, if already computed)."""
+        text = encoded if encoded is not None else encode_pretty(value)
+        self.f.write(",\n    " if self.count else "\n    ")
+        self.f.write(text.replace("\n", "\n    "))
+        self.count += 1
+
+    def close(self) -> None:
+        self.f.write(("\n" if self.count else "") + "]")
+        self.f.close()
+        os.replace(f"{self.fp}.tmp", self.fp)
+
+
+class EncodedChunk(NamedTuple):
+    """Records converted from some raw items, already encoded for the binary files."""
+
+    docs: List[Tuple[str, str]]
+    conversations: List[Tuple[str, bytes]]  # (id, record)
+    records: List[Tuple[bytes, bytes]]  # (sample record, label record)
+
+
+def encode_chunk(docs: Iterable[Tuple[str, str]], XY: Iterable[Tuple[Sample, Label]]) -> EncodedChunk:
+    """
+    Encode converted documents and samples for `SplitWriter.add_chunk`. Encoding is most of the cost
+    of writing, so this runs in the processes converting the raw items.
+
+    The conversations the samples reference (through ConversationViews) are encoded once each, in the
+    order they are first referenced.
+    """
+    conversations: Dict[str, List[Turn]] = {}
+    encoded_records = []
+    for sample, label in XY:
+        if sample.conversation_id is not None:
+            conversations.setdefault(sample.conversation_id, sample.conversation.turns)
+        encoded_records.append((records.encode_record(sample), records.encode_record(label)))
+    return EncodedChunk(
+        list(docs),
+        [
+            (cid, records.encode_record([turn.as_message() for turn in turns]))
+            for cid, turns in conversations.items()
+        ],
+        encoded_records,
+    )
+
+
+def _remove_json(dataset_fp: str, name: str) -> None:
+    # Left by versions that also wrote the preprocessed files as JSON, and stale once they are rebuilt
+    fp = os.path.join(dataset_fp, f"{name}.json")
+    if os.path.exists(fp):
+        os.remove(fp)
+
+
+class SplitWriter:
+    """Writes the preprocessed binary files of one split as records come in.
+
+    Besides `<split>_X` and `<split>_Y`, it writes the conversations of the split to
+    `<split>_conversations` and the documents its samples use to `<split>_docs` (see `merge_docs`).
+    When a document id comes again, the last text is kept like in a dict: an identical text is
+    skipped, and a different one is appended, which `DocumentStore` resolves to the last one. Nothing
+    accumulates in memory but the document ids and a digest of their text.
+
+    Args:
+        dataset_fp: Dataset folder the files are written to
+        split: "train" or "test"
+    """
+
+    def __init__(self, dataset_fp: str, split: str) -> None:
+        self.dataset_fp = dataset_fp
+        self.split = split
+        self._doc_digests: Dict[str, bytes] = {}
+        self._x, self._y = f"{split}_X", f"{split}_Y"
+        self._conversations = f"{split}_{records.CONVERSATIONS_FILE}"
+        self._docs = f"{split}_docs"
+        self._records = {
+            name: records.RecordWriter(os.path.join(dataset_fp, name))
+            for name in [self._x, self._y, self._conversations, self._docs]
+        }
+        self._keys = {
+            name: JsonWriter(os.path.join(dataset_fp, f"{name}.keys.json"))
+            for name in [self._conversations, self._docs]
+        }
+
+    def add_doc(self, doc_id: str, text: str) -> None:
+        data = text.encode("utf-8")
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        if self._doc_digests.get(doc_id) == digest:
+            return
+        self._doc_digests[doc_id] = digest
+        self._records[self._docs].append(data)
+        self._keys[self._docs].append(doc_id)
+
+    def add_chunk(self, chunk: EncodedChunk) -> None:
+        """Append the documents, conversations and samples (with their labels) of a chunk (see `encode_chunk`)."""
+        for doc_id, text in chunk.docs:
+            self.add_doc(doc_id, text)
+        for conversation_id, record in chunk.conversations:
+            self._records[self._conversations].append(record)
+            self._keys[self._conversations].append(conversation_id)
+        for x_record, y_record in chunk.records:
+            self._records[self._x].append(x_record)
+            self._records[self._y].append(y_record)
+
+    def close(self) -> None:
+        for writer in list(self._records.values()) + list(self._keys.values()):
+            writer.close()
+        for name in [self._x, self._y, self._conversations]:
+            _remove_json(self.dataset_fp, name)
+
+
+def merge_docs(dataset_fp: str, splits: List[str]) -> None:
+    """
+    Write `docs` from the `<split>_docs` files of the splits. Like updating a dict with the documents
+    of every split in turn, an id keeps the position of its first occurrence and the text of its last.
+    """
+    done_fp = os.path.join(dataset_fp, DOCS_DONE_FILE)
+    if os.path.exists(done_fp):
+        os.remove(done_fp)
+
+    split_docs = [records.DocumentStore(os.path.join(dataset_fp, f"{split}_docs")) for split in splits]
+    latest: Dict[str, records.DocumentStore] = {}
+    for store in split_docs:
+        for doc_id in store:
+            latest[doc_id] = store
+
+    record_writer = records.RecordWriter(os.path.join(dataset_fp, "docs"))
+    keys_writer = JsonWriter(os.path.join(dataset_fp, "docs.keys.json"))
+    for doc_id, store in latest.items():
+        record_writer.append(store[doc_id].encode("utf-8"))
+        keys_writer.append(doc_id)
+    record_writer.close()
+    keys_writer.close()
+    _remove_json(dataset_fp, "docs")
+
+    # Written last: the dataset only counts as preprocessed once it exists
+    with open(done_fp, "w") as f:
+        json.dump({"documents": len(latest)}, f)
@@ -1,10 +1,11 @@
 import json
 import os
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
 
-from utils.data import coqa_utils, multiwoz_utils, quac_utils
+from utils.data import preprocess, records
+from utils.retrieval.sentence_index import SentenceIndex
 from utils.scorer import Scorer
-from utils.structures import DataClassEncoder, DatasetName, Label, Sample
+from utils.structures import Label, Sample, Turn, to_turns
 
 
 # TODO: put all the filenames in a config file instead of it being literal strings here
@@ -19,141 +20,123 @@ class Dataset:
             NotImplementedError: raises NotImplementedError if the dataset is not supported
         """
 
-        # Check if the preprocessed files exist. if so, no need to preprocess
-        should_preprocess = not (
-            os.path.exists(os.path.join(fp, "docs.json"))
-            and os.path.exists(os.path.join(fp, "train_X.json"))
-            and os.path.exists(os.path.join(fp, "train_Y.json"))
-            and os.path.exists(os.path.join(fp, "test_X.json"))
-            and os.path.exists(os.path.join(fp, "test_Y.json"))
+        self._fp = fp
+        self._sentence_index = None
+        self._bm25_index = None
+        # Preprocessed files loaded so far ("docs", conversations and records.SPLIT_FILES). Each is loaded on first use,
+        # so e.g. evaluating on the test split never reads the train split.
+        self._data: Dict[str, Any] = {}
+
+        # Check if the preprocessed files exist
+        has_preprocessed_files = records.has_binary_files(fp) or all(
+            os.path.exists(os.path.join(fp, f"{name}.json")) for name in ["docs"] + records.SPLIT_FILES
         )
-        if should_preprocess:
-            if os.path.basename(fp) == DatasetName.MULTIWOZ:
-                self._setup_multiwoz(fp)
-            elif os.path.basename(fp) == DatasetName.QUAC:
-                self._setup_quac(fp)
-            elif os.path.basename(fp) == DatasetName.COQA:
-                self._setup_coqa(fp)
-            else:
-                raise NotImplementedError("Dataset not supported.")
-        else:
-            self._load_preprocessed_data(fp)
+        if preprocess.is_supported(fp) and (preprocess.has_raw_files(fp) or not has_preprocessed_files):
+            # Rebuilds the splits whose raw files or loader changed since they were preprocessed (see manifest.json)
+            preprocess.preprocess([fp])
+        elif not has_preprocessed_files:
+            raise NotImplementedError("Dataset not supported.")
 
-    @property
-    def docs(self) -> Dict[str, str]:
-        return self._docs
+        # The binary files (see utils/data/records.py) are memory-mapped and decoded per record, so prefer them
+        self._binary = records.has_binary_files(fp)
 
     @property
-    def train_X(self) -> List[Sample]:
-        return self._train_X
+    def docs(self) -> Mapping[str, str]:
+        return self._load("docs")
 
     @property
-    def train_Y(self) -> List[Label]:
-        return self._train_Y
+    def sentence_index(self) -> SentenceIndex:
+        """Sentence index over `docs`, shared by every sample of the dataset."""
+        if self._sentence_index is None:
+            self._sentence_index = SentenceIndex(self.docs)
+        return self._sentence_index
 
     @property
-    def test_X(self) -> List[Sample]:
-        return self._test_X
+    def bm25_index(self) -> "BM25Index":
+        """BM25 index over the sentence windows of `docs`, built on first use."""
+        if self._bm25_index is None:
+            # Imported here so loading a dataset does not import scipy
+            from utils.retrieval.bm25 import BM25Index
 
-    @property
-    def test_Y(self) -> List[Label]:
-        return self._test_Y
-
-    def _load_preprocessed_data(self, fp: str) -> None:
-        """Helper function to load the preprocessed data files."""
-        with open(os.path.join(fp, "docs.json"), "r") as f:
-            self._docs = json.load(f)
-        with open(os.path.join(fp, "train_X.json"), "r") as f:
-            self._train_X = [Sample(**v) for v in json.load(f)]
-        with open(os.path.join(fp, "train_Y.json"), "r") as f:
-            self._train_Y = [Label(**v) for v in json.load(f)]
-        with open(os.path.join(fp, "test_X.json"), "r") as f:
-            self._test_X = [Sample(**v) for v in json.load(f)]
-        with open(os.path.join(fp, "test_Y.json"), "r") as f:
-            self._test_Y = [Label(**v) for v in json.load(f)]
-
-    def _setup_multiwoz(self, fp: str) -> None:
-        """Helper function to load the original MultiWOZ dataset, preprocess it and save the preprocessed files."""
-        # Load original data
-        with open(os.path.join(fp, "train", "logs.json"), "r") as f:
-            train_logs = json.load(f)
-        with open(os.path.join(fp, "train", "labels.json"), "r") as f:
-            train_labels = multiwoz_utils.preprocess_labels(json.load(f))
-        with open(os.path.join(fp, "val", "logs.json"), "r") as f:
-            val_logs = json.load(f)
-        with open(os.path.join(fp, "val", "labels.json"), "r") as f:
-            val_labels = multiwoz_utils.preprocess_labels(json.load(f))
-        with open(os.path.join(fp, "knowledge.json"), "r") as f:
-            knowledge = json.load(f)
-
-        self._docs = multiwoz_utils.get_docs(knowledge)
-
-        self._train_X, self._train_Y = multiwoz_utils.get_XY(
-            train_logs, train_labels, knowledge, self._docs
-        )
-        self._test_X, self._test_Y = multiwoz_utils.get_XY(
-            val_logs, val_labels, knowledge, self._docs
-        )
+            self._bm25_index = BM25Index(self.sentence_index)
+        return self._bm25_index
 
-        # Save preprocessed files
-        self._save_preprocessed_files(
-            fp, self._docs, self._train_X, self._train_Y, self._test_X, self._test_Y
-        )
+    @property
+    def train_X(self) -> Sequence[Sample]:
+        return self._load("train_X")
 
-    def _setup_quac(self, fp: str) -> None:
-        """Helper function to load the original QuAC dataset, preprocess it and save the preprocessed files."""
-        # Load original data
-        with open(os.path.join(fp, "train_v0.2.json"), "r") as f:
-            train_data = json.load(f)
-        with open(os.path.join(fp, "val_v0.2.json"), "r") as f:
-            val_data = json.load(f)
+    @property
+    def train_Y(self) -> Sequence[Label]:
+        return self._load("train_Y")
 
-        self._docs = quac_utils.get_docs(train_data)
-        self._docs.update(quac_utils.get_docs(val_data))
+    @property
+    def test_X(self) -> Sequence[Sample]:
+        return self._load("test_X")
 
-        self._train_X, self._train_Y = quac_utils.get_XY(train_data)
-        self._test_X, self._test_Y = quac_utils.get_XY(val_data)
+    @property
+    def test_Y(self) -> Sequence[Label]:
+        return self._load("test_Y")
 
-        self._save_preprocessed_files(
-            fp, self._docs, self._train_X, self._train_Y, self._test_X, self._test_Y
-        )
+    def split(
+        self, name: str, start: int = 0, stop: Optional[int] = None
+    ) -> Tuple[List[Sample], List[Label]]:
+        """Get the samples and labels start..stop of a split.
 
-    def _setup_coqa(self, fp: str) -> None:
-        """Helper function to load the original CoQA dataset, preprocess it and save the preprocessed files."""
-        # Load original data
-        with open(os.path.join(fp, "coqa-train-v1.0.json"), "r") as f:
-            train_data = json.load(f)
-        with open(os.path.join(fp, "coqa-dev-v1.0.json"), "r") as f:
-            val_data = json.load(f)
+        With the binary files only those records are read and decoded, and the other split is never opened.
 
-        self._docs = coqa_utils.get_docs(train_data)
-        self._docs.update(coqa_utils.get_docs(val_data))
+        Args:
+            name (str): "train" or "test"
+            start (int): index of the first sample
+            stop (Optional[int]): index after the last sample, None for the end of the split
 
-        self._train_X, self._train_Y = coqa_utils.get_XY(train_data)
-        self._test_X, self._test_Y = coqa_utils.get_XY(val_data)
+        Returns:
+            Tuple[List[Sample], List[Label]]: the samples and their labels
+        """
+        if name not in ("train", "test"):
+            raise ValueError(f"Unknown split {name}, expected train or test.")
+        X = self._load(f"{name}_X")[start:stop]
+        Y = self._load(f"{name}_Y")[start:stop]
+        return list(X), list(Y)
+
+    def _load(self, name: str) -> Any:
+        """Helper function to load the preprocessed file `name` ("docs", a conversations file or one of
+        records.SPLIT_FILES) on first use."""
+        if name not in self._data:
+            if name == "docs":
+                if self._binary:
+                    self._data[name] = records.DocumentStore(os.path.join(self._fp, "docs"))
+                else:
+                    with open(os.path.join(self._fp, "docs.json"), "r") as f:
+                        self._data[name] = json.load(f)
+            elif name.endswith(records.CONVERSATIONS_FILE):
+                if self._binary:
+                    self._data[name] = records.ConversationRecords(os.path.join(self._fp, name))
+                else:
+                    with open(os.path.join(self._fp, f"{name}.json"), "r") as f:
+                        self._data[name] = {cid: to_turns(messages) for cid, messages in json.load(f).items()}
+            elif records.SPLIT_TYPES[name] is Sample:
+                conversations = self._conversations(name.split("_")[0])
+                if self._binary:
+                    self._data[name] = records.load_split(self._fp, name, conversations)
+                else:
+                    with open(os.path.join(self._fp, f"{name}.json"), "r") as f:
+                        self._data[name] = [Sample.from_dict(v, conversations) for v in json.load(f)]
+            elif self._binary:
+                self._data[name] = records.load_split(self._fp, name)
+            else:
+                with open(os.path.join(self._fp, f"{name}.json"), "r") as f:
+                    self._data[name] = [records.SPLIT_TYPES[name](**v) for v in json.load(f)]
+        return self._data[name]
 
-        # Save preprocessed files
-        self._save_preprocessed_files(
-            fp, self._docs, self._train_X, self._train_Y, self._test_X, self._test_Y
-        )
+    def _conversations(self, split: str) -> Mapping[str, List[Turn]]:
+        """Helper function to load the conversations the samples of a split reference.
 
-    def _save_preprocessed_files(
-        self,
-        fp: str,
-        docs: Dict[str, str],
-        train_X: List[Sample],
-        train_Y: List[Label],
-        test_X: List[Sample],
-        test_Y: List[Label],
-    ) -> None:
-        """Helper function to save the preprocessed files."""
-        with open(os.path.join(fp, "docs.json"), "w") as f:
-            json.dump(docs, f, cls=DataClassEncoder, indent=4)
-        with open(os.path.join(fp, "train_X.json"), "w") as f:
-            json.dump(train_X, f, cls=DataClassEncoder, indent=4)
-        with open(os.path.join(fp, "train_Y.json"), "w") as f:
-            json.dump(train_Y, f, cls=DataClassEncoder, indent=4)
-        with open(os.path.join(fp, "test_X.json"), "w") as f:
-            json.dump(test_X, f, cls=DataClassEncoder, indent=4)
-        with open(os.path.join(fp, "test_Y.json"), "w") as f:
-            json.dump(test_Y, f, cls=DataClassEncoder, indent=4)
+        They are in `<split>_conversations`, or in `conversations` for files preprocessed before the
+        splits were built separately. Older files store the conversation inside the samples.
+        """
+        for name in [f"{split}_{records.CONVERSATIONS_FILE}", records.CONVERSATIONS_FILE]:
+            if self._binary and records.has_conversations(self._fp, name):
+                return self._load(name)
+            if not self._binary and os.path.exists(os.path.join(self._fp, f"{name}.json")):
+                return self._load(name)
+        return {}
@@ -1,11 +1,90 @@
 import os
-import json
-from typing import List, Dict
+import time
+from typing import List, Dict, Optional
 from tqdm import tqdm
 
-from .structures import Sample, Label, DataClassEncoder
+from . import sharding
+from .journal import PredictionJournal, write_predictions
+from .structures import Sample, Label
 from .method import ConvRef
 from .scorer import Scorer
+from .work_queue import QueueResults, WorkQueue
+
+def run_inference(
+    X: List[Sample],
+    Y: List[Label],
+    docs: Dict[str, str],
+    method: ConvRef,
+    journal: PredictionJournal,
+    indices: Optional[List[int]] = None,
+    batch_size: int = 1,
+    pipeline_depth: int = 0,
+    cpu_workers: int = 2,
+    ner_processes: int = 1,
+) -> None:
+    """
+    Predict the labels of the samples `indices` (default all of them) that are not in the journal yet,
+    appending each to the journal as soon as it is made.
+
+    Args:
+        X: List of input samples
+        Y: List of ground truth labels
+        docs: Dictionary of documents
+        method: Model/method to generate predictions
+        journal: Journal of the predictions made so far, keyed by index in X
+        indices: Indices of the samples to predict, e.g. those of a shard
+        batch_size: Number of samples passed to `method.batch_call` at once (1 runs one sample at a time)
+        pipeline_depth: If > 0, run the samples with `method.pipelined_call`, letting the CPU stages run
+            up to this many samples ahead of the model
+        cpu_workers: Number of threads of each CPU stage of `method.pipelined_call`
+        ner_processes: Number of processes computing the entities of the final queries with spaCy
+    """
+    if journal.dropped_bytes:
+        print(f"Dropped a truncated prediction ({journal.dropped_bytes} bytes) from {journal.fp}")
+    todo = [i for i in (indices if indices is not None else range(len(X))) if i not in journal]
+
+    # The entities of the final queries are computed in batches, one chunk of the samples at a time so
+    # they are still in the bounded cache of the NER model when the samples of the chunk are run
+    chunk_size = max(method.ner.max_cached, batch_size)
+    for start in range(0, len(todo), chunk_size):
+        chunk = todo[start:start + chunk_size]
+        method.prefetch_entities([X[i] for i in chunk], n_process=ner_processes)
+        _predict(X, Y, docs, method, journal, chunk, batch_size, pipeline_depth, cpu_workers)
+
+
+def _predict(
+    X: List[Sample],
+    Y: List[Label],
+    docs: Dict[str, str],
+    method: ConvRef,
+    journal: PredictionJournal,
+    todo: List[int],
+    batch_size: int,
+    pipeline_depth: int,
+    cpu_workers: int,
+) -> None:
+    """Predict the labels of the samples `todo` into the journal, see `run_inference`."""
+    if batch_size > 1:
+        for start in tqdm(range(0, len(todo), batch_size)):
+            batch = todo[start:start + batch_size]
+            labels = method.batch_call([X[i] for i in batch], docs, [Y[i] for i in batch])
+            for i, y_hat in zip(batch, labels):
+                journal.append(i, y_hat)
+            print(len(journal), len(X), labels[-1])
+    elif pipeline_depth > 0:
+        labels = method.pipelined_call(
+            [X[i] for i in todo], docs, [Y[i] for i in todo], max_queue_size=pipeline_depth, cpu_workers=cpu_workers
+        )
+        for i, y_hat in tqdm(zip(todo, labels), total=len(todo)):
+            journal.append(i, y_hat)
+            print(i, len(X), y_hat)
+        print("Pipeline stages", {k: v.to_dict() for k, v in method.pipeline_metrics.items()})
+    else:
+        for i in tqdm(todo):
+            y_hat = method(X[i], docs, Y[i])
+            journal.append(i, y_hat)
+            print(i, len(X), y_hat)
+
 
 def run_inference_and_evaluate(
     prefix: str, 
@@ -13,8 +92,14 @@ def run_inference_and_evaluate(
     Y: List[Label], 
     docs: Dict[str, str], 
     method: ConvRef, 
-    scorer: Scorer, 
-    fp: str
+    scorer: Optional[Scorer], 
+    fp: str,
+    batch_size: int = 1,
+    pipeline_depth: int = 0,
+    cpu_workers: int = 2,
+    ner_processes: int = 1,
+    num_shards: int = 1,
+    shard_id: Optional[int] = None,
 ) -> None:
     """
     Evaluate model predictions and save results
@@ -25,24 +110,85 @@ def run_inference_and_evaluate(
         Y: List of ground truth labels  
         docs: Dictionary of documents
         method: Model/method to generate predictions
-        scorer: Scorer object for evaluation
+        scorer: Scorer object for evaluation (unused by a shard)
         fp: Output file path
+        batch_size: Number of samples passed to `method.batch_call` at once (1 runs one sample at a time)
+        pipeline_depth: If > 0, run the samples with `method.pipelined_call`, letting the CPU stages run
+            up to this many samples ahead of the model
+        cpu_workers: Number of threads of each CPU stage of `method.pipelined_call`
+        ner_processes: Number of processes computing the entities of the final queries with spaCy
+        num_shards: Number of shards the samples are split into (see sharding.py)
+        shard_id: If set, only predict the samples of this shard, into its own journal, without scoring.
+            `evaluate_shards` merges and scores the shards once they are all done
     """
-    Y_hat = []
+    os.makedirs(fp, exist_ok=True)
+    kwargs = {
+        "batch_size": batch_size,
+        "pipeline_depth": pipeline_depth,
+        "cpu_workers": cpu_workers,
+        "ner_processes": ner_processes,
+    }
+    if shard_id is not None:
+        indices = sharding.shard_indices(X, num_shards, shard_id)
+        print(f"Shard {shard_id}/{num_shards}: {len(indices)} samples")
+        with PredictionJournal(sharding.shard_journal_fp(fp, prefix, num_shards, shard_id)) as journal:
+            run_inference(X, Y, docs, method, journal, indices, **kwargs)
+        return
+
     yhat_fp = os.path.join(fp, f"{prefix}Y_hat.json")
-    if os.path.exists(yhat_fp):
-        json_out = json.load(open(yhat_fp, "r"))
-        if json_out:
-            Y_hat = [Label(**val) for val in json_out]
-    
-    for i, x in tqdm(enumerate(X)):
-        if i < len(Y_hat):
-            continue
-        Y_hat.append(method(x, docs, Y[i]))
-        print(i, len(X), Y_hat[-1])
+    # Predictions are appended to the journal as they are made, and only compacted into Y_hat.json at the end
+    with PredictionJournal.from_json(os.path.join(fp, f"{prefix}Y_hat.jsonl"), yhat_fp) as journal:
+        run_inference(X, Y, docs, method, journal, **kwargs)
+        Y_hat = journal.compact(yhat_fp, len(X))
+
+    scorer(X, Y_hat, Y, save=os.path.join(fp, f"{prefix}eval.json"))
+
+
+def run_queue_worker(
+    X: List[Sample],
+    Y: List[Label],
+    docs: Dict[str, str],
+    method: ConvRef,
+    queue: WorkQueue,
+    poll_interval: float = 5.0,
+    **kwargs,
+) -> None:
+    """
+    Run the samples leased from a work queue until every sample of the queue has a label.
+
+    When no task is left to lease but other workers still hold some, wait for them to finish or for
+    their leases to expire (e.g. if they died) and take over. `kwargs` are passed to `run_inference`.
+    """
+    queue.add(X)
+    batch_size = kwargs.get("batch_size", 1)
+    with queue.heartbeats():
+        while True:
+            tasks = queue.lease(max(batch_size, 1))
+            if not tasks:
+                if queue.is_finished():
+                    break
+                time.sleep(poll_interval)
+                continue
+            indices = [i for task in tasks for i in task.indices]
+            try:
+                run_inference(X, Y, docs, method, QueueResults(queue, indices), indices, **kwargs)
+            except BaseException:
+                queue.release(tasks)
+                raise
+            queue.done(tasks)
+            progress = queue.progress()
+            print(f"Work queue: {progress['labeled']}/{progress['samples']} samples, tasks {progress['tasks']}")
+
+
+def evaluate_queue(prefix: str, X: List[Sample], Y: List[Label], scorer: Scorer, fp: str, queue: WorkQueue) -> None:
+    """Write the labels of a finished work queue to Y_hat.json, in the order of X, and score them."""
+    Y_hat = queue.labels(len(X))
+    write_predictions(os.path.join(fp, f"{prefix}Y_hat.json"), Y_hat)
+    scorer(X, Y_hat, Y, save=os.path.join(fp, f"{prefix}eval.json"))
+    queue.mark_scored()
 
-        # Save generated output
-        with open(yhat_fp, "w") as f:
-            json.dump(Y_hat, f, cls=DataClassEncoder, indent=4)
 
-    scorer(X, Y_hat, Y, save=os.path.join(fp, f"{prefix}eval.json"))
\ No newline at end of file
+def evaluate_shards(prefix: str, X: List[Sample], Y: List[Label], scorer: Scorer, fp: str, num_shards: int) -> None:
+    """Merge the journals of the `num_shards` shards of a run into Y_hat.json, in the order of X, and score it."""
+    Y_hat = sharding.merge_shards(fp, prefix, len(X), num_shards)
+    scorer(X, Y_hat, Y, save=os.path.join(fp, f"{prefix}eval.json"))
@@ -30,8 +30,7 @@ class TreeNode:
                 "role": "user",
                 "content": f"Summarize the topic coverage/given keywords of the following documents in under 25 keywords. Do not say anything else:\n{docs}",
             }]
-            outputs = model(prompt, max_new_tokens=256)
-            self.data = outputs[0]["generated_text"][-1]["content"]
+            self.data = model.generate(prompt, max_new_tokens=256)
     
     def set_max_nodes(self, lang_model: Any, emb_model: Any, max_nodes_per_level: int):
         if len(self.children) <= max_nodes_per_level:
@@ -0,0 +1,126 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from .llm.backend import LLMBackend
+
+HISTORY_POLICIES = ["full", "last_k", "tokens", "summary"]
+
+
+class HistoryPolicy:
+    """Decides how much of a conversation is sent to the model with every prompt.
+
+    - "full": every message (the original behavior)
+    - "last_k": only the last `last_k` messages
+    - "tokens": the most recent messages that fit in `max_tokens` tokens
+    - "summary": the last `last_k` messages verbatim, plus a summary of all the older ones
+
+    The final message is always kept. Summaries are rolling: the summary of the older messages at
+    turn t extends the cached summary of the longest already summarized prefix (normally the one of
+    turn t-1) with only the messages added since, so each turn costs one short LLM call no matter how
+    long the conversation is.
+
+    Args:
+        policy: One of HISTORY_POLICIES
+        model: Backend used to count tokens and to write summaries
+        last_k: Number of most recent messages kept verbatim ("last_k" and "summary")
+        max_tokens: Token budget of the kept messages ("tokens")
+        max_cached: Number of summaries kept in memory
+    """
+
+    def __init__(
+        self,
+        policy: str,
+        model: LLMBackend,
+        last_k: int = 6,
+        max_tokens: int = 1024,
+        max_cached: int = 4096,
+    ) -> None:
+        if policy not in HISTORY_POLICIES:
+            raise NotImplementedError(f"History policy {policy} not supported.")
+        self.policy = policy
+        self.model = model
+        self.last_k = max(last_k, 1)
+        self.max_tokens = max_tokens
+        self.max_cached = max_cached
+        # Summary of every summarized conversation prefix, keyed by a hash chained over its messages
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.summary_calls = 0
+        self.summarized_messages = 0
+
+    @staticmethod
+    def _prefix_keys(messages: List[Dict[str, str]]) -> List[str]:
+        """keys[i] identifies messages[:i + 1], computed in one pass over the messages."""
+        keys, key = [], ""
+        for message in messages:
+            key = hashlib.sha256(
+                f"{key}\x00{message['role']}\x00{message['content']}".encode("utf-8")
+            ).hexdigest()
+            keys.append(key)
+        return keys
+
+    def _summarize(self, summary: Optional[str], messages: List[Dict[str, str]]) -> str:
+        transcript = "\n".join(f"{m['role'].upper()}: {m['content']}" for m in messages)
+        previous = f"Summary so far: {summary}\n" if summary else ""
+        prompt = [
+            {
+                "role": "user",
+                "content": f"Summarize the earlier conversation in a few sentences, keeping the names, places, times and requests mentioned. Do not say anything else.\n{previous}New messages:\n{transcript}",
+            }
+        ]
+        self.summary_calls += 1
+        self.summarized_messages += len(messages)
+        return self.model.generate(prompt, max_new_tokens=128)
+
+    def summary(self, messages: List[Dict[str, str]]) -> str:
+        """Rolling summary of `messages`, reusing the summary of their longest cached prefix."""
+        if not messages:
+            return ""
+        keys = self._prefix_keys(messages)
+        with self._lock:
+            start, summary = 0, None
+            for i in range(len(keys) - 1, -1, -1):
+                if keys[i] in self._summaries:
+                    start, summary = i + 1, self._summaries[keys[i]]
+                    self._summaries.move_to_end(keys[i])
+                    break
+            if start < len(messages):
+                summary = self._summarize(summary, messages[start:])
+                self._summaries[keys[-1]] = summary
+                if len(self._summaries) > self.max_cached:
+                    self._summaries.popitem(last=False)
+            return summary
+
+    def apply(self, conversation: List[Dict[str, str]]) -> Tuple[Optional[str], List[Dict[str, str]]]:
+        """
+        Apply the policy to a conversation.
+
+        Returns:
+            Tuple of the summary of the dropped messages (None unless the policy is "summary" and
+            messages were dropped) and the messages kept, in order
+        """
+        if self.policy == "full" or len(conversation) <= 1:
+            return None, conversation
+        if self.policy == "last_k":
+            return None, conversation[-self.last_k :]
+        if self.policy == "tokens":
+            kept, total = 1, self.model.count_tokens(conversation[-1]["content"])
+            for message in reversed(conversation[:-1]):
+                total += self.model.count_tokens(message["content"])
+                if total > self.max_tokens:
+                    break
+                kept += 1
+            return None, conversation[-kept:]
+
+        older, recent = conversation[: -self.last_k], conversation[-self.last_k :]
+        return (self.summary(older) if older else None), recent
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "summaries": len(self._summaries),
+            "summary_calls": self.summary_calls,
+            "summarized_messages": self.summarized_messages,
+        }
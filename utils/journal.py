@@ -0,0 +1,132 @@
+import json
+import os
+import time
+from typing import Dict, List
+
+from .structures import DataClassEncoder, Label
+
+
+def write_predictions(json_fp: str, Y_hat: List[Label]) -> None:
+    """Write the predictions of a run to `json_fp` (e.g. Y_hat.json) as one JSON list, atomically."""
+    with open(f"{json_fp}.tmp", "w") as f:
+        json.dump(Y_hat, f, cls=DataClassEncoder, indent=4)
+    os.replace(f"{json_fp}.tmp", json_fp)
+
+
+class PredictionJournal:
+    """Append-only record of the predicted labels of a run, one JSON line `{"i": ..., "label": ...}` per sample.
+
+    Each prediction is written once, as it is made, instead of rewriting every earlier prediction
+    after each sample. Lines are flushed immediately but fsynced in batches (every `sync_every` lines
+    or `sync_interval` seconds), so a crash loses at most the last unsynced predictions. A line cut
+    short by a crash is dropped (and truncated away) when the journal is reopened, and since every
+    line carries the index of its sample, a run resumes from any set of completed samples, not only a
+    prefix. `compact` writes the final `Y_hat.json`.
+
+    Args:
+        fp: Path of the journal, e.g. `results/exp/Y_hat.jsonl`
+        sync_every: Number of appended lines between fsyncs
+        sync_interval: Maximum number of seconds between fsyncs
+    """
+
+    def __init__(self, fp: str, sync_every: int = 32, sync_interval: float = 1.0) -> None:
+        self.fp = fp
+        self.sync_every = max(sync_every, 1)
+        self.sync_interval = sync_interval
+        self.labels: Dict[int, Label] = {}
+        self.dropped_bytes = 0  # Size of the truncated tail found when opening
+
+        if os.path.exists(fp):
+            self._read()
+        self.f = open(fp, "ab")
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def _read(self) -> None:
+        with open(self.fp, "rb") as f:
+            data = f.read()
+        end = 0  # End of the last complete line
+        while end < len(data):
+            newline = data.find(b"\n", end)
+            if newline < 0:
+                break  # No newline: the last write did not finish
+            try:
+                entry = json.loads(data[end:newline])
+            except ValueError:
+                if data.find(b"\n", newline + 1) >= 0:
+                    raise ValueError(f"Corrupted line at byte {end} of {self.fp}.")
+                break  # The torn last line of a crash that was not synced
+            # The first prediction of a sample is kept
+            self.labels.setdefault(entry["i"], Label(**entry["label"]))
+            end = newline + 1
+        if end < len(data):
+            self.dropped_bytes = len(data) - end
+            # Cut the partial line so the next appends start on a line of their own
+            with open(self.fp, "r+b") as f:
+                f.truncate(end)
+
+    def __contains__(self, i: int) -> bool:
+        return i in self.labels
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def missing(self, n: int) -> List[int]:
+        """Indices in 0..n-1 without a prediction yet, in order."""
+        return [i for i in range(n) if i not in self.labels]
+
+    def append(self, i: int, label: Label) -> None:
+        if i in self.labels:
+            return
+        line = json.dumps({"i": i, "label": label}, cls=DataClassEncoder, separators=(",", ":"), ensure_ascii=False)
+        self.f.write(f"{line}\n".encode("utf-8"))
+        self.f.flush()
+        self.labels[i] = label
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every or time.time() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self) -> None:
+        if self._unsynced:
+            os.fsync(self.f.fileno())
+            self._unsynced = 0
+        self._last_sync = time.time()
+
+    def close(self) -> None:
+        if not self.f.closed:
+            self.sync()
+            self.f.close()
+
+    def __enter__(self) -> "PredictionJournal":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def ordered(self, n: int) -> List[Label]:
+        """The predictions of samples 0..n-1, in order. Raises if any is missing."""
+        missing = self.missing(n)
+        if missing:
+            raise ValueError(f"{len(missing)} of {n} samples have no prediction in {self.fp}, e.g. {missing[:5]}.")
+        return [self.labels[i] for i in range(n)]
+
+    def compact(self, json_fp: str, n: int) -> List[Label]:
+        """Write the predictions of samples 0..n-1 to `json_fp` as one JSON list, atomically, and return them."""
+        Y_hat = self.ordered(n)
+        write_predictions(json_fp, Y_hat)
+        return Y_hat
+
+    @classmethod
+    def from_json(cls, fp: str, json_fp: str, **kwargs) -> "PredictionJournal":
+        """Open the journal `fp`, first seeding it with the predictions of an older `Y_hat.json` if it has none."""
+        journal = cls(fp, **kwargs)
+        if not len(journal) and os.path.exists(json_fp):
+            try:
+                with open(json_fp, "r") as f:
+                    values = json.load(f)
+            except ValueError:
+                values = []  # Written by a run killed in the middle of rewriting it
+            for i, value in enumerate(values or []):
+                journal.append(i, Label(**value))
+            journal.sync()
+        return journal
@@ -0,0 +1,77 @@
+from typing import Any, Dict, List, Protocol, runtime_checkable
+
+
+@runtime_checkable
+class LLMBackend(Protocol):
+    """Interface every language model backend implements.
+
+    Messages are chat messages, i.e. a list of {"role": ..., "content": ...} dicts.
+    """
+
+    name: str
+
+    def generate(self, messages: List[Dict[str, str]], max_new_tokens: int = 256) -> str:
+        """Generate a response to a single chat history and return its text."""
+        ...
+
+    def batch_generate(
+        self,
+        histories: List[List[Dict[str, str]]],
+        max_new_tokens: int = 256,
+        batch_size: int = 8,
+    ) -> List[str]:
+        """Generate a response to every chat history, in order."""
+        ...
+
+    def score_choices(self, messages: List[Dict[str, str]], choices: List[str]) -> List[float]:
+        """Return the log-likelihood of each choice being the model's response to `messages`."""
+        ...
+
+    def yes_no_probabilities(
+        self, histories: List[List[Dict[str, str]]], batch_size: int = 8
+    ) -> List[float]:
+        """For every chat history, the probability that the response starts with YES rather than NO.
+
+        Computed from the next-token distribution of a single forward pass over the prompt, renormalized
+        over the YES and NO tokens only.
+        """
+        ...
+
+    def count_tokens(self, text: str) -> int:
+        """Number of tokens of `text` for this model, without special tokens."""
+        ...
+
+
+BACKENDS = ["transformers", "stub"]
+
+
+def load_backend(backend: str, model: str, **kwargs: Any) -> LLMBackend:
+    """Create the backend `backend` (one of BACKENDS) for the model `model`.
+
+    The backend modules are imported lazily so the stub backend does not need torch/transformers.
+    """
+    if backend == "transformers":
+        from .transformers_backend import TransformersBackend
+
+        return TransformersBackend(model, **kwargs)
+    elif backend == "stub":
+        from .stub_backend import StubBackend
+
+        return StubBackend(model, **kwargs)
+    else:
+        raise NotImplementedError(f"Backend {backend} not supported.")
+
+
+def load_embedding_model(backend: str) -> Any:
+    """Sentence embedding model used for the summary trees and the dense index.
+
+    The stub backend gets a deterministic bag-of-words model so it runs without any weights.
+    """
+    if backend == "stub":
+        from .stub_backend import StubEmbeddingModel
+
+        return StubEmbeddingModel()
+
+    from transformers import AutoModel
+
+    return AutoModel.from_pretrained("jinaai/jina-embeddings-v3", trust_remote_code=True)
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class PrefixKVCache:
+    """Bounded LRU of `past_key_values` keyed on the token ids of the prompt they were computed for.
+
+    Consecutive samples of a conversation share the system message, the document context and all
+    earlier turns, so the prompt of turn t+1 starts with the prompt of turn t. A lookup returns the
+    cached entry with the longest common token prefix, which the caller crops to that length and
+    extends with only the new tokens instead of prefilling the whole prompt again.
+
+    Args:
+        max_entries: Maximum number of prompts kept. The least recently used entry is evicted first.
+        min_prefix_tokens: Shorter common prefixes are not worth reusing and count as misses.
+    """
+
+    def __init__(self, max_entries: int = 8, min_prefix_tokens: int = 32) -> None:
+        self.max_entries = max_entries
+        self.min_prefix_tokens = min_prefix_tokens
+        self._entries: "OrderedDict[Tuple[int, ...], Any]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.prompt_tokens = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _common_prefix_len(a: np.ndarray, b: np.ndarray) -> int:
+        n = min(len(a), len(b))
+        mismatch = np.flatnonzero(a[:n] != b[:n])
+        return int(mismatch[0]) if len(mismatch) else n
+
+    def lookup(self, ids: List[int]) -> Tuple[int, Optional[Any]]:
+        """Find the entry sharing the longest prefix with `ids`.
+
+        At least one token of `ids` is always left uncovered, since generation needs an input token.
+
+        Returns:
+            Tuple of the reusable prefix length and the cached `past_key_values` (None on a miss).
+            The returned cache is the stored object and must be copied before being extended.
+        """
+        self.prompt_tokens += len(ids)
+        query = np.asarray(ids)
+
+        best_len, best_key = 0, None
+        for key in self._entries:
+            prefix_len = self._common_prefix_len(query, np.asarray(key))
+            if prefix_len > best_len:
+                best_len, best_key = prefix_len, key
+        best_len = min(best_len, len(ids) - 1)
+
+        if best_key is None or best_len < self.min_prefix_tokens:
+            self.misses += 1
+            return 0, None
+
+        self._entries.move_to_end(best_key)
+        self.hits += 1
+        self.reused_tokens += best_len
+        return best_len, self._entries[best_key]
+
+    def put(self, ids: List[int], past_key_values: Any) -> None:
+        """Store the `past_key_values` computed for exactly the tokens `ids`."""
+        key = tuple(ids)
+        self._entries[key] = past_key_values
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused_tokens": self.reused_tokens,
+            "prompt_tokens": self.prompt_tokens,
+        }
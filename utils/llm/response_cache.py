@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from .backend import LLMBackend
+
+
+class ResponseCache:
+    """Persistent, content-addressed cache of LLM responses stored in a SQLite file.
+
+    Entries are keyed on a hash of the model name, the full chat messages and the generation
+    kwargs, so any prompt that was already answered by the same model is served from disk.
+
+    Args:
+        fp: Path to the SQLite file (created if missing)
+        max_entries: Maximum number of responses kept. The least recently used ones are evicted.
+        read_only: Never write to the cache (misses are still answered by the model). The file must exist.
+    """
+
+    def __init__(self, fp: str, max_entries: int = 1_000_000, read_only: bool = False) -> None:
+        self.fp = fp
+        self.max_entries = max_entries
+        self.read_only = read_only
+
+        if os.path.dirname(fp):
+            os.makedirs(os.path.dirname(fp), exist_ok=True)
+        self._lock = threading.Lock()
+        if read_only:
+            if not os.path.exists(fp):
+                raise FileNotFoundError(f"Response cache {fp} does not exist.")
+            self._conn = sqlite3.connect(f"file:{fp}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self._conn = sqlite3.connect(fp, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, last_used REAL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)"
+            )
+            self._conn.commit()
+        self._n_entries = self._count()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model: str, messages: Any, kwargs: Dict[str, Any]) -> str:
+        payload = json.dumps(
+            {"model": model, "messages": messages, "kwargs": kwargs},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self._n_entries
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            if not self.read_only:
+                self._conn.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+                )
+                self._conn.commit()
+            return row[0]
+
+    def put(self, key: str, model: str, response: str) -> None:
+        if self.read_only:
+            return
+        with self._lock:
+            now = time.time()
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO responses (key, model, response, last_used) VALUES (?, ?, ?, ?)",
+                (key, model, response, now),
+            )
+            if cursor.rowcount:
+                self._n_entries += 1
+            else:
+                self._conn.execute(
+                    "UPDATE responses SET response = ?, last_used = ? WHERE key = ?",
+                    (response, now, key),
+                )
+            if self._n_entries > self.max_entries:
+                # Other processes may share the file, so recount before evicting
+                self._n_entries = self._count()
+            if self._n_entries > self.max_entries:
+                # Evict down to 90% of the limit so eviction does not run on every insert
+                n_evict = self._n_entries - int(self.max_entries * 0.9)
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)",
+                    (n_evict,),
+                )
+                self._n_entries -= n_evict
+                self.evictions += n_evict
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": self._n_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class CachedBackend:
+    """Wraps an LLMBackend so every call is first looked up in a ResponseCache."""
+
+    def __init__(self, backend: LLMBackend, cache: ResponseCache) -> None:
+        self.backend = backend
+        self.cache = cache
+        self.name = backend.name
+
+    def __getattr__(self, name: str) -> Any:
+        # Anything else (tokenizer, prefix cache, ...) comes from the wrapped backend
+        if name == "backend":
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+    def generate(self, messages: List[Dict[str, str]], max_new_tokens: int = 256) -> str:
+        key = self.cache.make_key(
+            self.name, messages, {"method": "generate", "max_new_tokens": max_new_tokens}
+        )
+        response = self.cache.get(key)
+        if response is None:
+            response = self.backend.generate(messages, max_new_tokens=max_new_tokens)
+            self.cache.put(key, self.name, response)
+        return response
+
+    def batch_generate(
+        self,
+        histories: List[List[Dict[str, str]]],
+        max_new_tokens: int = 256,
+        batch_size: int = 8,
+    ) -> List[str]:
+        # batch_size does not change the responses, so it is not part of the key
+        keys = [
+            self.cache.make_key(
+                self.name, history, {"method": "generate", "max_new_tokens": max_new_tokens}
+            )
+            for history in histories
+        ]
+        responses = [self.cache.get(key) for key in keys]
+
+        # Only the misses are sent to the model
+        missing = [i for i, response in enumerate(responses) if response is None]
+        generated = self.backend.batch_generate(
+            [histories[i] for i in missing], max_new_tokens=max_new_tokens, batch_size=batch_size
+        )
+        for i, response in zip(missing, generated):
+            responses[i] = response
+            self.cache.put(keys[i], self.name, response)
+        return responses
+
+    def score_choices(self, messages: List[Dict[str, str]], choices: List[str]) -> List[float]:
+        key = self.cache.make_key(
+            self.name, messages, {"method": "score_choices", "choices": choices}
+        )
+        response = self.cache.get(key)
+        if response is not None:
+            return json.loads(response)
+        scores = self.backend.score_choices(messages, choices)
+        self.cache.put(key, self.name, json.dumps(scores))
+        return scores
+
+    def yes_no_probabilities(
+        self, histories: List[List[Dict[str, str]]], batch_size: int = 8
+    ) -> List[float]:
+        keys = [
+            self.cache.make_key(self.name, history, {"method": "yes_no_probabilities"})
+            for history in histories
+        ]
+        responses = [self.cache.get(key) for key in keys]
+        probabilities = [None if response is None else float(response) for response in responses]
+
+        missing = [i for i, probability in enumerate(probabilities) if probability is None]
+        computed = self.backend.yes_no_probabilities(
+            [histories[i] for i in missing], batch_size=batch_size
+        )
+        for i, probability in zip(missing, computed):
+            probabilities[i] = probability
+            self.cache.put(keys[i], self.name, repr(probability))
+        return probabilities
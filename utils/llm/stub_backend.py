@@ -0,0 +1,171 @@
+import json
+import math
+import re
+import time
+import zlib
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from ..retrieval.text import content_words
+
+
+class StubBackend:
+    """Deterministic CPU-only backend that replays canned outputs or falls back to simple rules.
+
+    It recognizes the prompts used in this repo (keyword listing, YES/NO checks, answer consistency,
+    summary tree summaries, KG edges and answer generation) and answers them from the text of the
+    prompt alone, so the whole pipeline can be run and profiled without loading any weights.
+
+    Args:
+        name: Name reported as the model name (e.g. for caching)
+        responses: Canned responses keyed by the content of the last message
+        latency: Seconds to sleep per generated response, to simulate model time
+    """
+
+    def __init__(
+        self,
+        name: str = "stub",
+        responses: Optional[Dict[str, str]] = None,
+        latency: float = 0.0,
+    ) -> None:
+        self.name = name
+        self.responses = responses or {}
+        self.latency = latency
+
+    @classmethod
+    def from_file(cls, fp: str, **kwargs) -> "StubBackend":
+        """Load canned responses from a JSON file mapping last message content to response."""
+        with open(fp, "r") as f:
+            return cls(responses=json.load(f), **kwargs)
+
+    def _context_and_query(self, messages: List[Dict[str, str]]):
+        """Split the prompt into the document/excerpt context and the user query."""
+        context = ""
+        for message in messages:
+            for marker in ["Key Excerpts:", "Excerpts:", "Documents:", "separated by <div>s:"]:
+                if marker in message["content"]:
+                    context = message["content"].split(marker, 1)[1]
+                    break
+
+        query = ""
+        user_messages = [m["content"] for m in messages if m["role"] == "user"]
+        for content in reversed(user_messages):
+            if not any(marker in content for marker in ["Excerpts:", "Documents:", "<div>", "Are the document(s)"]):
+                query = content
+                break
+        return context, query
+
+    def _respond(self, messages: List[Dict[str, str]]) -> str:
+        last = messages[-1]["content"]
+        if last in self.responses:
+            return self.responses[last]
+
+        if "Are Answers 1 & 2 consistent" in last:
+            answers = {}
+            for message in messages:
+                match = re.match(r"\[ANSWER (\d)\] (.*)", message["content"], re.S)
+                if match:
+                    answers[match.group(1)] = set(content_words(match.group(2)))
+            a1, a2 = answers.get("1", set()), answers.get("2", set())
+            overlap = len(a1 & a2) / max(1, min(len(a1), len(a2)))
+            return "YES, THEY ARE CONSISTENT." if overlap >= 0.5 else "NO, THEY ARE NOT CONSISTENT."
+
+        if 'Answer "YES" or "NO" only.' in last:
+            context, query = self._context_and_query(messages)
+            return "YES" if set(content_words(query)) & set(content_words(context)) else "NO"
+
+        if "This is the query I want to answer:" in last:
+            query = last.split("This is the query I want to answer:", 1)[1].split("\n", 1)[0]
+            keywords = list(dict.fromkeys(w for w in content_words(query) if len(w) > 2))
+            return ", ".join(keywords[:5])
+
+        if last.startswith("Summarize the earlier conversation"):
+            previous = last.split("Summary so far: ", 1)[1].split("\n", 1)[0] if "Summary so far: " in last else ""
+            new = last.split("New messages:\n", 1)[1] if "New messages:\n" in last else ""
+            words = list(dict.fromkeys(content_words(previous) + content_words(new)))
+            return " ".join(words[-40:])
+
+        if last.startswith("Summarize the topic coverage"):
+            docs = last.split("\n", 1)[1] if "\n" in last else ""
+            docs = re.sub(r"DOCUMENT( COLLECTION KEYWORDS)?|</?div>", " ", docs)
+            return ", ".join(w for w, _ in Counter(content_words(docs)).most_common(25))
+
+        if "Convert the document excerpt in the div into edges" in last:
+            excerpt = re.search(r"<div>(.*?)</div>", last, re.S)
+            edges = []
+            for sentence in re.split(r"(?<=[.!?]) +", excerpt.group(1) if excerpt else ""):
+                words = content_words(sentence)
+                if len(words) >= 2:
+                    edges.append(f"{words[0]}|related_to|{words[-1]}")
+            return "\n".join(edges)
+
+        # Answer generation: the sentence of the context sharing the most words with the query
+        context, query = self._context_and_query(messages)
+        sentences = [
+            s.strip()
+            for div in re.findall(r"<div>(.*?)</div>", context, re.S) or [context]
+            for s in re.split(r"(?<=[.!?])\s+", div)
+            if s.strip()
+        ]
+        if not sentences:
+            return query
+        query_words = set(content_words(query))
+        return max(sentences, key=lambda s: len(query_words & set(content_words(s))))
+
+    def count_tokens(self, text: str) -> int:
+        # Roughly one token per word or punctuation mark
+        return len(re.findall(r"\w+|[^\w\s]", text))
+
+    def generate(self, messages: List[Dict[str, str]], max_new_tokens: int = 256) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        return " ".join(self._respond(messages).split(" ")[:max_new_tokens])
+
+    def batch_generate(
+        self,
+        histories: List[List[Dict[str, str]]],
+        max_new_tokens: int = 256,
+        batch_size: int = 8,
+    ) -> List[str]:
+        if self.latency:
+            time.sleep(self.latency * math.ceil(len(histories) / batch_size))
+        return [
+            " ".join(self._respond(history).split(" ")[:max_new_tokens])
+            for history in histories
+        ]
+
+    def score_choices(self, messages: List[Dict[str, str]], choices: List[str]) -> List[float]:
+        response = self._respond(messages).strip().upper()
+        matches = [response.startswith(choice.strip().upper()) for choice in choices]
+        n_matches = sum(matches)
+        if n_matches == 0 or n_matches == len(choices):
+            return [math.log(1 / len(choices))] * len(choices)
+        return [
+            math.log(0.9 / n_matches) if match else math.log(0.1 / (len(choices) - n_matches))
+            for match in matches
+        ]
+
+    def yes_no_probabilities(
+        self, histories: List[List[Dict[str, str]]], batch_size: int = 8
+    ) -> List[float]:
+        return [
+            0.9 if self._respond(history).strip().upper().startswith("YES") else 0.1
+            for history in histories
+        ]
+
+
+class StubEmbeddingModel:
+    """Deterministic stand-in for the sentence embedding model (hashed bag-of-words vectors)."""
+
+    def __init__(self, dim: int = 64) -> None:
+        self.dim = dim
+
+    def encode(self, texts: List[str], task: Optional[str] = None) -> np.ndarray:
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in content_words(text):
+                embeddings[i, zlib.crc32(word.encode()) % self.dim] += 1.0
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
@@ -0,0 +1,190 @@
+import copy
+from typing import Dict, List, Tuple
+
+import torch
+from transformers import DynamicCache, pipeline
+
+from .kv_cache import PrefixKVCache
+
+
+class TransformersBackend:
+    """LLM backend running a HuggingFace text-generation pipeline.
+
+    Args:
+        model: HuggingFace model name or path
+        prefix_cache_size: Number of prompts whose `past_key_values` are kept for reuse by later
+            prompts sharing a prefix with them (see `PrefixKVCache`). 0 disables the cache. Only
+            `generate` uses it: the padded prompts of `batch_generate` are always prefilled in full.
+    """
+
+    def __init__(self, model: str, prefix_cache_size: int = 0) -> None:
+        self.name = model
+        self.pipeline = pipeline(
+            "text-generation",
+            model=model,
+            torch_dtype=torch.bfloat16,
+            device_map="auto",
+        )
+        self.pipeline.model.generation_config.pad_token_id = (
+            self.pipeline.tokenizer.eos_token_id
+        )
+        # Batched generation with a decoder-only model needs a pad token and left padding
+        if self.pipeline.tokenizer.pad_token_id is None:
+            self.pipeline.tokenizer.pad_token_id = self.pipeline.tokenizer.eos_token_id
+        self.pipeline.tokenizer.padding_side = "left"
+        # Counting runs on the CPU stage threads of ConvRef.pipelined_call (to pack the documents) while
+        # the model stage tokenizes padded batches. A fast tokenizer cannot be used from both at once
+        # ("Already borrowed"), so counting has its own instance.
+        self._count_tokenizer = copy.deepcopy(self.pipeline.tokenizer)
+
+        self.prefix_cache = PrefixKVCache(prefix_cache_size) if prefix_cache_size > 0 else None
+        self._yes_no_ids = None
+
+    @property
+    def model(self):
+        return self.pipeline.model
+
+    @property
+    def tokenizer(self):
+        return self.pipeline.tokenizer
+
+    def count_tokens(self, text: str) -> int:
+        return len(self._count_tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def generate(self, messages: List[Dict[str, str]], max_new_tokens: int = 256) -> str:
+        if self.prefix_cache is not None:
+            return self._generate_with_prefix_cache(messages, max_new_tokens)
+        outputs = self.pipeline(messages, max_new_tokens=max_new_tokens)
+        return outputs[0]["generated_text"][-1]["content"]
+
+    @torch.no_grad()
+    def _generate_with_prefix_cache(
+        self, messages: List[Dict[str, str]], max_new_tokens: int
+    ) -> str:
+        """Generate while reusing the KV cache of the longest cached prompt prefix."""
+        ids = self.tokenizer.apply_chat_template(
+            messages, add_generation_prompt=True, tokenize=True
+        )
+        prefix_len, cached = self.prefix_cache.lookup(ids)
+        if cached is None:
+            past_key_values = DynamicCache()
+        else:
+            # Copy so the stored entry stays valid, then drop everything after the shared prefix
+            past_key_values = copy.deepcopy(cached)
+            past_key_values.crop(prefix_len)
+
+        input_ids = torch.tensor([ids], device=self.model.device)
+        output = self.model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            max_new_tokens=max_new_tokens,
+        )
+
+        # The cache now also holds the generated tokens, keep only the prompt for later reuse
+        past_key_values.crop(len(ids))
+        self.prefix_cache.put(ids, past_key_values)
+
+        return self.tokenizer.decode(output[0, len(ids):], skip_special_tokens=True)
+
+    def batch_generate(
+        self,
+        histories: List[List[Dict[str, str]]],
+        max_new_tokens: int = 256,
+        batch_size: int = 8,
+    ) -> List[str]:
+        if not histories:
+            return []
+        outputs = self.pipeline(
+            histories, max_new_tokens=max_new_tokens, batch_size=batch_size
+        )
+        return [output[0]["generated_text"][-1]["content"] for output in outputs]
+
+    @torch.no_grad()
+    def score_choices(self, messages: List[Dict[str, str]], choices: List[str]) -> List[float]:
+        prompt_ids = self.tokenizer.apply_chat_template(
+            messages, add_generation_prompt=True, tokenize=True
+        )
+        choice_ids = [
+            self.tokenizer(choice, add_special_tokens=False)["input_ids"]
+            for choice in choices
+        ]
+
+        # Score all the choices in one padded forward pass (left padded like generation)
+        seqs = [prompt_ids + ids for ids in choice_ids]
+        max_len = max(len(seq) for seq in seqs)
+        input_ids = torch.full(
+            (len(seqs), max_len), self.tokenizer.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((len(seqs), max_len), dtype=torch.long)
+        for i, seq in enumerate(seqs):
+            input_ids[i, max_len - len(seq):] = torch.tensor(seq)
+            attention_mask[i, max_len - len(seq):] = 1
+
+        logits = self.model(
+            input_ids=input_ids.to(self.model.device),
+            attention_mask=attention_mask.to(self.model.device),
+        ).logits.float()
+        log_probs = torch.log_softmax(logits, dim=-1)
+
+        scores = []
+        for i, ids in enumerate(choice_ids):
+            # The logits at position p predict the token at position p + 1
+            positions = torch.arange(max_len - len(ids) - 1, max_len - 1)
+            token_log_probs = log_probs[i, positions, torch.tensor(ids)]
+            scores.append(token_log_probs.sum().item())
+        return scores
+
+    def _yes_no_token_ids(self) -> Tuple[List[int], List[int]]:
+        """First token ids of the spellings of YES and NO a response can start with."""
+        if self._yes_no_ids is None:
+            ids = []
+            for word in ["YES", "NO"]:
+                spellings = [word, word.capitalize(), word.lower()]
+                ids.append(
+                    {
+                        self.tokenizer(prefix + spelling, add_special_tokens=False)["input_ids"][0]
+                        for spelling in spellings
+                        for prefix in ["", " "]
+                    }
+                )
+            yes_ids, no_ids = ids
+            # A token starting both words (e.g. a lone space) says nothing about the answer
+            self._yes_no_ids = (sorted(yes_ids - no_ids), sorted(no_ids - yes_ids))
+        return self._yes_no_ids
+
+    @torch.no_grad()
+    def yes_no_probabilities(
+        self, histories: List[List[Dict[str, str]]], batch_size: int = 8
+    ) -> List[float]:
+        yes_ids, no_ids = self._yes_no_token_ids()
+        probabilities = []
+        for i in range(0, len(histories), batch_size):
+            prompts = [
+                self.tokenizer.apply_chat_template(
+                    history, add_generation_prompt=True, tokenize=False
+                )
+                for history in histories[i:i + batch_size]
+            ]
+            # The chat template already adds the special tokens. Left padding puts every prompt's
+            # last token at the last position.
+            inputs = self.tokenizer(
+                prompts, return_tensors="pt", padding=True, add_special_tokens=False
+            ).to(self.model.device)
+
+            # Positions count from each prompt's first real token, like generate() does
+            position_ids = (inputs["attention_mask"].cumsum(-1) - 1).clamp(min=0)
+
+            # Only project the last hidden state to the vocabulary instead of the whole sequence
+            hidden = self.model.base_model(
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                position_ids=position_ids,
+            ).last_hidden_state[:, -1]
+            logits = self.model.get_output_embeddings()(hidden).float()
+            log_probs = torch.log_softmax(logits, dim=-1)
+
+            yes = torch.logsumexp(log_probs[:, yes_ids], dim=-1)
+            no = torch.logsumexp(log_probs[:, no_ids], dim=-1)
+            probabilities.extend(torch.sigmoid(yes - no).tolist())
+        return probabilities
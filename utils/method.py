@@ -1,41 +1,76 @@
 import re
+import threading
 import time
 from collections import defaultdict
-from difflib import SequenceMatcher
+from typing import Iterator, Tuple, Union
 
-import spacy
-import torch
 from tqdm import tqdm
-from transformers import pipeline
 
 from .graph.summary_tree import SummaryTree
-from .response import affirmative_resp, list_words, segments_to_edges
+from .history import HistoryPolicy
+from .llm.backend import LLMBackend, load_backend
+from .ner import EntityExtractor
+from .pipeline import Stage, StagePipeline
+from .retrieval.bm25 import BM25Index
+from .retrieval.context_packer import ContextPacker
+from .retrieval.dense_index import DenseIndex
+from .retrieval.dedup import DedupStats, remove_near_duplicates
+from .retrieval.sentence_index import SentenceIndex
+from .retrieval.tree_retrieval import TreeRetriever
+from .response import (
+    affirmative_prob,
+    affirmative_resp,
+    batch_affirmative_prob,
+    batch_affirmative_resp,
+    batch_list_words,
+    list_words,
+    segments_to_edges,
+)
 from .structures import *
-
-nlp = spacy.load("en_core_web_lg")
+from .tracing import TracedBackend, span, trace
 
 
 # TODO: Clean up to not need e2i, i2e, r2i, i2r
 class ConvRef:
     def __init__(
         self,
-        model: str,
+        model: Union[str, LLMBackend],
         llm_only: bool,
         strict: bool,
         use_gt_segments: bool = False,  # Flag for Stage 1 ablation
         use_gt_doc_relevancy: bool = False,  # Flag for Stage 2 ablation
+        batch_size: int = 8,  # Number of prompts sent to the model at once by `batch_call`
+        backend: str = "transformers",  # Used when `model` is a model name
+        yes_no_scoring: str = "generate",  # "generate" parses a generated answer, "logits" uses one forward pass
+        relevancy_threshold: float = 0.5,  # Minimum YES probability to be relevant with "logits" scoring
+        stage1: str = "keywords",  # "keywords" asks the LLM for keywords to search, "bm25"/"dense" rank the windows
+        retrieval_top_k: int = 10,  # Number of windows kept by the "bm25" and "dense" Stage 1
+        retrieval_history_turns: int = 0,  # Number of earlier user turns added to the "bm25" and "dense" queries
     ) -> None:
-        self.model = pipeline(
-            "text-generation",
-            model=model,
-            torch_dtype=torch.bfloat16,
-            device_map="auto",
-        )
-        self.model.model.generation_config.pad_token_id = (
-            self.model.tokenizer.eos_token_id
-        )
+        if isinstance(model, str):
+            model = load_backend(backend, model)
+        # Every model call is timed, with its token counts, in the spans of the labels
+        self.model = TracedBackend(model)
+        self.batch_size = batch_size
+        self.yes_no_scoring = yes_no_scoring
+        self.relevancy_threshold = relevancy_threshold
+        self.stage1 = stage1
+        self.retrieval_top_k = retrieval_top_k
+        self.retrieval_history_turns = retrieval_history_turns
 
         self.summary_trees = None
+        self.tree_retriever = None
+        self.context_packer = None
+        self.history_policy = None
+        self.sentence_index = None
+        self.bm25_index = None
+        self.dense_index = None
+        self.emb_model = None
+        self.dedup_stats = DedupStats()
+        self.ner = EntityExtractor()
+        self._model_lock = threading.Lock()  # Serializes model calls from the pipelined_call stages
+        self._stats_lock = threading.Lock()  # Guards self.dedup_stats, updated from the CPU stage threads
+        self.pipeline_metrics = None
         self.llm_only = llm_only
         self.strict = strict
 
@@ -54,22 +89,14 @@ class ConvRef:
         Returns:
             list: A list of unique strings with near-duplicates removed.
         """
-        # Sort strings by length (longest first) to keep the longest version
-        strings = sorted(strings, key=len, reverse=True)
-        unique_strings = []
-
-        for s in strings:
-            is_duplicate = False
-            for unique in unique_strings:
-                # Check similarity
-                similarity = SequenceMatcher(None, s, unique).ratio()
-                if similarity >= similarity_threshold:
-                    is_duplicate = True
-                    break
-            if not is_duplicate:
-                unique_strings.append(s)
-
-        return unique_strings
+        # Bounded comparisons (see remove_near_duplicates), counted in self.dedup_stats. Counted per call
+        # and merged under a lock, since the pipelined_call CPU stages deduplicate concurrently.
+        stats = DedupStats()
+        with span("dedup"):
+            unique = remove_near_duplicates(strings, similarity_threshold, stats)
+        with self._stats_lock:
+            self.dedup_stats.add(stats)
+        return unique
 
     def _extract_keyword_context(self, document: str, keyword: str) -> list:
         results = []
@@ -91,125 +118,255 @@ class ConvRef:
 
         return results
 
+    def _conversation_query(self, X: Sample) -> str:
+        """Text of the conversation that documents are matched against: all user turns."""
+        return "\n".join(m["content"] for m in X.conversation if m["role"] == "user")
+
+    def _div_context(self, X: Sample, texts: Dict[str, str]) -> str:
+        """One <div> per document, packed into the token budget if there is one."""
+        if self.context_packer is not None:
+            texts, _ = self.context_packer.pack(texts, self._conversation_query(X))
+        return "\n".join([f"<div>{text}</div>" for text in texts.values()])
+
+    def _doc_context(self, X: Sample, docs: Dict[str, str]) -> str:
+        if self.context_packer is None:
+            return "\n".join([f"<div>{docs[doc_id]}</div>" for doc_id in X.document_ids])
+        return self._div_context(X, {doc_id: docs[doc_id] for doc_id in X.document_ids})
+
+    def _tree_chunks(self, X: Sample) -> Optional[List[str]]:
+        """Chunks selected by tree-guided retrieval, or None to use the full documents."""
+        if self.tree_retriever is None:
+            return None
+        # Fall back to the full documents when nothing in them matches the conversation
+        return self.tree_retriever.select(X.document_ids, self._conversation_query(X)) or None
+
+    def _stage1_texts(self, X: Sample, docs: Dict[str, str]) -> Dict[str, str]:
+        """Documents of the Stage 1 keyword prompt, limited to the selected chunks if any."""
+        chunk_ids = self._tree_chunks(X)
+        if chunk_ids is None:
+            return {doc_id: docs[doc_id] for doc_id in X.document_ids}
+        return self.tree_retriever.texts(chunk_ids)
+
+    def _stage1_doc_context(self, X: Sample, docs: Dict[str, str]) -> str:
+        if self.tree_retriever is None:
+            return self._doc_context(X, docs)
+        return self._div_context(X, self._stage1_texts(X, docs))
+
+    def _record_dropped_context(self, X: Sample, docs: Dict[str, str], y_hat: Label) -> Label:
+        """Record in `y_hat` how many tokens the context packer dropped from each document of the prompt."""
+        if self.context_packer is None:
+            return y_hat
+        if not self.llm_only and (self.use_gt_segments or self.stage1 != "keywords"):
+            return y_hat
+        if self.llm_only:
+            texts = {doc_id: docs[doc_id] for doc_id in X.document_ids}
+        else:
+            texts = self._stage1_texts(X, docs)
+        # Already packed when the prompt was built, so this is a cache hit
+        _, dropped = self.context_packer.pack(texts, self._conversation_query(X))
+        y_hat.dropped_context = dropped or None
+        return y_hat
+
+    def _excerpt_context(self, relevant_segments: List[str]) -> str:
+        return "\n".join([f"<div>{segment}</div>" for segment in relevant_segments])
+
+    def _find_verbatim_segments(
+        self, X: Sample, answer: str, docs: Dict[str, str], segments: Optional[List[str]]
+    ) -> Optional[List[str]]:
+        """Use the answer itself as the segment if it is found verbatim in one of the documents."""
+        for doc_id in X.document_ids:
+            if answer in docs[doc_id]:
+                segments = [answer]
+        return segments
+
+    def _with_history(self, X: Sample, system_content: str) -> List[Dict[str, str]]:
+        """A system message followed by the conversation, as much of it as the history policy keeps."""
+        if self.history_policy is None:
+            return [{"role": "system", "content": system_content}] + X.conversation
+        with span("history"):
+            summary, messages = self.history_policy.apply(X.conversation)
+        if summary:
+            system_content = f"{system_content}\nSummary of the earlier conversation: {summary}"
+        return [{"role": "system", "content": system_content}] + messages
+
+    def _llm_only_history(self, X: Sample, doc_context: str) -> List[Dict[str, str]]:
+        return self._with_history(
+            X,
+            f"You are a helpful assistant. If needed, refer to the following provided document(s) to answer questions. Documents: {doc_context}",
+        )
+
+    def _llm_only_relevancy_prompt(self, X: Sample, doc_context: str) -> List[Dict[str, str]]:
+        return self._llm_only_history(X, doc_context) + [
+            {
+                "role": "user",
+                "content": f"Are the document(s) relevant for answering the query?",
+            }
+        ]
+
+    def _llm_only_answer_prompt(self, X: Sample, doc_context: str) -> List[Dict[str, str]]:
+        return self._with_history(
+            X,
+            f"You are a helpful assistant. If needed, refer to the following provided document(s) to answer questions. Answer with the single most relevant snippet from the document(s) verbatim and nothing else. Documents: {doc_context}",
+        )
+
+    def _keyword_prompt(self, doc_context: str, final_query: str) -> List[Dict[str, str]]:
+        return [
+            {
+                "role": "user",
+                "content": f"Here are the document(s) separated by <div>s: {doc_context}\nThis is the query I want to answer: {final_query}\nIf the document may be able to answer the query, please provide keywords separated by a comma to search the document(s) for, verbatim, in a document to answer the following query. Otherwise, give no response.\nPlease note each comma-separated keyword will be used to retrieve sentences from the document, so find keywords that will find sentences from the document that may be relevant to answer the question.",
+            }
+        ]
+
+    def _relevancy_prompt(self, X: Sample, relevant_segments: List[str]) -> List[Dict[str, str]]:
+        excerpt_context = self._excerpt_context(relevant_segments)
+        return [X.conversation[-1]] + [
+            {
+                "role": "user",
+                "content": f"Are the following excerpts relevant for answering the query? Excerpts: {excerpt_context}",
+            }
+        ]
+
+    def _response_prompt(self, X: Sample, relevant_segments: List[str]) -> List[Dict[str, str]]:
+        excerpt_context = self._excerpt_context(relevant_segments)
+        return self._with_history(
+            X,
+            f"You are a helpful assistant. Answer with the single most relevant snippet from the document(s) verbatim and nothing else. Key Excerpts: {excerpt_context}",
+        )
+
+    def _affirmative(self, history: List[Dict[str, str]]) -> Tuple[bool, Optional[float]]:
+        """Ask a YES/NO question. Returns the answer and, with "logits" scoring, the YES probability."""
+        with span("relevancy"):
+            if self.yes_no_scoring == "logits":
+                probability = affirmative_prob(self.model, history)
+                return probability >= self.relevancy_threshold, probability
+            return affirmative_resp(self.model, history), None
+
+    def _batch_affirmative(
+        self, histories: List[List[Dict[str, str]]]
+    ) -> Tuple[List[bool], List[Optional[float]]]:
+        """Batched version of `_affirmative`."""
+        with span("relevancy"):
+            if self.yes_no_scoring == "logits":
+                probabilities = batch_affirmative_prob(
+                    self.model, histories, batch_size=self.batch_size
+                )
+                return [p >= self.relevancy_threshold for p in probabilities], probabilities
+            answers = batch_affirmative_resp(self.model, histories, batch_size=self.batch_size)
+            return answers, [None] * len(histories)
+
     def _run_llm_only_approach(
         self, X: Sample, docs: Dict[str, str], start: float
     ) -> Label:
-        history = [
-            {
-                "role": "system",
-                "content": f"You are a helpful assistant. If needed, refer to the following provided document(s) to answer questions. Documents: {doc_context}",
-            }
-        ] + X.conversation
-        document_relevant = affirmative_resp(
-            self.model,
-            history
-            + [
-                {
-                    "role": "user",
-                    "content": f"Are the document(s) relevant for answering the query?",
-                }
-            ],
+        with span("context"):
+            doc_context = self._doc_context(X, docs)
+        document_relevant, document_relevant_prob = self._affirmative(
+            self._llm_only_relevancy_prompt(X, doc_context)
         )
         segments = None
         answer = None
         if document_relevant:
-            history[0]["content"] = (
-                f"You are a helpful assistant. If needed, refer to the following provided document(s) to answer questions. Answer with the single most relevant snippet from the document(s) verbatim and nothing else. Documents: {doc_context}",
-            )
-            outputs = self.model(
-                history,
-                max_new_tokens=256,
-            )
-            answer = outputs[0]["generated_text"][-1]["content"]
-            for doc_id in X.document_ids:
-                if answer in docs[doc_id]:
-                    segments = [answer]
+            with span("generation"):
+                answer = self.model.generate(
+                    self._llm_only_answer_prompt(X, doc_context),
+                    max_new_tokens=256,
+                )
+            segments = self._find_verbatim_segments(X, answer, docs, segments)
         return Label(
             document_relevant=document_relevant,
             segments=segments,
             answer=answer,
             time_taken=time.time() - start,
+            document_relevant_prob=document_relevant_prob,
         )
 
-    def _get_relevant_segments(
-        self, X: Sample, docs: Dict[str, str], doc_context: str, final_query: str
+    def _search_segments(
+        self, X: Sample, docs: Dict[str, str], keywords: List[str], final_query: str
     ) -> List[str]:
-        """Helper function to get the key excerpts (relevant segments) from the passage. Stage 1 of the Ours approach."""
-        # Identify potential keywords that relate to the query.
-        keywords = list_words(
-            self.model,
-            [
-                {
-                    "role": "user",
-                    "content": f"Here are the document(s) separated by <div>s: {doc_context}\nThis is the query I want to answer: {final_query}\nIf the document may be able to answer the query, please provide keywords separated by a comma to search the document(s) for, verbatim, in a document to answer the following query. Otherwise, give no response.\nPlease note each comma-separated keyword will be used to retrieve sentences from the document, so find keywords that will find sentences from the document that may be relevant to answer the question.",
-                }
-            ],
-        ) + [ent.text for ent in nlp(final_query).ents]
+        """Helper function to search the documents for the keywords and the entities of the query."""
+        with span("ner"):
+            keywords = keywords + self.ner.entities(final_query)
         keywords = list(set([v.lower() for v in keywords]))
         print("KEYWORDS", keywords)
 
-        # Find all in-context instances of the keyword in the document.
-        relevant_segments = []
-        for keyword in keywords:
-            keyword = keyword.strip().lower()
-            if keyword:
-                for doc_id in X.document_ids:
-                    if keyword in docs[doc_id].lower():
-                        relevant_segments.extend(
-                            self._extract_keyword_context(
-                                document=docs[doc_id], keyword=keyword
-                            )
-                        )
+        # Find all in-context instances of the keywords in the documents, in a single pass per document.
+        # With tree-guided retrieval only the selected chunks are searched.
+        with span("keyword_search"):
+            chunk_ids = self._tree_chunks(X)
+            if chunk_ids is None:
+                relevant_segments = self._get_sentence_index(docs).find_contexts(
+                    X.document_ids, keywords
+                )
+            else:
+                relevant_segments = self.tree_retriever.sentence_index.find_contexts(
+                    chunk_ids, keywords
+                )
         relevant_segments = self._remove_near_duplicates(relevant_segments)
         return relevant_segments
 
+    def prefetch_entities(self, samples: List[Sample], n_process: int = 1) -> None:
+        """Compute the entities of the final queries of `samples` in batches, if Stage 1 needs them."""
+        if not self.llm_only and not self.use_gt_segments and self.stage1 == "keywords":
+            self.ner.prefetch([X.conversation[-1]["content"] for X in samples], n_process=n_process)
+
+    def _history_turns(self, X: Sample) -> List[str]:
+        """The `retrieval_history_turns` user turns before the final query."""
+        if self.retrieval_history_turns <= 0:
+            return []
+        history = [m["content"] for m in X.conversation[:-1] if m["role"] == "user"]
+        return history[-self.retrieval_history_turns :]
+
+    def _ranked_segments(self, X: Sample, docs: Dict[str, str]) -> List[str]:
+        """Helper function to rank the sentence windows of the documents against the conversation, without any
+        LLM call. Stage 1 of the Ours approach with `stage1="bm25"` (sparse) or `stage1="dense"` (embeddings)."""
+        with span("ranking"):
+            if self.stage1 == "bm25":
+                index = self._get_bm25_index(docs)
+                query_vector = index.query_vector(X.conversation[-1]["content"])
+                for turn in self._history_turns(X):
+                    index.query_vector(turn, weight=0.5, vector=query_vector)
+                relevant_segments = index.search(X.document_ids, query_vector, top_k=self.retrieval_top_k)
+            else:
+                query = "\n".join(self._history_turns(X) + [X.conversation[-1]["content"]])
+                with self._model_lock:
+                    query_embedding = self.emb_model.encode([query], task="retrieval.query")[0]
+                relevant_segments = self.dense_index.search(
+                    X.document_ids, query_embedding, top_k=self.retrieval_top_k
+                )
+        return self._remove_near_duplicates(relevant_segments)
+
+    def _get_relevant_segments(
+        self, X: Sample, docs: Dict[str, str], doc_context: str, final_query: str
+    ) -> List[str]:
+        """Helper function to get the key excerpts (relevant segments) from the passage. Stage 1 of the Ours approach."""
+        if self.stage1 != "keywords":
+            return self._ranked_segments(X, docs)
+        # Identify potential keywords that relate to the query.
+        with span("keywords"):
+            keywords = list_words(self.model, self._keyword_prompt(doc_context, final_query))
+        return self._search_segments(X, docs, keywords, final_query)
+
     def _determine_document_relevancy(
         self, X: Sample, relevant_segments: List[str]
-    ) -> bool:
-        """Helper function to determine if the document is relevant based on the key excerpts. Stage 2 of the Ours approach."""
-        excerpt_context = "\n".join(
-            [f"<div>{segment}</div>" for segment in relevant_segments]
-        )
-
+    ) -> Tuple[bool, Optional[float]]:
+        """Helper function to determine if the document is relevant based on the key excerpts. Stage 2 of the Ours approach.
+        Also returns the probability of relevancy when it is available."""
         if (
             self.strict
         ):  # Ours_strict approach (ask the LLM if the document is relevant)
-            document_relevant = affirmative_resp(
-                self.model,
-                [X.conversation[-1]]
-                + [
-                    {
-                        "role": "user",
-                        "content": f"Are the following excerpts relevant for answering the query? Excerpts: {excerpt_context}",
-                    }
-                ],
-            )
+            return self._affirmative(self._relevancy_prompt(X, relevant_segments))
         else:  # Ours_lax approach (assume the document is relevant)
-            document_relevant = True
-
-        return document_relevant
+            return True, None
 
     def _generate_response(
         self, X: Sample, relevant_segments: List[str], docs: Dict[str, str]
-    ) -> str:
+    ) -> Tuple[str, List[str]]:
         """Helper function to generate the response. Stage 3 of the Ours approach."""
-
-        segments = relevant_segments
-        history = [
-            {
-                "role": "system",
-                "content": f"You are a helpful assistant. Answer with the single most relevant snippet from the document(s) verbatim and nothing else. Key Excerpts: {excerpt_context}",
-            }
-        ] + X.conversation
-
-        outputs = self.model(
-            history,
-            max_new_tokens=256,
-        )
-        answer = outputs[0]["generated_text"][-1]["content"]
-        for doc_id in X.document_ids:
-            if answer in docs[doc_id]:
-                segments = [answer]
+        with span("generation"):
+            answer = self.model.generate(
+                self._response_prompt(X, relevant_segments),
+                max_new_tokens=256,
+            )
+        segments = self._find_verbatim_segments(X, answer, docs, relevant_segments)
 
         return answer, segments
 
@@ -219,14 +376,21 @@ class ConvRef:
         """Main function to run the Ours approach."""
         # Stage 1: Key Excerpts Selection
         if self.use_gt_segments:
-            relevant_segments = Y.segments
+            relevant_segments = Y.segments or []
         else:
             final_query = X.conversation[-1]["content"]
             relevant_segments = self._get_relevant_segments(
                 X, docs, doc_context, final_query
             )
 
+        return self._run_ours_stages_2_3(X, docs, start, relevant_segments, Y)
+
+    def _run_ours_stages_2_3(
+        self, X: Sample, docs: Dict[str, str], start: float, relevant_segments: List[str], Y: Label
+    ) -> Label:
+        """Stage 2 and 3 of the Ours approach, given the relevant segments found by Stage 1."""
         # Stage 2: Relevancy Check (identify if the document is relevant)
+        document_relevant_prob = None
         if len(relevant_segments) == 0:
             document_relevant = (
                 False  # always set it to False when relevant_segments is empty
@@ -234,7 +398,9 @@ class ConvRef:
         elif self.use_gt_doc_relevancy:
             document_relevant = Y.document_relevant
         else:  # otherwise, determine relevancy based on the key excerpts (Our Approach)
-            document_relevant = self._determine_document_relevancy(X, relevant_segments)
+            document_relevant, document_relevant_prob = self._determine_document_relevancy(
+                X, relevant_segments
+            )
 
         # Stage 3: Response Generation
         answer, segments = None, None
@@ -246,6 +412,7 @@ class ConvRef:
             segments=segments,
             answer=answer,
             time_taken=time.time() - start,
+            document_relevant_prob=document_relevant_prob,
         )
 
     def __call__(self, X: Sample, docs: Dict[str, str], Y: Label = None) -> Label:
@@ -261,13 +428,267 @@ class ConvRef:
             Label: The generated response
         """
         start = time.time()
-        if self.llm_only:
-            return self._run_llm_only_approach(X, docs, start)
+        with trace() as spans:
+            if self.llm_only:
+                y_hat = self._run_llm_only_approach(X, docs, start)
+            else:
+                # The BM25 Stage 1 does not prompt with the documents
+                doc_context = None
+                if self.stage1 == "keywords":
+                    with span("context"):
+                        doc_context = self._stage1_doc_context(X, docs)
+                y_hat = self._run_ours_approach(X, docs, start, doc_context, Y)
+        y_hat.spans = spans
+        return self._record_dropped_context(X, docs, y_hat)
+
+    def _generate_batch(self, histories: List[List[Dict[str, str]]]) -> List[str]:
+        """Generate a response for every history, sending them to the model as padded batches."""
+        return self.model.batch_generate(
+            histories, max_new_tokens=256, batch_size=self.batch_size
+        )
+
+    def _run_llm_only_approach_batch(
+        self, samples: List[Sample], docs: Dict[str, str]
+    ) -> List[Label]:
+        with span("context"):
+            doc_contexts = [self._doc_context(X, docs) for X in samples]
+        document_relevant, document_relevant_prob = self._batch_affirmative(
+            [self._llm_only_relevancy_prompt(X, c) for X, c in zip(samples, doc_contexts)]
+        )
+
+        # Only the samples whose document(s) were found relevant move on to answer generation
+        relevant_idx = [i for i, relevant in enumerate(document_relevant) if relevant]
+        with span("generation"):
+            answers = self._generate_batch(
+                [self._llm_only_answer_prompt(samples[i], doc_contexts[i]) for i in relevant_idx]
+            )
+
+        labels = [
+            Label(
+                document_relevant=relevant,
+                segments=None,
+                answer=None,
+                document_relevant_prob=probability,
+            )
+            for relevant, probability in zip(document_relevant, document_relevant_prob)
+        ]
+        for i, answer in zip(relevant_idx, answers):
+            labels[i].answer = answer
+            labels[i].segments = self._find_verbatim_segments(samples[i], answer, docs, None)
+        return labels
+
+    def _run_ours_approach_batch(
+        self, samples: List[Sample], docs: Dict[str, str], labels: List[Label]
+    ) -> List[Label]:
+        # Stage 1: Key Excerpts Selection
+        if self.use_gt_segments:
+            relevant_segments = [Y.segments or [] for Y in labels]
+        elif self.stage1 != "keywords":
+            relevant_segments = [self._ranked_segments(X, docs) for X in samples]
         else:
-            doc_context = "\n".join(
-                [f"<div>{docs[doc_id]}</div>" for doc_id in X.document_ids]
+            final_queries = [X.conversation[-1]["content"] for X in samples]
+            with span("context"):
+                prompts = [
+                    self._keyword_prompt(self._stage1_doc_context(X, docs), final_query)
+                    for X, final_query in zip(samples, final_queries)
+                ]
+            with span("keywords"):
+                all_keywords = batch_list_words(self.model, prompts, batch_size=self.batch_size)
+            relevant_segments = [
+                self._search_segments(X, docs, keywords, final_query)
+                for X, keywords, final_query in zip(samples, all_keywords, final_queries)
+            ]
+
+        # Stage 2: Relevancy Check. Samples without any segments drop out here.
+        document_relevant = [len(segments) > 0 for segments in relevant_segments]
+        document_relevant_prob = [None] * len(samples)
+        candidate_idx = [i for i, relevant in enumerate(document_relevant) if relevant]
+        if self.use_gt_doc_relevancy:
+            for i in candidate_idx:
+                document_relevant[i] = labels[i].document_relevant
+        elif self.strict:
+            strict_relevant, strict_prob = self._batch_affirmative(
+                [self._relevancy_prompt(samples[i], relevant_segments[i]) for i in candidate_idx]
+            )
+            for i, relevant, probability in zip(candidate_idx, strict_relevant, strict_prob):
+                document_relevant[i] = relevant
+                document_relevant_prob[i] = probability
+
+        # Stage 3: Response Generation for the samples that are still relevant
+        relevant_idx = [i for i, relevant in enumerate(document_relevant) if relevant]
+        with span("generation"):
+            answers = self._generate_batch(
+                [self._response_prompt(samples[i], relevant_segments[i]) for i in relevant_idx]
+            )
+
+        Y_hat = [
+            Label(
+                document_relevant=relevant,
+                segments=None,
+                answer=None,
+                document_relevant_prob=probability,
             )
-            return self._run_ours_approach(X, docs, start, doc_context, Y)
+            for relevant, probability in zip(document_relevant, document_relevant_prob)
+        ]
+        for i, answer in zip(relevant_idx, answers):
+            Y_hat[i].answer = answer
+            Y_hat[i].segments = self._find_verbatim_segments(
+                samples[i], answer, docs, relevant_segments[i]
+            )
+        return Y_hat
+
+    def batch_call(
+        self, samples: List[Sample], docs: Dict[str, str], labels: Optional[List[Label]] = None
+    ) -> List[Label]:
+        """
+        Batched version of `__call__`. Each stage runs over the whole batch at once, and the
+        prompts of a stage are sent to the model as padded batches of `self.batch_size`.
+        Samples that branch differently (e.g. no relevant segments in Stage 1) skip the later stages.
+
+        Args:
+            samples (List[Sample]): The input samples
+            docs (Dict[str, str]): A dictionary of document ids to their corresponding text
+            labels (List[Label], optional): The ground truth labels, required for the ablation flags. Defaults to None.
+
+        Returns:
+            List[Label]: The generated responses, in the same order as `samples`. `time_taken` is the
+            wall-clock time of the whole batch divided by the number of samples.
+        """
+        if not samples:
+            return []
+        if labels is None:
+            labels = [None] * len(samples)
+
+        start = time.time()
+        with trace() as spans:
+            if self.llm_only:
+                Y_hat = self._run_llm_only_approach_batch(samples, docs)
+            else:
+                Y_hat = self._run_ours_approach_batch(samples, docs, labels)
+
+        time_taken = (time.time() - start) / len(samples)
+        for X, y_hat in zip(samples, Y_hat):
+            y_hat.time_taken = time_taken
+            y_hat.spans = list(spans)
+            self._record_dropped_context(X, docs, y_hat)
+        return Y_hat
+
+    def _stage_prepare(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """CPU stage of `pipelined_call` run before any model call: contexts and query entities."""
+        state["start"] = time.time()
+        state["spans"] = []
+        X = state["X"]
+        if not self.llm_only and not self.use_gt_segments and self.stage1 == "keywords":
+            state["final_query"] = X.conversation[-1]["content"]
+            with trace(state["spans"]):
+                with span("context"):
+                    state["doc_context"] = self._stage1_doc_context(X, state["docs"])
+                # Warms the entity cache used by _search_segments
+                with span("ner"):
+                    self.ner.entities(state["final_query"])
+        return state
+
+    def _stage_keywords(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """Model stage of `pipelined_call`: the Stage 1 keyword LLM call."""
+        if "final_query" in state:
+            with self._model_lock, trace(state["spans"]), span("keywords"):
+                state["keywords"] = list_words(
+                    self.model, self._keyword_prompt(state["doc_context"], state["final_query"])
+                )
+        return state
+
+    def _stage_segments(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """CPU stage of `pipelined_call`: keyword (or ranked) search and near-duplicate removal."""
+        with trace(state["spans"]):
+            if "keywords" in state:
+                state["relevant_segments"] = self._search_segments(
+                    state["X"], state["docs"], state["keywords"], state["final_query"]
+                )
+            elif not self.llm_only and not self.use_gt_segments:
+                state["relevant_segments"] = self._ranked_segments(state["X"], state["docs"])
+        return state
+
+    def _stage_answer(self, state: Dict[str, Any]) -> Label:
+        """Model stage of `pipelined_call`: relevancy check and response generation."""
+        X, docs, Y, start = state["X"], state["docs"], state["Y"], state["start"]
+        with self._model_lock, trace(state["spans"]):
+            if self.llm_only:
+                y_hat = self._run_llm_only_approach(X, docs, start)
+            else:
+                if self.use_gt_segments:
+                    relevant_segments = Y.segments or []
+                else:
+                    relevant_segments = state["relevant_segments"]
+                y_hat = self._run_ours_stages_2_3(X, docs, start, relevant_segments, Y)
+        y_hat.spans = state["spans"]
+        return self._record_dropped_context(X, docs, y_hat)
+
+    def pipelined_call(
+        self,
+        samples: List[Sample],
+        docs: Dict[str, str],
+        labels: Optional[List[Label]] = None,
+        max_queue_size: int = 4,
+        cpu_workers: int = 2,
+    ) -> Iterator[Label]:
+        """
+        Run `__call__` over many samples, overlapping the CPU work with the model calls.
+
+        The samples go through a StagePipeline of CPU stages (contexts and NER, then keyword search
+        and deduplication) and model stages (keyword LLM call, then relevancy check and generation).
+        The model stages share a lock so only one of them uses the model at a time, while the CPU
+        stages already work on the next `max_queue_size` samples. The pipeline's per-stage metrics
+        are kept in `self.pipeline_metrics`.
+
+        Args:
+            samples (List[Sample]): The input samples
+            docs (Dict[str, str]): A dictionary of document ids to their corresponding text
+            labels (List[Label], optional): The ground truth labels, required for the ablation flags. Defaults to None.
+            max_queue_size (int): Capacity of the queue in front of each stage
+            cpu_workers (int): Number of threads of each CPU stage
+
+        Yields:
+            Label: The generated response of every sample, in order. `time_taken` runs from the
+            start of the sample's first stage to the end of its last one.
+        """
+        if labels is None:
+            labels = [None] * len(samples)
+
+        pipeline = StagePipeline(
+            [
+                Stage("prepare", self._stage_prepare, workers=cpu_workers),
+                Stage("keywords", self._stage_keywords),
+                Stage("segments", self._stage_segments, workers=cpu_workers),
+                Stage("answer", self._stage_answer),
+            ],
+            max_queue_size=max_queue_size,
+        )
+        self.pipeline_metrics = pipeline.metrics
+        items = ({"X": X, "docs": docs, "Y": Y} for X, Y in zip(samples, labels))
+        yield from pipeline.run(items)
+
+    def load_sentence_index(self, sentence_index: SentenceIndex) -> None:
+        """Use a prebuilt sentence index (e.g. `Dataset.sentence_index`) for the keyword search."""
+        self.sentence_index = sentence_index
+
+    def _get_sentence_index(self, docs: Dict[str, str]) -> SentenceIndex:
+        if self.sentence_index is None or self.sentence_index.docs is not docs:
+            self.sentence_index = SentenceIndex(docs)
+        return self.sentence_index
+
+    def load_bm25_index(self, bm25_index: BM25Index) -> None:
+        """Use a prebuilt BM25 index (e.g. `Dataset.bm25_index`) for the "bm25" Stage 1."""
+        self.bm25_index = bm25_index
+
+    def _get_bm25_index(self, docs: Dict[str, str]) -> BM25Index:
+        if self.bm25_index is None or self.bm25_index.sentence_index.docs is not docs:
+            self.bm25_index = BM25Index(self._get_sentence_index(docs))
+        return self.bm25_index
+
+    def load_dense_index(self, dense_index: DenseIndex, emb_model: Any) -> None:
+        """Use a sentence-window embedding index, and the model that built it, for the "dense" Stage 1."""
+        self.dense_index = dense_index
+        self.emb_model = emb_model
 
     def load_summary_trees(self, summary_trees_fp: str) -> None:
         self.summary_trees = {
@@ -288,3 +709,22 @@ class ConvRef:
                     {k: v.to_dict() for k, v in summary_trees.items()}, f, indent=4
                 )
         self.summary_trees = summary_trees
+
+    def use_context_budget(self, max_tokens: int) -> None:
+        """Pack the documents of every prompt into `max_tokens` model tokens. See ContextPacker."""
+        self.context_packer = ContextPacker(self.model.count_tokens, max_tokens)
+
+    def use_history_policy(self, policy: str, last_k: int = 6, max_tokens: int = 1024) -> None:
+        """Limit the conversation sent with the llm-only and response prompts. See HistoryPolicy."""
+        self.history_policy = HistoryPolicy(policy, self.model, last_k=last_k, max_tokens=max_tokens)
+
+    def use_tree_retrieval(
+        self, docs: Dict[str, str], emb_model: Any = None, top_k: int = 2
+    ) -> None:
+        """Limit Stage 1 (and so the Stage 3 excerpts) to the document chunks selected by descending
+        the summary trees, which must be loaded or generated first. See TreeRetriever."""
+        if self.summary_trees is None:
+            raise ValueError("Summary trees must be loaded before using tree retrieval.")
+        self.tree_retriever = TreeRetriever(
+            self.summary_trees, docs, emb_model, top_k=top_k, model_lock=self._model_lock
+        )
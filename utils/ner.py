@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+from typing import Iterable, List
+
+# Components of the en_core_web_* pipelines that NER does not need. Their ner component has its own
+# internal tok2vec layer, so the shared tok2vec can be excluded too.
+NON_NER_COMPONENTS = ["tok2vec", "tagger", "parser", "attribute_ruler", "lemmatizer", "senter"]
+
+
+class EntityExtractor:
+    """Named entity extraction with spaCy, loaded on first use with only the NER component.
+
+    Entities are cached per text in a bounded LRU, and `prefetch` computes them for many texts at once
+    with `nlp.pipe`.
+
+    Args:
+        model (str): Name of the spaCy pipeline to load
+        max_cached (int): Number of texts whose entities are kept in memory
+    """
+
+    def __init__(self, model: str = "en_core_web_lg", max_cached: int = 4096) -> None:
+        self.model = model
+        self.max_cached = max_cached
+        self._nlp = None
+        self._load_lock = threading.Lock()
+        self._cache: "OrderedDict[str, List[str]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    @property
+    def nlp(self):
+        # Locked so concurrent first uses (e.g. from pipelined stages) load the model only once
+        with self._load_lock:
+            if self._nlp is None:
+                import spacy
+
+                self._nlp = spacy.load(self.model, exclude=NON_NER_COMPONENTS)
+        return self._nlp
+
+    def _store(self, text: str, entities: List[str]) -> None:
+        with self._cache_lock:
+            self._cache[text] = entities
+            self._cache.move_to_end(text)
+            if len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+
+    def entities(self, text: str) -> List[str]:
+        """Return the text of every entity in `text`."""
+        with self._cache_lock:
+            if text in self._cache:
+                self._cache.move_to_end(text)
+                return self._cache[text]
+        entities = [ent.text for ent in self.nlp(text).ents]
+        self._store(text, entities)
+        return entities
+
+    def prefetch(self, texts: Iterable[str], n_process: int = 1, batch_size: int = 256) -> None:
+        """Compute and cache the entities of all `texts` in batches (optionally across processes).
+        Only the last `max_cached` texts stay cached, so prefetch at most that many at a time."""
+        with self._cache_lock:
+            texts = [text for text in dict.fromkeys(texts) if text not in self._cache]
+        for text, doc in zip(
+            texts, self.nlp.pipe(texts, n_process=n_process, batch_size=batch_size)
+        ):
+            self._store(text, [ent.text for ent in doc.ents])
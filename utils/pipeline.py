@@ -0,0 +1,149 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+
+_DONE = object()  # Sentinel telling a stage's workers there is no more input
+
+
+@dataclass
+class Stage:
+    """One step of a StagePipeline.
+
+    Args:
+        name: Name used in the metrics
+        fn: Function applied to every item, its output is the input of the next stage
+        workers: Number of threads running `fn` concurrently
+    """
+
+    name: str
+    fn: Callable[[Any], Any]
+    workers: int = 1
+
+
+@dataclass
+class StageMetrics:
+    items: int = 0
+    busy_time: float = 0.0  # Total seconds spent in the stage function, summed over workers
+    max_queue_depth: int = 0
+    queue_depth_samples: List[int] = field(default_factory=list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        samples = self.queue_depth_samples
+        return {
+            "items": self.items,
+            "busy_time": self.busy_time,
+            "max_queue_depth": self.max_queue_depth,
+            "mean_queue_depth": sum(samples) / len(samples) if samples else 0.0,
+        }
+
+
+class StagePipeline:
+    """Runs items through a sequence of stages, with each stage in its own worker threads.
+
+    Consecutive stages are connected by bounded queues, so while a model stage works on item i the
+    CPU stages can already work on items i+1..i+k (k = `max_queue_size`) without running ahead
+    unboundedly. Results are yielded in the order of the input items, and exceptions raised by a stage
+    are re-raised in the caller.
+
+    Args:
+        stages: The stages, in order
+        max_queue_size: Capacity of the queue in front of each stage
+    """
+
+    def __init__(self, stages: List[Stage], max_queue_size: int = 4) -> None:
+        self.stages = stages
+        self.max_queue_size = max_queue_size
+        self.metrics = {stage.name: StageMetrics() for stage in stages}
+        self._metrics_lock = threading.Lock()
+        self._finished_workers = [0] * len(stages)
+
+    def _put(self, stage: Stage, inbox: queue.Queue, entry: Any) -> None:
+        """Put an entry in the queue in front of `stage`, recording the queue depth."""
+        inbox.put(entry)
+        depth = inbox.qsize()
+        with self._metrics_lock:
+            metrics = self.metrics[stage.name]
+            metrics.queue_depth_samples.append(depth)
+            metrics.max_queue_depth = max(metrics.max_queue_depth, depth)
+
+    def _worker(self, k: int, queues: List[queue.Queue], results: queue.Queue, errors: List) -> None:
+        stage = self.stages[k]
+        metrics = self.metrics[stage.name]
+        inbox = queues[k]
+        while True:
+            entry = inbox.get()
+            if entry is _DONE:
+                break
+
+            i, item = entry
+            # After an error the remaining items are only drained, so every thread still finishes
+            if not errors:
+                start = time.time()
+                try:
+                    item = stage.fn(item)
+                except BaseException as e:
+                    errors.append(e)
+                with self._metrics_lock:
+                    metrics.items += 1
+                    metrics.busy_time += time.time() - start
+
+            if k + 1 < len(self.stages):
+                self._put(self.stages[k + 1], queues[k + 1], (i, item))
+            else:
+                results.put((i, item))
+
+        # Let the other workers of this stage see the end of input too, and the last one to finish
+        # forwards it to the next stage once everything it received has been passed on.
+        inbox.put(_DONE)
+        with self._metrics_lock:
+            self._finished_workers[k] += 1
+            last_worker = self._finished_workers[k] == stage.workers
+        if last_worker and k + 1 < len(self.stages):
+            queues[k + 1].put(_DONE)
+
+    def run(self, items: Iterable[Any]) -> Iterator[Any]:
+        """Yield the output of the last stage for every item, in the order of `items`."""
+        queues = [queue.Queue(maxsize=self.max_queue_size) for _ in self.stages]
+        results = queue.Queue()
+        errors: List[BaseException] = []
+        self._finished_workers = [0] * len(self.stages)
+
+        for k, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                threading.Thread(
+                    target=self._worker, args=(k, queues, results, errors), daemon=True
+                ).start()
+
+        # Feed the first stage from its own thread, since putting in a full queue blocks
+        n_items = []
+
+        def feed() -> None:
+            n = 0
+            try:
+                for n, item in enumerate(items, 1):
+                    self._put(self.stages[0], queues[0], (n - 1, item))
+            except BaseException as e:
+                errors.append(e)
+            n_items.append(n)
+            queues[0].put(_DONE)
+
+        threading.Thread(target=feed, daemon=True).start()
+
+        # Several workers per stage can finish items out of order, so buffer until the next one is done
+        pending = {}
+        next_i = 0
+        while not n_items or next_i < n_items[0]:
+            try:
+                i, item = results.get(timeout=0.1)
+            except queue.Empty:
+                if errors:
+                    raise errors[0]
+                continue
+            if errors:
+                raise errors[0]
+            pending[i] = item
+            while next_i in pending:
+                yield pending.pop(next_i)
+                next_i += 1
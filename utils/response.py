@@ -1,20 +1,50 @@
 from typing import Any, List, Dict
 
-def affirmative_resp(model: Any, history: List[Dict[str, str]]) -> bool:
+from .llm.backend import LLMBackend
+
+def _parse_affirmative(response: str) -> bool:
+    response = response.upper()
+    return "NO" not in response and "YES" in response
+
+def _parse_words(response: str) -> List[str]:
+    return [v.strip() for v in response.lower().split(",")]
+
+def affirmative_resp(model: LLMBackend, history: List[Dict[str, str]]) -> bool:
     history[-1]["content"] += " Answer \"YES\" or \"NO\" only."
 
-    outputs = model(history, max_new_tokens=10)
-    response = outputs[0]["generated_text"][-1]["content"].upper()
+    return _parse_affirmative(model.generate(history, max_new_tokens=10))
 
-    return "NO" not in response and "YES" in response
+def batch_affirmative_resp(model: LLMBackend, histories: List[List[Dict[str, str]]], batch_size: int = 8) -> List[bool]:
+    """Batched version of `affirmative_resp`. The histories are sent to the model as padded batches of `batch_size`."""
+    for history in histories:
+        history[-1]["content"] += " Answer \"YES\" or \"NO\" only."
 
-def list_words(model: Any, history: List[Dict[str, str]]) -> bool:
+    responses = model.batch_generate(histories, max_new_tokens=10, batch_size=batch_size)
+    return [_parse_affirmative(response) for response in responses]
+
+def affirmative_prob(model: LLMBackend, history: List[Dict[str, str]]) -> float:
+    """Probability that the model answers YES, from one forward pass instead of generating tokens."""
+    return batch_affirmative_prob(model, [history], batch_size=1)[0]
+
+def batch_affirmative_prob(model: LLMBackend, histories: List[List[Dict[str, str]]], batch_size: int = 8) -> List[float]:
+    """Batched version of `affirmative_prob`."""
+    for history in histories:
+        history[-1]["content"] += " Answer \"YES\" or \"NO\" only."
+
+    return model.yes_no_probabilities(histories, batch_size=batch_size)
+
+def list_words(model: LLMBackend, history: List[Dict[str, str]]) -> List[str]:
     history[-1]["content"] += " Respond with a comma-seperated list only. Do not include anything else in your response."
 
-    outputs = model(history, max_new_tokens=256)
-    response = outputs[0]["generated_text"][-1]["content"].lower().split(",")
+    return _parse_words(model.generate(history, max_new_tokens=256))
+
+def batch_list_words(model: LLMBackend, histories: List[List[Dict[str, str]]], batch_size: int = 8) -> List[List[str]]:
+    """Batched version of `list_words`. The histories are sent to the model as padded batches of `batch_size`."""
+    for history in histories:
+        history[-1]["content"] += " Respond with a comma-seperated list only. Do not include anything else in your response."
 
-    return [v.strip() for v in response]
+    responses = model.batch_generate(histories, max_new_tokens=256, batch_size=batch_size)
+    return [_parse_words(response) for response in responses]
 
 def resp_to_kg(output: str, entities_to_id: Dict[str, int], relations_to_id: Dict[str, int], id_to_entities: Dict[str, int], id_to_relations: Dict[str, int], update_mapping: bool) -> List[List[str]]:
     # Filter out incorrectly formatted.
@@ -37,7 +67,7 @@ def resp_to_kg(output: str, entities_to_id: Dict[str, int], relations_to_id: Dic
 
     return [[entities_to_id[edge[0]], relations_to_id[edge[1]], entities_to_id[edge[2]]] for edge in response if edge[0] in entities_to_id and edge[2] in entities_to_id and edge[1] in relations_to_id]
 
-def segments_to_edges(model: Any, segments: List[str], entities_to_id: Dict[str, int], relations_to_id: Dict[str, int], id_to_entities: Dict[str, int], id_to_relations: Dict[str, int], edge_to_excerpt: Dict[str, List[str]]) -> List[List[str]]:
+def segments_to_edges(model: LLMBackend, segments: List[str], entities_to_id: Dict[str, int], relations_to_id: Dict[str, int], id_to_entities: Dict[str, int], id_to_relations: Dict[str, int], edge_to_excerpt: Dict[str, List[str]]) -> List[List[str]]:
     # Convert to edges.
     excerpts = [f"<div>{doc}</div>" for doc in segments]
     all_edges = []
@@ -56,14 +86,14 @@ Entities:
 Relations:
 {rel_lst}
         """.strip()
-        outputs = model([
+        output = model.generate([
             {
                 "role": "user",
                 "content": prompt,
             }
         ], max_new_tokens=256)
         edges = resp_to_kg(
-            outputs[0]["generated_text"][-1]["content"],
+            output,
             entities_to_id,
             relations_to_id,
             id_to_entities,
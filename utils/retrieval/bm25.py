@@ -0,0 +1,117 @@
+import re
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+from scipy import sparse
+
+from .sentence_index import SentenceIndex
+from .text import STOPWORDS
+
+TOKEN = re.compile(r"[a-z0-9']+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens of `text` without stopwords."""
+    return [token for token in TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """Okapi BM25 index over the sentence windows of every document.
+
+    The retrieval units are the same sentence windows the keyword search returns (a sentence with the
+    one before and after it). Their BM25 term weights are precomputed into one CSR matrix with a row
+    per window, so scoring a query against the windows of some documents is a single sparse
+    matrix-vector product over their (contiguous) rows.
+
+    Args:
+        sentence_index: Sentence index of the documents (e.g. `Dataset.sentence_index`)
+        k1: BM25 term frequency saturation
+        b: BM25 length normalization
+    """
+
+    def __init__(self, sentence_index: SentenceIndex, k1: float = 1.5, b: float = 0.75) -> None:
+        self.sentence_index = sentence_index
+        self.k1 = k1
+        self.b = b
+
+        self.vocabulary: Dict[str, int] = {}
+        self.doc_ids = list(sentence_index.docs)
+        self._doc_rows: Dict[str, range] = {}
+        indptr, indices, counts = [0], [], []
+        for doc_id in self.doc_ids:
+            start = len(indptr) - 1
+            for window in sentence_index[doc_id].windows():
+                for token, count in Counter(tokenize(window)).items():
+                    indices.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+                    counts.append(count)
+                indptr.append(len(indices))
+            self._doc_rows[doc_id] = range(start, len(indptr) - 1)
+
+        indptr = np.asarray(indptr, dtype=np.int64)
+        indices = np.asarray(indices, dtype=np.int32)
+        tf = np.asarray(counts, dtype=np.float32)
+        n_windows = len(indptr) - 1
+
+        # Inverse document frequency of every term, with windows as the "documents" of BM25
+        df = np.bincount(indices, minlength=len(self.vocabulary))
+        self.idf = np.log1p((n_windows - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+        # Summed per row with bincount, which (unlike reduceat) handles windows without any term
+        rows = np.repeat(np.arange(n_windows), np.diff(indptr))
+        lengths = np.bincount(rows, weights=tf, minlength=n_windows).astype(np.float32)
+        avg_length = lengths.mean() if n_windows else 0.0
+        norm = self.k1 * (1 - self.b + self.b * lengths / max(avg_length, 1e-12))
+        row_norm = np.repeat(norm, np.diff(indptr))
+        weights = self.idf[indices] * tf * (self.k1 + 1) / (tf + row_norm)
+
+        self.weights = sparse.csr_matrix(
+            (weights, indices, indptr), shape=(n_windows, len(self.vocabulary))
+        )
+
+    def __len__(self) -> int:
+        return self.weights.shape[0]
+
+    def query_vector(self, query: str, weight: float = 1.0, vector: Optional[np.ndarray] = None) -> np.ndarray:
+        """Add the terms of `query` (weighted by `weight`) to a dense query vector over the vocabulary."""
+        if vector is None:
+            vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for token, count in Counter(tokenize(query)).items():
+            if token in self.vocabulary:
+                vector[self.vocabulary[token]] += weight * count
+        return vector
+
+    def search(self, doc_ids: List[str], query_vector: np.ndarray, top_k: int = 10) -> List[str]:
+        """
+        Find the sentence windows of the documents that score highest for the query.
+
+        Args:
+            doc_ids: The documents to search
+            query_vector: Query built with `query_vector`
+            top_k: Maximum number of windows returned
+
+        Returns:
+            The windows with a positive score, best first (ties keep document order)
+        """
+        ranges = [self._doc_rows[doc_id] for doc_id in doc_ids]
+        rows = np.concatenate([np.arange(r.start, r.stop) for r in ranges]) if ranges else []
+        if len(rows) == 0 or not query_vector.any():
+            return []
+
+        scores = self.weights[rows] @ query_vector
+        top = np.flatnonzero(scores > 0)
+        if len(top) > top_k:
+            # Keep everything tied with the k-th best score so ties are broken by position below
+            kth_score = -np.partition(-scores[top], top_k - 1)[top_k - 1]
+            top = top[scores[top] >= kth_score]
+        top = top[np.lexsort((top, -scores[top]))][:top_k]
+
+        # Map the matrix rows back to (document, sentence)
+        offsets = np.cumsum([0] + [len(r) for r in ranges])
+        windows = []
+        for i in top:
+            doc_pos = int(np.searchsorted(offsets, i, side="right")) - 1
+            windows.append(
+                self.sentence_index[doc_ids[doc_pos]].window(int(i - offsets[doc_pos]))
+            )
+        return windows
@@ -0,0 +1,129 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+from .sentence_index import SENTENCE_SPLIT
+from .text import content_words
+
+FAQ_SEPARATOR = "\n\n"  # Separates the entries of the MultiWOZ FAQ documents (and paragraphs)
+
+
+class _Units:
+    """A document split into the units the packer keeps or drops whole."""
+
+    __slots__ = ("texts", "separator", "tokens", "words")
+
+    def __init__(self, text: str, count_tokens: Callable[[str], int]) -> None:
+        if FAQ_SEPARATOR in text:
+            self.separator = FAQ_SEPARATOR
+            self.texts = [unit for unit in text.split(FAQ_SEPARATOR) if unit.strip()]
+        else:
+            self.separator = " "
+            self.texts = [unit for unit in SENTENCE_SPLIT.split(text) if unit.strip()]
+        self.tokens = [count_tokens(unit) for unit in self.texts]
+        self.words = [set(content_words(unit)) for unit in self.texts]
+
+
+class ContextPacker:
+    """Fits the documents of a sample into a token budget, keeping the parts most related to the conversation.
+
+    Documents are split into FAQ entries (or paragraphs) when they have blank lines and into sentences
+    otherwise. If everything fits the documents are left untouched. Otherwise units are ranked by their
+    word overlap with the conversation, then by the overlap of their whole document, and added greedily
+    while they fit. The kept units stay in document order, and documents left without any unit are
+    dropped from the context.
+
+    Args:
+        count_tokens: Function counting the tokens of a text (e.g. `LLMBackend.count_tokens`)
+        max_tokens: Token budget of all the documents together
+        max_cached: Number of split documents (and packings) kept in memory
+    """
+
+    def __init__(
+        self, count_tokens: Callable[[str], int], max_tokens: int, max_cached: int = 4096
+    ) -> None:
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.max_cached = max_cached
+        self._units: "OrderedDict[str, _Units]" = OrderedDict()
+        self._packs: "OrderedDict[Tuple, Tuple[Dict[str, str], Dict[str, int]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.packed = 0
+        self.truncated = 0
+
+    def _split(self, text: str) -> _Units:
+        if text in self._units:
+            self._units.move_to_end(text)
+            return self._units[text]
+        units = self._units[text] = _Units(text, self.count_tokens)
+        if len(self._units) > self.max_cached:
+            self._units.popitem(last=False)
+        return units
+
+    def pack(self, texts: Dict[str, str], query: str) -> Tuple[Dict[str, str], Dict[str, int]]:
+        """
+        Pack the documents into the token budget.
+
+        Args:
+            texts: Mapping from document id to text, in the order they appear in the prompt
+            query: Text of the conversation the documents are ranked against
+
+        Returns:
+            Tuple of the packed texts (same order, documents with nothing kept are left out) and the
+            number of tokens dropped from each document that lost any
+        """
+        key = (tuple(texts.items()), query)
+        with self._lock:
+            if key in self._packs:
+                self._packs.move_to_end(key)
+                return self._packs[key]
+
+            self.packed += 1
+            split = {doc_id: self._split(text) for doc_id, text in texts.items()}
+            if sum(sum(units.tokens) for units in split.values()) <= self.max_tokens:
+                result = (dict(texts), {})
+            else:
+                self.truncated += 1
+                result = self._truncate(split, set(content_words(query)))
+
+            self._packs[key] = result
+            if len(self._packs) > self.max_cached:
+                self._packs.popitem(last=False)
+            return result
+
+    def _truncate(
+        self, split: Dict[str, _Units], query_words: set
+    ) -> Tuple[Dict[str, str], Dict[str, int]]:
+        doc_scores = {
+            doc_id: len(query_words & set().union(*units.words))
+            for doc_id, units in split.items()
+        }
+        candidates: List[Tuple[int, int, int, str, int]] = []
+        for doc_pos, (doc_id, units) in enumerate(split.items()):
+            for unit_pos, words in enumerate(units.words):
+                candidates.append(
+                    (-len(query_words & words), -doc_scores[doc_id], doc_pos, doc_id, unit_pos)
+                )
+        candidates.sort()
+
+        remaining = self.max_tokens
+        kept: Dict[str, List[int]] = {doc_id: [] for doc_id in split}
+        for _, _, _, doc_id, unit_pos in candidates:
+            tokens = split[doc_id].tokens[unit_pos]
+            if tokens <= remaining:
+                kept[doc_id].append(unit_pos)
+                remaining -= tokens
+
+        packed, dropped = {}, {}
+        for doc_id, units in split.items():
+            positions = sorted(kept[doc_id])
+            if positions:
+                packed[doc_id] = units.separator.join(units.texts[i] for i in positions)
+            n_dropped = sum(units.tokens) - sum(units.tokens[i] for i in positions)
+            if n_dropped:
+                dropped[doc_id] = n_dropped
+        return packed, dropped
+
+    def stats(self) -> Dict[str, int]:
+        return {"packed": self.packed, "truncated": self.truncated}
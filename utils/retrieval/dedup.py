@@ -0,0 +1,114 @@
+from collections import Counter
+from dataclasses import dataclass, fields
+from difflib import SequenceMatcher
+from typing import List, Optional
+
+
+@dataclass
+class DedupStats:
+    """Counts of how the (string, kept string) pairs of `remove_near_duplicates` were decided."""
+
+    pairs: int = 0  # Pairs a full all-vs-all comparison would look at
+    exact_matches: int = 0  # Strings dropped because an identical string was already kept
+    skipped_length: int = 0  # Pairs ruled out by the length ratio bound
+    skipped_quick_ratio: int = 0  # Pairs ruled out by the character multiset bound
+    ratio_computed: int = 0  # Pairs that needed a full SequenceMatcher.ratio()
+
+    @property
+    def skipped(self) -> int:
+        return self.pairs - self.ratio_computed
+
+    def add(self, other: "DedupStats") -> None:
+        """Add the counts of `other` to these counts."""
+        for field in fields(self):
+            setattr(self, field.name, getattr(self, field.name) + getattr(other, field.name))
+
+
+def _ratio_bound(matches: int, length: int) -> float:
+    # Same formula as difflib's _calculate_ratio, so the bounds compare exactly like ratio() does
+    return 2.0 * matches / length if length else 1.0
+
+
+def remove_near_duplicates(
+    strings: List[str],
+    similarity_threshold: float = 0.9,
+    stats: Optional[DedupStats] = None,
+) -> List[str]:
+    """
+    Removes near-duplicate strings from a list. Keeps the longest version of each near-duplicate group.
+
+    Gives exactly the same result as comparing every string with every kept string using
+    `SequenceMatcher(None, s, kept).ratio() >= similarity_threshold`, but most pairs are decided by
+    cheap upper bounds of the ratio instead:
+    - identical strings are found with a set lookup,
+    - 2 * min(len) / (len(s) + len(kept)), so only kept strings of similar length are considered,
+    - the character multiset overlap (what `quick_ratio` computes), from cached per-string Counters.
+    The remaining pairs reuse one SequenceMatcher per kept string, so its index is built only once.
+
+    Args:
+        strings (list): A list of strings to process.
+        similarity_threshold (float): The similarity threshold (default is 0.9).
+        stats (DedupStats, optional): Updated with the number of pairs decided by each check.
+
+    Returns:
+        list: A list of unique strings with near-duplicates removed.
+    """
+    # Sort strings by length (longest first) to keep the longest version
+    strings = sorted(strings, key=len, reverse=True)
+    unique_strings = []
+    unique_set = set()
+    counters = []
+    matchers = []
+
+    for s in strings:
+        if stats is not None:
+            stats.pairs += len(unique_strings)
+        if s in unique_set:
+            if stats is not None:
+                stats.exact_matches += 1
+            continue
+
+        # Kept strings are at least as long as s and sorted longest first. The length bound grows as
+        # they get shorter, so the candidates are the kept strings from the first one within the bound.
+        lo, hi = 0, len(unique_strings)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _ratio_bound(len(s), len(s) + len(unique_strings[mid])) < similarity_threshold:
+                lo = mid + 1
+            else:
+                hi = mid
+        first = lo
+        if stats is not None:
+            stats.skipped_length += first
+
+        s_counter = Counter(s)
+        candidates = []
+        for i in range(first, len(unique_strings)):
+            length = len(s) + len(unique_strings[i])
+            bound = _ratio_bound(sum((s_counter & counters[i]).values()), length)
+            if bound < similarity_threshold:
+                if stats is not None:
+                    stats.skipped_quick_ratio += 1
+            else:
+                candidates.append((bound, i))
+
+        # Most likely duplicates first, stop at the first one
+        is_duplicate = False
+        for _, i in sorted(candidates, reverse=True):
+            matcher = matchers[i]
+            matcher.set_seq1(s)
+            if stats is not None:
+                stats.ratio_computed += 1
+            if matcher.ratio() >= similarity_threshold:
+                is_duplicate = True
+                break
+
+        if not is_duplicate:
+            unique_strings.append(s)
+            unique_set.add(s)
+            counters.append(s_counter)
+            matcher = SequenceMatcher(None)
+            matcher.set_seq2(s)
+            matchers.append(matcher)
+
+    return unique_strings
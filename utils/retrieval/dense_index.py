@@ -0,0 +1,159 @@
+import json
+import os
+from typing import Any, Dict, List
+
+import numpy as np
+from tqdm import tqdm
+
+from .sentence_index import SentenceIndex
+
+
+class DenseIndex:
+    """Sentence-window embeddings of every document, stored as a float16 memory-mapped `.npy` file.
+
+    Row i of `<fp>.npy` is the L2-normalized embedding of a sentence window (a sentence with the one
+    before and after it, like the keyword search returns), with the windows of each document in
+    consecutive rows. The sidecar `<fp>.json` records the document ids, the first row of every
+    document and how many rows are already written, which makes `build` resumable.
+
+    The matrix is opened with `mmap_mode="r"`, so loading is zero-copy and processes sharing an index
+    share its pages through the OS page cache instead of each holding a copy.
+
+    Args:
+        fp: Path of the index without extension
+        sentence_index: Sentence index of the documents the index was built from
+    """
+
+    def __init__(self, fp: str, sentence_index: SentenceIndex) -> None:
+        self.fp = fp
+        self.sentence_index = sentence_index
+        with open(f"{fp}.json", "r") as f:
+            sidecar = json.load(f)
+        if sidecar["done"] < sidecar["n_windows"]:
+            raise ValueError(f"Dense index {fp} is incomplete, resume building it first.")
+
+        self.embeddings = np.load(f"{fp}.npy", mmap_mode="r")
+        self._doc_rows = {
+            doc_id: range(start, stop)
+            for doc_id, start, stop in zip(
+                sidecar["doc_ids"], sidecar["offsets"][:-1], sidecar["offsets"][1:]
+            )
+        }
+
+    def __len__(self) -> int:
+        return self.embeddings.shape[0]
+
+    @staticmethod
+    def build(
+        fp: str,
+        sentence_index: SentenceIndex,
+        emb_model: Any,
+        batch_size: int = 256,
+    ) -> None:
+        """
+        Embed every sentence window of the documents of `sentence_index` and write the index to `fp`.
+
+        Windows are embedded in batches of `batch_size` and the sidecar is updated after every batch,
+        so an interrupted build picks up where it stopped when run again.
+
+        Args:
+            fp: Path of the index without extension
+            sentence_index: Sentence index of the documents to embed
+            emb_model: Embedding model with an `encode(texts, task=...)` method
+            batch_size: Number of windows embedded at once
+        """
+        doc_ids = list(sentence_index.docs)
+        offsets = [0]
+        for doc_id in doc_ids:
+            offsets.append(offsets[-1] + len(sentence_index[doc_id]))
+        n_windows = offsets[-1]
+
+        sidecar_fp = f"{fp}.json"
+        sidecar: Dict[str, Any] = {"doc_ids": doc_ids, "offsets": offsets, "n_windows": n_windows, "done": 0}
+        if os.path.exists(sidecar_fp) and os.path.exists(f"{fp}.npy"):
+            with open(sidecar_fp, "r") as f:
+                previous = json.load(f)
+            if previous["doc_ids"] == doc_ids and previous["offsets"] == offsets:
+                sidecar = previous
+
+        def windows(start: int, stop: int) -> List[str]:
+            """Text of the windows in rows start..stop."""
+            doc_pos = int(np.searchsorted(offsets, start, side="right")) - 1
+            texts = []
+            for row in range(start, stop):
+                while row >= offsets[doc_pos + 1]:
+                    doc_pos += 1
+                texts.append(sentence_index[doc_ids[doc_pos]].window(row - offsets[doc_pos]))
+            return texts
+
+        embeddings = None
+        progress = tqdm(total=n_windows, initial=sidecar["done"])
+        while sidecar["done"] < n_windows:
+            start = sidecar["done"]
+            stop = min(start + batch_size, n_windows)
+            batch = np.asarray(emb_model.encode(windows(start, stop), task="retrieval.passage"))
+            batch = batch / np.maximum(np.linalg.norm(batch, axis=1, keepdims=True), 1e-12)
+
+            if embeddings is None:
+                if start == 0:
+                    # The embedding size is only known after the first batch
+                    embeddings = np.lib.format.open_memmap(
+                        f"{fp}.npy", mode="w+", dtype=np.float16, shape=(n_windows, batch.shape[1])
+                    )
+                else:
+                    embeddings = np.load(f"{fp}.npy", mmap_mode="r+")
+            embeddings[start:stop] = batch.astype(np.float16)
+            embeddings.flush()
+
+            # Only record the rows as done once they are on disk
+            sidecar["done"] = stop
+            with open(f"{sidecar_fp}.tmp", "w") as f:
+                json.dump(sidecar, f)
+            os.replace(f"{sidecar_fp}.tmp", sidecar_fp)
+            progress.update(stop - start)
+        progress.close()
+
+        if n_windows == 0:
+            np.save(f"{fp}.npy", np.zeros((0, 0), dtype=np.float16))
+            with open(sidecar_fp, "w") as f:
+                json.dump(sidecar, f)
+
+    def search(self, doc_ids: List[str], query_embedding: np.ndarray, top_k: int = 10) -> List[str]:
+        """
+        Find the sentence windows of the documents most similar to the query (cosine similarity).
+
+        Args:
+            doc_ids: The documents to search
+            query_embedding: Embedding of the query
+            top_k: Number of windows returned
+
+        Returns:
+            The `top_k` most similar windows, best first (ties keep document order)
+        """
+        ranges = [self._doc_rows[doc_id] for doc_id in doc_ids]
+        for doc_id, rows in zip(doc_ids, ranges):
+            if len(rows) != len(self.sentence_index[doc_id]):
+                raise ValueError(f"Dense index {self.fp} was built from a different version of {doc_id}.")
+        if not ranges or sum(len(r) for r in ranges) == 0:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(np.linalg.norm(query), 1e-12)
+        # Only the rows of the sample's documents are read from the memory map
+        scores = np.concatenate(
+            [self.embeddings[r.start : r.stop].astype(np.float32) @ query for r in ranges]
+        )
+        top = np.arange(len(scores))
+        if len(top) > top_k:
+            kth_score = -np.partition(-scores, top_k - 1)[top_k - 1]
+            top = top[scores >= kth_score]
+        top = top[np.lexsort((top, -scores[top]))][:top_k]
+
+        offsets = np.cumsum([0] + [len(r) for r in ranges])
+        windows = []
+        for i in top:
+            doc_pos = int(np.searchsorted(offsets, i, side="right")) - 1
+            windows.append(
+                self.sentence_index[doc_ids[doc_pos]].window(int(i - offsets[doc_pos]))
+            )
+        return windows
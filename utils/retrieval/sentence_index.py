@@ -0,0 +1,141 @@
+import re
+from bisect import bisect_right
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+# Same sentence boundaries as ConvRef._extract_keyword_context
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?]) +")
+
+# Joins the lowercased sentences of a document. Keywords never contain it, so a match can never
+# span two sentences.
+_SEP = "\x00"
+
+
+class DocumentSentences:
+    """Sentence boundaries of one document, with the lowercased text and sentence offsets."""
+
+    __slots__ = ("sentences", "lowered", "starts", "_windows")
+
+    def __init__(self, document: str) -> None:
+        self.sentences = SENTENCE_SPLIT.split(document)
+        # All lowercased sentences joined by _SEP. starts[i] is the offset of sentence i in it.
+        lowered = [sentence.lower() for sentence in self.sentences]
+        self.lowered = _SEP.join(lowered)
+        self.starts = []
+        offset = 0
+        for sentence in lowered:
+            self.starts.append(offset)
+            offset += len(sentence) + len(_SEP)
+        self._windows: Dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.sentences)
+
+    def sentence_at(self, offset: int) -> int:
+        """Index of the sentence containing the character `offset` of `lowered`."""
+        return bisect_right(self.starts, offset) - 1
+
+    def window(self, i: int) -> str:
+        """The sentence before, sentence i and the sentence after, like _extract_keyword_context."""
+        if i in self._windows:
+            return self._windows[i]
+        before = self.sentences[i - 1] if i > 0 else ""
+        after = self.sentences[i + 1] if i < len(self.sentences) - 1 else ""
+        self._windows[i] = f"{before} {self.sentences[i]} {after}".strip()
+        return self._windows[i]
+
+    def windows(self) -> List[str]:
+        return [self.window(i) for i in range(len(self.sentences))]
+
+
+class KeywordMatcher:
+    """Multi-pattern matcher (Aho–Corasick style) finding every keyword in a single pass over a text.
+
+    One scan of a regex alternation over all keywords (run by the C regex engine) reports each
+    position where at least one keyword starts. Keywords are grouped by their first character, so only
+    the few keywords sharing that character are checked at those positions, which also reports
+    overlapping keywords starting at the same position (e.g. "new" and "new york").
+    """
+
+    def __init__(self, keywords: Iterable[str]) -> None:
+        # Unique, lowercased, non-empty keywords in their original order
+        self.keywords = list(
+            dict.fromkeys(
+                k for k in (keyword.strip().lower() for keyword in keywords) if k and _SEP not in k
+            )
+        )
+        self._by_first_char: Dict[str, List[int]] = defaultdict(list)
+        for i, keyword in enumerate(self.keywords):
+            self._by_first_char[keyword[0]].append(i)
+        # Zero-width lookahead so overlapping occurrences are all found
+        self._starts = (
+            re.compile(
+                "(?=(?:"
+                + "|".join(re.escape(k) for k in sorted(self.keywords, key=len, reverse=True))
+                + "))"
+            )
+            if self.keywords
+            else None
+        )
+
+    def finditer(self, text: str) -> Iterable[Tuple[int, int]]:
+        """Yield (keyword index, offset) for every occurrence of every keyword in `text`."""
+        if self._starts is None:
+            return
+        for match in self._starts.finditer(text):
+            pos = match.start()
+            for i in self._by_first_char[text[pos]]:
+                if text.startswith(self.keywords[i], pos):
+                    yield i, pos
+
+
+class SentenceIndex:
+    """Per-document sentence index, built once per document on first use and then reused.
+
+    Args:
+        docs: Mapping from document id to document text (e.g. `Dataset.docs`)
+    """
+
+    def __init__(self, docs: Dict[str, str]) -> None:
+        self.docs = docs
+        self._index: Dict[str, DocumentSentences] = {}
+
+    def __getitem__(self, doc_id: str) -> DocumentSentences:
+        if doc_id not in self._index:
+            self._index[doc_id] = DocumentSentences(self.docs[doc_id])
+        return self._index[doc_id]
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def build(self) -> "SentenceIndex":
+        """Index every document now instead of on first use."""
+        for doc_id in self.docs:
+            self[doc_id]
+        return self
+
+    def find_contexts(self, doc_ids: List[str], keywords: Iterable[str]) -> List[str]:
+        """
+        Find the sentence-window context of every sentence containing any of the keywords.
+
+        Gives the same contexts, in the same order (keyword, then document, then sentence), as calling
+        `ConvRef._extract_keyword_context` for every keyword and document.
+
+        Args:
+            doc_ids: The documents to search
+            keywords: The keywords to search for (case-insensitive)
+
+        Returns:
+            List of contexts, one per (keyword, document, sentence) match
+        """
+        matcher = KeywordMatcher(keywords)
+        hits = set()
+        for doc_pos, doc_id in enumerate(doc_ids):
+            doc = self[doc_id]
+            for keyword_pos, offset in matcher.finditer(doc.lowered):
+                hits.add((keyword_pos, doc_pos, doc.sentence_at(offset)))
+
+        return [
+            self[doc_ids[doc_pos]].window(sentence_pos)
+            for _, doc_pos, sentence_pos in sorted(hits)
+        ]
@@ -0,0 +1,16 @@
+import re
+from typing import List
+
+STOPWORDS = {
+    "a", "about", "after", "all", "also", "an", "and", "any", "are", "as", "at", "be", "been",
+    "before", "but", "by", "can", "could", "did", "do", "does", "for", "from", "had", "has",
+    "have", "he", "her", "him", "his", "how", "i", "if", "in", "into", "is", "it", "its", "me",
+    "my", "no", "not", "of", "on", "or", "our", "she", "so", "than", "that", "the", "their",
+    "them", "then", "there", "they", "this", "to", "was", "we", "were", "what", "when", "where",
+    "which", "who", "why", "will", "with", "would", "you", "your",
+}
+
+
+def content_words(text: str) -> List[str]:
+    """Lowercased words of `text` without stopwords, in order of appearance."""
+    return [w for w in re.findall(r"[a-z0-9']+", text.lower()) if w not in STOPWORDS]
@@ -0,0 +1,203 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ..graph.summary_tree import SummaryTree, TreeNode
+from .sentence_index import SentenceIndex
+from .text import content_words
+
+
+class TreeRetriever:
+    """Selects the chunks of each document that match a conversation by descending its SummaryTree.
+
+    Starting from the root, the children of a node are ranked against the conversation by the keyword
+    overlap with their summary (or chunk text for leaves), or by the cosine similarity of their
+    embeddings when an embedding model is given. The best `top_k` children are followed at every
+    level, and the leaves reached are the selected chunks. A document none of whose top-level children
+    match the conversation is skipped entirely.
+
+    The selected chunks replace the full documents in the Stage 1 prompt, and the keyword search runs
+    over them only, so the Stage 3 excerpts come from them too.
+
+    Args:
+        summary_trees: The SummaryTree of every document (e.g. `ConvRef.summary_trees`)
+        docs: Mapping from document id to document text. Documents without a tree are one chunk.
+        emb_model: Embedding model with an `encode(texts, task=...)` method. None ranks by keyword overlap.
+        top_k: Number of children followed at every level
+        max_cached: Number of selections (and query embeddings) kept in memory
+        model_lock: Lock held around the `emb_model` calls, shared with the other users of the model
+            (e.g. `ConvRef._model_lock`). By default the retriever has its own.
+    """
+
+    def __init__(
+        self,
+        summary_trees: Dict[str, SummaryTree],
+        docs: Dict[str, str],
+        emb_model: Any = None,
+        top_k: int = 2,
+        max_cached: int = 1024,
+        model_lock: Optional[threading.Lock] = None,
+    ) -> None:
+        self.summary_trees = summary_trees
+        self.docs = docs
+        self.emb_model = emb_model
+        self.top_k = top_k
+        self.max_cached = max_cached
+
+        # Every leaf is a chunk with id "<doc id>#<position>", numbered in order of the document
+        self.chunks: Dict[str, str] = {}
+        self._doc_chunks: Dict[str, List[str]] = {}
+        self._leaf_chunk: Dict[int, str] = {}
+        self._untreed_docs = set()
+        for doc_id, doc in docs.items():
+            tree = summary_trees.get(doc_id)
+            leaves = self._leaves(tree.root) if tree is not None and tree.root else []
+            if not leaves:
+                chunk_id = f"{doc_id}#0"
+                self.chunks[chunk_id] = doc
+                self._doc_chunks[doc_id] = [chunk_id]
+                self._untreed_docs.add(doc_id)
+                continue
+            positions = [doc.find(leaf.data) for leaf in leaves]
+            order = sorted(
+                range(len(leaves)),
+                key=lambda i: (positions[i] if positions[i] >= 0 else len(doc), i),
+            )
+            self._doc_chunks[doc_id] = []
+            for k, i in enumerate(order):
+                chunk_id = f"{doc_id}#{k}"
+                self.chunks[chunk_id] = leaves[i].data
+                self._doc_chunks[doc_id].append(chunk_id)
+                self._leaf_chunk[id(leaves[i])] = chunk_id
+        self._chunk_order = {
+            chunk_id: k for chunk_ids in self._doc_chunks.values() for k, chunk_id in enumerate(chunk_ids)
+        }
+        self.sentence_index = SentenceIndex(self.chunks)
+
+        self._node_words: Dict[int, set] = {}
+        self._node_embeddings: Dict[int, np.ndarray] = {}
+        self._query_embeddings: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._selections: "OrderedDict[Tuple[Tuple[str, ...], str], List[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._model_lock = model_lock if model_lock is not None else threading.Lock()
+
+        self.selected_chars = 0
+        self.total_chars = 0
+        self.skipped_documents = 0
+
+    @staticmethod
+    def _leaves(node: TreeNode) -> List[TreeNode]:
+        if not node.children:
+            return [node] if node.data else []
+        return [leaf for child in node.children for leaf in TreeRetriever._leaves(child)]
+
+    def _embed_tree(self, node: TreeNode) -> None:
+        """Embed every node of a tree in one call, the first time one of its nodes is ranked."""
+        nodes, stack = [], [node]
+        while stack:
+            current = stack.pop()
+            nodes.append(current)
+            stack.extend(current.children)
+        with self._model_lock:
+            embeddings = np.asarray(self.emb_model.encode([n.data for n in nodes], task="retrieval.passage"))
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        for n, embedding in zip(nodes, embeddings):
+            self._node_embeddings[id(n)] = embedding
+
+    def _query_embedding(self, query: str) -> np.ndarray:
+        if query not in self._query_embeddings:
+            with self._model_lock:
+                embedding = np.asarray(self.emb_model.encode([query], task="retrieval.query"))[0]
+            self._query_embeddings[query] = embedding / max(np.linalg.norm(embedding), 1e-12)
+            if len(self._query_embeddings) > self.max_cached:
+                self._query_embeddings.popitem(last=False)
+        return self._query_embeddings[query]
+
+    def _scores(self, root: TreeNode, nodes: List[TreeNode], query: str) -> List[float]:
+        if self.emb_model is not None:
+            if id(root) not in self._node_embeddings:
+                self._embed_tree(root)
+            query_embedding = self._query_embedding(query)
+            return [float(self._node_embeddings[id(n)] @ query_embedding) for n in nodes]
+
+        query_words = set(content_words(query))
+        scores = []
+        for n in nodes:
+            if id(n) not in self._node_words:
+                self._node_words[id(n)] = set(content_words(n.data))
+            scores.append(float(len(query_words & self._node_words[id(n)])))
+        return scores
+
+    def _descend(self, root: TreeNode, node: TreeNode, query: str) -> List[str]:
+        """Chunk ids of the leaves reached from `node` by following the best children."""
+        if not node.children:
+            return [self._leaf_chunk[id(node)]] if id(node) in self._leaf_chunk else []
+
+        scores = self._scores(root, node.children, query)
+        ranked = sorted(range(len(node.children)), key=lambda i: -scores[i])
+        selected = [i for i in ranked[: self.top_k] if scores[i] > 0]
+        if not selected and node is not root:
+            # The summary of this node matched, so follow its best children even without overlap
+            selected = ranked[: self.top_k]
+        return [
+            chunk_id for i in selected for chunk_id in self._descend(root, node.children[i], query)
+        ]
+
+    def _select_document(self, doc_id: str, query: str) -> List[str]:
+        if doc_id in self._untreed_docs:  # Documents without a tree are always fully selected
+            return self._doc_chunks[doc_id]
+
+        root = self.summary_trees[doc_id].root
+        if not root.children:  # The whole document is a single chunk
+            return self._doc_chunks[doc_id] if self._scores(root, [root], query)[0] > 0 else []
+        return sorted(set(self._descend(root, root, query)), key=self._chunk_order.get)
+
+    def select(self, doc_ids: List[str], query: str) -> List[str]:
+        """
+        Select the chunks of the documents that match the query.
+
+        Args:
+            doc_ids: The documents of the sample
+            query: Text of the conversation to match (e.g. all user turns)
+
+        Returns:
+            The selected chunk ids, grouped by document in the order of `doc_ids` and in document order
+            within each document. Empty if nothing in any document matches.
+        """
+        key = (tuple(doc_ids), query)
+        with self._lock:
+            if key in self._selections:
+                self._selections.move_to_end(key)
+                return self._selections[key]
+
+            chunk_ids = []
+            for doc_id in doc_ids:
+                selected = self._select_document(doc_id, query)
+                if not selected:
+                    self.skipped_documents += 1
+                chunk_ids.extend(selected)
+
+            # Counted once per distinct selection
+            self.selected_chars += sum(len(self.chunks[c]) for c in chunk_ids)
+            self.total_chars += sum(len(self.docs[doc_id]) for doc_id in doc_ids)
+            self._selections[key] = chunk_ids
+            if len(self._selections) > self.max_cached:
+                self._selections.popitem(last=False)
+            return chunk_ids
+
+    def texts(self, chunk_ids: List[str]) -> Dict[str, str]:
+        """Text of the selected chunks of every document, joined by blank lines like in the document."""
+        by_doc: "OrderedDict[str, List[str]]" = OrderedDict()
+        for chunk_id in chunk_ids:
+            by_doc.setdefault(chunk_id.rsplit("#", 1)[0], []).append(self.chunks[chunk_id])
+        return {doc_id: "\n\n".join(chunks) for doc_id, chunks in by_doc.items()}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "selected_chars": self.selected_chars,
+            "total_chars": self.total_chars,
+            "selected_fraction": self.selected_chars / self.total_chars if self.total_chars else 0.0,
+            "skipped_documents": self.skipped_documents,
+        }
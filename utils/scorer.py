@@ -1,29 +1,30 @@
-import torch
 import os
 import numpy as np
 from tqdm import tqdm
-from typing import Dict, List, Any
-from transformers import pipeline
+from typing import Dict, List, Any, Union
 
+from utils.llm.backend import LLMBackend, load_backend
 from utils.structures import *
 from utils.data.squad_eval import compute_f1
 from utils.constants import ANSWER_DELIM
+from utils.tracing import save_chrome_trace, stage_stats
 
 class Scorer:
     def __init__(
         self,
         fp: str,
-        evaluator: str = "meta-llama/Llama-3.2-1B-Instruct",
+        evaluator: Union[str, LLMBackend] = "meta-llama/Llama-3.2-1B-Instruct",
+        backend: str = "transformers",  # Used when `evaluator` is a model name
+        yes_no_scoring: str = "generate",  # "generate" parses a generated answer, "logits" uses one forward pass
+        batch_size: int = 8,  # Number of consistency judgements per forward pass with "logits" scoring
+        trace: bool = False,  # Also write the spans of the predictions as a Chrome trace, next to the scores
     ) -> None:
-        self.evaluator = pipeline(
-            "text-generation",
-            model=evaluator,
-            torch_dtype=torch.bfloat16,
-            device_map="auto",
-        )
-        self.evaluator.model.generation_config.pad_token_id = (
-            self.evaluator.tokenizer.eos_token_id
-        )
+        if isinstance(evaluator, str):
+            evaluator = load_backend(backend, evaluator)
+        self.evaluator = evaluator
+        self.yes_no_scoring = yes_no_scoring
+        self.batch_size = batch_size
+        self.trace = trace
 
         self.fp = fp
         os.makedirs(self.fp, exist_ok=True)
@@ -88,6 +89,7 @@ class Scorer:
 
     def answer(self, X: List[Sample], Y_hat: List[Label], Y: List[Label]) -> Dict[str, Any]:
         answers = []
+        prompts = []  # (index in answers, prompt) of the answers judged with "logits" scoring
 
         for x, y_hat, y in tqdm(zip(X, Y_hat, Y)):
             if (y.answer == None and y_hat.answer != None) or (y.answer != None and y_hat.answer == None):
@@ -116,8 +118,13 @@ class Scorer:
                     }
                 ]
 
-                outputs = self.evaluator(prompt, max_new_tokens=10)
-                response = outputs[0]["generated_text"][-1]["content"]
+                if self.yes_no_scoring == "logits":
+                    # Judged below, all at once
+                    prompts.append((len(answers), prompt))
+                    answers.append(0)
+                    continue
+
+                response = self.evaluator.generate(prompt, max_new_tokens=10)
                 print(prompt, response)
 
                 if response.startswith("YES"):
@@ -126,6 +133,14 @@ class Scorer:
                     # Consider as answered incorrectly
                     answers.append(0)
 
+        if prompts:
+            probabilities = self.evaluator.yes_no_probabilities(
+                [prompt for _, prompt in prompts], batch_size=self.batch_size
+            )
+            for (i, prompt), probability in zip(prompts, probabilities):
+                print(prompt, probability)
+                answers[i] = int(probability >= 0.5)
+
         return {
             "accuracy": np.mean(answers),
             "values": answers,
@@ -140,18 +155,26 @@ class Scorer:
             "time": {
                 "average": np.mean(time),
                 "standard_deviation": np.std(time),
-            }
+            },
+            "stages": stage_stats(Y_hat),
         }
         for k, v in scores.items():
             if k == "time":
                 print(k, round(v['average'], 3), f"(± {round(v['standard_deviation'], 3)})")
+            elif k == "stages":
+                print(k)
+                for stage, stats in v.items():
+                    print(
+                        f"  {stage:<30} n={stats['count']:<6} p50={stats['p50'] * 1000:.1f}ms "
+                        f"p90={stats['p90'] * 1000:.1f}ms p99={stats['p99'] * 1000:.1f}ms"
+                    )
             else:
-                metric_name = 'f1'
-                metric = v.get(metric_name, None)
-                if not metric:
-                    metric_name = 'accuracy'
-                    metric = v.get(metric_name, None) * 100
+                # Relevance has no accuracy, and an F1 of 0.0 is still the metric to print
+                metric_name = 'f1' if 'f1' in v else 'accuracy'
+                metric = v[metric_name] if metric_name == 'f1' else v[metric_name] * 100
                 print(k, metric_name, metric)
 
         with open(os.path.join(save), "w") as f:
             json.dump(scores, f, indent=4)
+        if self.trace:
+            save_chrome_trace(Y_hat, os.path.splitext(save)[0] + "_trace.json")
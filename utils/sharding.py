@@ -0,0 +1,89 @@
+import os
+import subprocess
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Sequence
+
+from .journal import PredictionJournal
+from .structures import Label, Sample
+
+
+def conversation_key(x: Sample) -> Hashable:
+    """Identifies the conversation of a sample, so all its turns go to the same shard."""
+    if x.conversation_id is not None:
+        return x.conversation_id
+    # Older files store the conversation in every sample, whose first message is the same for all its turns
+    return tuple(x.document_ids), x.conversation[0]["content"] if len(x.conversation) else ""
+
+
+def shard_indices(X: Sequence[Sample], num_shards: int, shard_id: int) -> List[int]:
+    """
+    Indices of the samples of shard `shard_id` out of `num_shards`, in order.
+
+    Samples are partitioned by conversation, so the caches shared across the turns of a conversation
+    (history summaries, prompt prefixes) stay in one process. Conversations are assigned largest
+    first to the shard with the fewest samples so far, which only depends on `X`, so every process
+    computes the same partition.
+    """
+    if not 0 <= shard_id < num_shards:
+        raise ValueError(f"Shard id {shard_id} is not in 0..{num_shards - 1}.")
+    conversations: "OrderedDict[Hashable, List[int]]" = OrderedDict()
+    for i, x in enumerate(X):
+        conversations.setdefault(conversation_key(x), []).append(i)
+
+    loads = [0] * num_shards
+    indices = []
+    # Stable sort, so conversations of the same size keep the order of their first sample
+    for members in sorted(conversations.values(), key=len, reverse=True):
+        shard = min(range(num_shards), key=lambda k: loads[k])
+        loads[shard] += len(members)
+        if shard == shard_id:
+            indices.extend(members)
+    return sorted(indices)
+
+
+def shard_journal_fp(fp: str, prefix: str, num_shards: int, shard_id: int) -> str:
+    return os.path.join(fp, f"{prefix}Y_hat.shard{shard_id}of{num_shards}.jsonl")
+
+
+def incomplete_shards(fp: str, prefix: str, X: Sequence[Sample], num_shards: int) -> List[int]:
+    """Shards whose journal is missing predictions of some of their samples."""
+    missing = []
+    for shard_id in range(num_shards):
+        journal_fp = shard_journal_fp(fp, prefix, num_shards, shard_id)
+        indices = shard_indices(X, num_shards, shard_id)
+        if not os.path.exists(journal_fp):
+            done = set()
+        else:
+            with PredictionJournal(journal_fp) as journal:
+                done = set(journal.labels)
+        if any(i not in done for i in indices):
+            missing.append(shard_id)
+    return missing
+
+
+def launch_shards(command: List[str], shard_ids: List[int], env: Optional[Dict[str, str]] = None) -> None:
+    """
+    Run `command --shard_id k` for every shard k of `shard_ids` in parallel local processes, and wait for them.
+
+    Raises:
+        RuntimeError: If a shard process fails (the others are still waited for, their journals are kept)
+    """
+    processes = {k: subprocess.Popen(command + ["--shard_id", str(k)], env=env) for k in shard_ids}
+    failed = [k for k, process in processes.items() if process.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} failed, run the experiment again to resume them.")
+
+
+def merge_shards(fp: str, prefix: str, n: int, num_shards: int) -> List[Label]:
+    """
+    Merge the shard journals into `Y_hat.json` (and the journal of the whole run) in the original order.
+
+    Returns:
+        The predictions of samples 0..n-1
+    """
+    with PredictionJournal(os.path.join(fp, f"{prefix}Y_hat.jsonl")) as merged:
+        for shard_id in range(num_shards):
+            with PredictionJournal(shard_journal_fp(fp, prefix, num_shards, shard_id)) as journal:
+                for i in sorted(journal.labels):
+                    merged.append(i, journal.labels[i])
+        return merged.compact(os.path.join(fp, f"{prefix}Y_hat.json"), n)
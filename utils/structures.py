@@ -1,7 +1,10 @@
 import json
-from dataclasses import asdict, dataclass, is_dataclass
+import sys
+from collections.abc import Sequence
+from dataclasses import asdict, dataclass, field, is_dataclass
 from enum import Enum
-from typing import Any, Dict, List, Optional
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Tuple
 
 
 class DatasetName(str, Enum):
@@ -13,19 +16,181 @@ class DatasetName(str, Enum):
 @dataclass
 class Arguments:
     model: str
+    evaluator: str
+    backend: str
     dataset: str
     no_summary_tree: bool
+    tree_retrieval: Optional[str]
+    tree_top_k: int
+    context_tokens: int
     llm_only: bool
+    strict: bool
+    use_gt_segments: bool
+    use_gt_doc_relevancy: bool
+    history: str
+    history_turns: int
+    history_tokens: int
+    stage1: str
+    retrieval_top_k: int
+    retrieval_history_turns: int
+    batch_size: int
+    pipeline_depth: int
+    cpu_workers: int
+    prefix_cache_size: int
+    ner_processes: int
+    yes_no_scoring: str
+    relevancy_threshold: float
+    cache_path: str
+    cache_max_entries: int
+    cache_read_only: bool
+    num_shards: int
+    shard_id: Optional[int]
+    work_queue: bool
+    lease_seconds: float
+    trace: bool
     exp_name: str
 
 
-@dataclass
+class Turn(NamedTuple):
+    """A message of a conversation, stored as a tuple instead of a dict, with an interned role."""
+
+    role: str
+    content: str
+
+    @classmethod
+    def from_message(cls, message: Dict[str, str]) -> "Turn":
+        return cls(sys.intern(message["role"]), message["content"])
+
+    def as_message(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content}
+
+
+def to_turns(messages: Iterable[Dict[str, str]]) -> List[Turn]:
+    """The Turns of a list of messages, e.g. of a conversation decoded from JSON."""
+    return [Turn.from_message(message) for message in messages]
+
+
+class ConversationView(Sequence):
+    """The first `length` messages of a conversation, read from its shared turn list without copying.
+
+    Indexing and slicing behave like on a list of messages (slices and concatenation return new
+    lists), so a view can be used wherever the conversation of a sample is expected. The messages are
+    built from the Turns when accessed, so only the tuples are held in memory.
+    """
+
+    __slots__ = ("turns", "length")
+
+    def __init__(self, turns: List[Turn], length: int) -> None:
+        self.turns = turns
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.turns[j].as_message() for j in range(self.length)[i]]
+        return self.turns[range(self.length)[i]].as_message()
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        return (turn.as_message() for turn in islice(self.turns, self.length))
+
+    def __add__(self, other: Iterable[Dict[str, str]]) -> List[Dict[str, str]]:
+        return list(self) + list(other)
+
+    def __radd__(self, other: Iterable[Dict[str, str]]) -> List[Dict[str, str]]:
+        return list(other) + list(self)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, (list, ConversationView)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+
+@dataclass(slots=True)
 class Sample:
-    document_ids: List[str]
-    conversation: List[Dict[str, str]]
+    document_ids: Sequence[str]  # Stored as a tuple of interned ids
+    conversation: Sequence  # List[Dict[str, str]] or a ConversationView
 
+    # Set when the conversation is the first `turn` messages of the shared conversation `conversation_id`
+    conversation_id: Optional[str] = None
+    turn: Optional[int] = None
 
-@dataclass
+    def __post_init__(self) -> None:
+        # The same ids repeat in every sample of a conversation (and QuAC ids are 50+ characters), so
+        # all the samples share one string per id
+        self.document_ids = tuple(sys.intern(doc_id) for doc_id in self.document_ids)
+        if self.conversation_id is not None:
+            self.conversation_id = sys.intern(self.conversation_id)
+
+    @classmethod
+    def from_dict(
+        cls, value: Dict[str, Any], conversations: Optional[Mapping[str, List[Turn]]] = None
+    ) -> "Sample":
+        """Build a sample from its JSON, resolving a conversation reference against `conversations`."""
+        if "conversation" in value:
+            # Older files store a copy of the conversation in every sample
+            conversation = value["conversation"]
+            return cls(value["document_ids"], ConversationView(to_turns(conversation), len(conversation)))
+        turns = conversations[value["conversation_id"]]
+        return cls(
+            value["document_ids"],
+            ConversationView(turns, value["turn"]),
+            value["conversation_id"],
+            value["turn"],
+        )
+
+
+class ConversationStore:
+    """The messages of every conversation of a dataset, stored once and shared by the samples of its turns.
+
+    A conversation with n turns would otherwise be copied into each of its n samples (O(n^2) messages
+    in memory and in the preprocessed files). Instead, each sample is a view of the first `turn`
+    messages of the shared list, and only the (conversation id, turn) reference is saved per sample.
+
+    Args:
+        conversations: Conversations already in the store, by id
+        prefix: Prefix of the ids of new conversations, e.g. to make them unique across the splits
+    """
+
+    def __init__(self, conversations: Optional[Dict[str, List[Turn]]] = None, prefix: str = "") -> None:
+        self.conversations = conversations if conversations is not None else {}
+        self.prefix = prefix
+
+    def new(self) -> Tuple[str, List[Turn]]:
+        """Start a conversation. Returns its id and its (empty) turn list, to append the Turns to."""
+        conversation_id = f"{self.prefix}{len(self.conversations)}"
+        turns: List[Turn] = []
+        self.conversations[conversation_id] = turns
+        return conversation_id, turns
+
+    def sample(self, document_ids: List[str], conversation_id: str, turn: int) -> Sample:
+        """Sample over the first `turn` messages of a conversation."""
+        turns = self.conversations[conversation_id]
+        return Sample(document_ids, ConversationView(turns, turn), conversation_id, turn)
+
+
+@dataclass(slots=True)
+class Span:
+    """A timed step of the prediction of a sample (see tracing.py), with the token counts of model calls."""
+
+    name: str  # Stage name, e.g. "keywords", or "<stage>/<model method>" for a model call within it
+    start: float  # time.time() seconds
+    end: float
+    pid: int
+    thread: str
+    prompt_tokens: Optional[int] = None
+    generated_tokens: Optional[int] = None
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+@dataclass(slots=True)
 class Label:
     document_relevant: bool
     segments: Optional[List[str]]
@@ -36,9 +201,28 @@ class Label:
 
     time_taken: Optional[float] = None  # How long it takes to answer the question
 
+    # Probability that the document is relevant, when the relevancy check scores YES/NO from the logits
+    document_relevant_prob: Optional[float] = None
+
+    # Tokens the context packer dropped from each document of the prompt, when it had to truncate
+    dropped_context: Optional[Dict[str, int]] = None
+
+    # Timed stages and model calls of the prediction. With batching, the spans of a batch are shared
+    # by all its samples
+    spans: Optional[List[Span]] = field(default=None, repr=False)
+
+    def __post_init__(self) -> None:
+        if self.spans is not None:
+            self.spans = [Span(**span) if isinstance(span, dict) else span for span in self.spans]
+
 
 class DataClassEncoder(json.JSONEncoder):
     def default(self, obj: Any) -> Any:
+        if isinstance(obj, Sample) and obj.conversation_id is not None:
+            # The messages are saved once per conversation (see ConversationStore)
+            return {"document_ids": obj.document_ids, "conversation_id": obj.conversation_id, "turn": obj.turn}
+        if isinstance(obj, ConversationView):
+            return list(obj)
         if is_dataclass(obj):
             return asdict(obj)
         return super().default(obj)
@@ -0,0 +1,193 @@
+"""
+Per-stage spans of the predictions. `trace()` starts recording the spans opened with `span(name)` in
+the current thread, and TracedBackend opens one for every model call, with its token counts. Spans
+opened inside another span are named "<outer>/<inner>", e.g. "keywords/generate".
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+from .llm.backend import LLMBackend
+from .structures import Label, Span
+
+_local = threading.local()
+
+
+@contextmanager
+def trace(spans: Optional[List[Span]] = None) -> Iterator[List[Span]]:
+    """Record the spans opened in this thread in `spans` (a new list by default) while in the block."""
+    spans = [] if spans is None else spans
+    previous = getattr(_local, "spans", None), getattr(_local, "stack", None)
+    _local.spans, _local.stack = spans, []
+    try:
+        yield spans
+    finally:
+        _local.spans, _local.stack = previous
+
+
+def is_tracing() -> bool:
+    return getattr(_local, "spans", None) is not None
+
+
+@contextmanager
+def span(name: str) -> Iterator[Optional[Span]]:
+    """Time the block as a span of the current trace. Does nothing (and yields None) outside of `trace()`."""
+    if not is_tracing():
+        yield None
+        return
+    stack = _local.stack
+    current = Span(
+        f"{stack[-1].name}/{name}" if stack else name,
+        time.time(),
+        0.0,
+        os.getpid(),
+        threading.current_thread().name,
+    )
+    _local.spans.append(current)
+    stack.append(current)
+    try:
+        yield current
+    finally:
+        current.end = time.time()
+        stack.pop()
+
+
+class TracedBackend:
+    """Wraps an LLMBackend so every model call is a span with its prompt and generated token counts.
+
+    Tokens are only counted while tracing, with the backend's `count_tokens` (message contents only,
+    without the chat template).
+    """
+
+    def __init__(self, backend: LLMBackend) -> None:
+        self.backend = backend
+        self.name = backend.name
+
+    def __getattr__(self, name: str) -> Any:
+        if name == "backend":
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+    def _prompt_tokens(self, histories: List[List[Dict[str, str]]]) -> int:
+        return sum(self.backend.count_tokens(m["content"]) for history in histories for m in history)
+
+    def generate(self, messages: List[Dict[str, str]], max_new_tokens: int = 256) -> str:
+        with span("generate") as s:
+            response = self.backend.generate(messages, max_new_tokens=max_new_tokens)
+            if s is not None:
+                s.prompt_tokens = self._prompt_tokens([messages])
+                s.generated_tokens = self.backend.count_tokens(response)
+        return response
+
+    def batch_generate(
+        self,
+        histories: List[List[Dict[str, str]]],
+        max_new_tokens: int = 256,
+        batch_size: int = 8,
+    ) -> List[str]:
+        if not histories:
+            return []
+        with span("batch_generate") as s:
+            responses = self.backend.batch_generate(histories, max_new_tokens=max_new_tokens, batch_size=batch_size)
+            if s is not None:
+                s.prompt_tokens = self._prompt_tokens(histories)
+                s.generated_tokens = sum(self.backend.count_tokens(response) for response in responses)
+        return responses
+
+    def score_choices(self, messages: List[Dict[str, str]], choices: List[str]) -> List[float]:
+        with span("score_choices") as s:
+            scores = self.backend.score_choices(messages, choices)
+            if s is not None:
+                s.prompt_tokens = self._prompt_tokens([messages])
+        return scores
+
+    def yes_no_probabilities(
+        self, histories: List[List[Dict[str, str]]], batch_size: int = 8
+    ) -> List[float]:
+        if not histories:
+            return []
+        with span("yes_no_probabilities") as s:
+            probabilities = self.backend.yes_no_probabilities(histories, batch_size=batch_size)
+            if s is not None:
+                s.prompt_tokens = self._prompt_tokens(histories)
+                s.generated_tokens = 0
+        return probabilities
+
+
+def _unique_spans(Y_hat: List[Label]) -> List[Span]:
+    # Batched samples share their spans, so each is counted once
+    spans = {}
+    for y_hat in Y_hat:
+        for s in y_hat.spans or []:
+            spans.setdefault((s.name, s.start, s.end, s.pid, s.thread), s)
+    return list(spans.values())
+
+
+def stage_stats(Y_hat: List[Label]) -> Dict[str, Dict[str, Any]]:
+    """Count, p50/p90/p99 duration (seconds) and token totals and throughput of every span name of the predictions."""
+    by_name: Dict[str, List[Span]] = {}
+    for s in _unique_spans(Y_hat):
+        by_name.setdefault(s.name, []).append(s)
+
+    stats = {}
+    for name in sorted(by_name):
+        spans = by_name[name]
+        durations = np.array([s.duration for s in spans])
+        p50, p90, p99 = np.percentile(durations, [50, 90, 99])
+        stats[name] = {
+            "count": len(spans),
+            "total": float(durations.sum()),
+            "p50": float(p50),
+            "p90": float(p90),
+            "p99": float(p99),
+        }
+        if any(s.prompt_tokens is not None for s in spans):
+            generated = sum(s.generated_tokens or 0 for s in spans)
+            stats[name]["prompt_tokens"] = sum(s.prompt_tokens or 0 for s in spans)
+            stats[name]["generated_tokens"] = generated
+            stats[name]["tokens_per_second"] = generated / max(float(durations.sum()), 1e-9)
+    return stats
+
+
+def save_chrome_trace(Y_hat: List[Label], fp: str) -> None:
+    """
+    Write the spans of the predictions as a Chrome trace (JSON object format), to open in
+    chrome://tracing or https://ui.perfetto.dev. Each process and thread that ran samples is a track,
+    and every span has the indices of the samples it belongs to in its args.
+    """
+    samples: Dict[tuple, List[int]] = {}
+    for i, y_hat in enumerate(Y_hat):
+        for s in y_hat.spans or []:
+            samples.setdefault((s.name, s.start, s.end, s.pid, s.thread), []).append(i)
+
+    threads: Dict[tuple, int] = {}
+    events = []
+    for s in sorted(_unique_spans(Y_hat), key=lambda s: (s.start, -s.end)):
+        tid = threads.setdefault((s.pid, s.thread), len(threads) + 1)
+        args = {"samples": samples[(s.name, s.start, s.end, s.pid, s.thread)]}
+        if s.prompt_tokens is not None:
+            args["prompt_tokens"] = s.prompt_tokens
+            args["generated_tokens"] = s.generated_tokens
+        events.append(
+            {
+                "name": s.name,
+                "cat": s.name.split("/")[0],
+                "ph": "X",
+                "ts": s.start * 1e6,
+                "dur": s.duration * 1e6,
+                "pid": s.pid,
+                "tid": tid,
+                "args": args,
+            }
+        )
+    for (pid, thread), tid in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread}})
+
+    with open(fp, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
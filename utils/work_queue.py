@@ -0,0 +1,277 @@
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from .sharding import conversation_key
+from .structures import DataClassEncoder, Label, Sample
+
+
+@dataclass
+class Task:
+    id: int
+    indices: List[int]  # Indices of the samples of one conversation
+
+
+class WorkQueue:
+    """Pull-based queue of the samples of an experiment, shared by any number of worker processes through a SQLite file.
+
+    Each task is one conversation (so the caches shared across its turns stay in one worker). A worker
+    leases tasks, keeps its leases alive with heartbeats from a background thread, and records the
+    label of every sample as soon as it is predicted. The tasks of a worker that stops heartbeating
+    are leased again by the next worker asking for work, which only runs their samples that have no
+    label yet. Labels are keyed by sample index, so each one is recorded exactly once even when a
+    worker that lost its lease finishes a sample anyway. Workers can join or leave at any time.
+
+    The file uses SQLite's default rollback journal rather than WAL, since WAL needs memory shared by
+    all the processes and so only works on one host. Workers on several nodes need a shared filesystem
+    whose file locks work across hosts (e.g. NFSv4 with locking, not NFSv3 mounted with `nolock`),
+    otherwise run all the workers on one host.
+
+    Args:
+        fp: Path of the SQLite file, e.g. `results/exp/queue.sqlite` (see above for shared filesystems)
+        worker: Id of this worker, default `<hostname>-<pid>`
+        lease_seconds: How long a lease lasts without a heartbeat
+    """
+
+    def __init__(self, fp: str, worker: Optional[str] = None, lease_seconds: float = 300.0) -> None:
+        self.fp = fp
+        self.worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+
+        if os.path.dirname(fp):
+            os.makedirs(os.path.dirname(fp), exist_ok=True)
+        self._lock = threading.Lock()
+        # Autocommit, with explicit transactions where several statements must be atomic
+        self._conn = sqlite3.connect(fp, timeout=60, isolation_level=None, check_same_thread=False)
+        # Not WAL, which relies on shared memory and is unsafe when the file is shared between hosts
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "id INTEGER PRIMARY KEY, indices TEXT, state TEXT, worker TEXT, lease_expires REAL, attempts INTEGER)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS labels (i INTEGER PRIMARY KEY, label TEXT, worker TEXT, time REAL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers ("
+            "worker TEXT PRIMARY KEY, joined REAL, last_seen REAL, samples INTEGER, busy_time REAL, lease_seconds REAL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _meta(self, conn: sqlite3.Connection, key: str) -> Optional[str]:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, X: Sequence[Sample]) -> None:
+        """Fill the queue with one task per conversation of `X`, unless a worker already did.
+
+        Raises:
+            ValueError: If the queue was filled from different samples
+        """
+        conversations: Dict[Any, List[int]] = {}
+        for i, x in enumerate(X):
+            conversations.setdefault(conversation_key(x), []).append(i)
+        fingerprint = hashlib.sha256(json.dumps([repr(key) for key in conversations]).encode("utf-8")).hexdigest()
+
+        now = time.time()
+        with self._transaction() as conn:
+            previous = self._meta(conn, "fingerprint")
+            if previous is None:
+                conn.executemany(
+                    "INSERT INTO tasks VALUES (?, ?, 'pending', NULL, NULL, 0)",
+                    [(task_id, json.dumps(indices)) for task_id, indices in enumerate(conversations.values())],
+                )
+                conn.execute("INSERT INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+                conn.execute("INSERT INTO meta VALUES ('n', ?)", (str(len(X)),))
+            elif previous != fingerprint:
+                raise ValueError(f"Work queue {self.fp} was filled from different samples.")
+            conn.execute(
+                "INSERT OR IGNORE INTO workers VALUES (?, ?, ?, 0, 0.0, ?)", (self.worker, now, now, self.lease_seconds)
+            )
+
+    def lease(self, max_samples: int = 1) -> List[Task]:
+        """Lease pending tasks (or tasks whose lease expired) until they hold at least `max_samples` samples."""
+        now = time.time()
+        tasks, n = [], 0
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, indices FROM tasks WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+                "ORDER BY id",
+                (now,),
+            ).fetchall()
+            for task_id, indices in rows:
+                tasks.append(Task(task_id, json.loads(indices)))
+                n += len(tasks[-1].indices)
+                if n >= max_samples:
+                    break
+            conn.executemany(
+                "UPDATE tasks SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                [(self.worker, now + self.lease_seconds, task.id) for task in tasks],
+            )
+        return tasks
+
+    def heartbeat(self) -> None:
+        """Extend the leases of this worker and record that it is alive."""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET lease_expires = ? WHERE state = 'leased' AND worker = ?",
+                (now + self.lease_seconds, self.worker),
+            )
+            conn.execute("UPDATE workers SET last_seen = ? WHERE worker = ?", (now, self.worker))
+
+    @contextmanager
+    def heartbeats(self) -> Iterator[None]:
+        """Send heartbeats from a background thread while in the block."""
+        stop = threading.Event()
+
+        def beat() -> None:
+            while not stop.wait(self.lease_seconds / 3):
+                self.heartbeat()
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def record(self, i: int, label: Label, busy_time: float = 0.0) -> bool:
+        """Record the label of sample `i`. Returns False if another worker already recorded one (which is kept)."""
+        now = time.time()
+        with self._transaction() as conn:
+            recorded = conn.execute(
+                "INSERT OR IGNORE INTO labels VALUES (?, ?, ?, ?)",
+                (i, json.dumps(label, cls=DataClassEncoder), self.worker, now),
+            ).rowcount == 1
+            if recorded:
+                conn.execute(
+                    "UPDATE workers SET samples = samples + 1, busy_time = busy_time + ?, last_seen = ? WHERE worker = ?",
+                    (busy_time, now, self.worker),
+                )
+        return recorded
+
+    def done(self, tasks: List[Task]) -> None:
+        """Mark leased tasks whose samples all have a label as done."""
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE tasks SET state = 'done', lease_expires = NULL WHERE id = ? AND worker = ? AND state = 'leased'",
+                [(task.id, self.worker) for task in tasks],
+            )
+
+    def release(self, tasks: List[Task]) -> None:
+        """Give back leased tasks, e.g. after an error, so another worker can run them right away."""
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE tasks SET state = 'pending', worker = NULL, lease_expires = NULL WHERE id = ? AND worker = ? AND state = 'leased'",
+                [(task.id, self.worker) for task in tasks],
+            )
+
+    def recorded(self, indices: List[int]) -> List[int]:
+        """Those of `indices` that already have a label."""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT i FROM labels WHERE i IN ({','.join('?' * len(indices))})", indices
+            ).fetchall()
+        return [i for (i,) in rows]
+
+    def is_finished(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM tasks WHERE state != 'done'").fetchone()[0] == 0
+
+    def labels(self, n: int) -> List[Label]:
+        """The labels of samples 0..n-1, in order. Raises if any is missing."""
+        with self._lock:
+            rows = dict(self._conn.execute("SELECT i, label FROM labels WHERE i < ?", (n,)).fetchall())
+        missing = [i for i in range(n) if i not in rows]
+        if missing:
+            raise ValueError(f"{len(missing)} of {n} samples have no label in {self.fp}, e.g. {missing[:5]}.")
+        return [Label(**json.loads(rows[i])) for i in range(n)]
+
+    def claim_scoring(self) -> bool:
+        """Whether this worker scores the finished experiment: the first to ask does, unless it died before scoring."""
+        with self._transaction() as conn:
+            scorer = self._meta(conn, "scorer")
+            if scorer is not None and scorer != self.worker:
+                seen = conn.execute("SELECT last_seen, lease_seconds FROM workers WHERE worker = ?", (scorer,)).fetchone()
+                if self._meta(conn, "scored") or (seen and time.time() - seen[0] < seen[1]):
+                    return False
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('scorer', ?)", (self.worker,))
+        return True
+
+    def mark_scored(self) -> None:
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('scored', ?)", (self.worker,))
+
+    def progress(self) -> Dict[str, Any]:
+        """Counts of the samples and tasks, and the samples, throughput and liveness of every worker."""
+        now = time.time()
+        with self._lock:
+            n = int(self._meta(self._conn, "n") or 0)
+            states = dict(self._conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+            labeled = self._conn.execute("SELECT COUNT(*) FROM labels").fetchone()[0]
+            rows = self._conn.execute(
+                "SELECT worker, joined, last_seen, samples, busy_time, lease_seconds FROM workers ORDER BY joined"
+            ).fetchall()
+        workers = {}
+        for worker, joined, last_seen, samples, busy_time, lease_seconds in rows:
+            workers[worker] = {
+                "samples": samples,
+                "samples_per_second": samples / max(last_seen - joined, 1e-9),
+                "seconds_per_sample": busy_time / samples if samples else None,
+                "seconds_since_seen": now - last_seen,
+                "alive": now - last_seen < lease_seconds,
+            }
+        return {
+            "samples": n,
+            "labeled": labeled,
+            "tasks": {state: states.get(state, 0) for state in ["pending", "leased", "done"]},
+            "workers": workers,
+        }
+
+
+class QueueResults:
+    """Lets `run_inference` record its predictions in a WorkQueue, like in a PredictionJournal."""
+
+    dropped_bytes = 0
+
+    def __init__(self, queue: WorkQueue, indices: List[int]) -> None:
+        self.queue = queue
+        self.fp = queue.fp
+        self._recorded = set(queue.recorded(indices)) if indices else set()
+        self._last = time.time()
+
+    def __contains__(self, i: int) -> bool:
+        return i in self._recorded
+
+    def __len__(self) -> int:
+        return len(self._recorded)
+
+    def append(self, i: int, label: Label) -> None:
+        now = time.time()
+        self.queue.record(i, label, busy_time=now - self._last)
+        self._last = now
+        self._recorded.add(i)
+
+
+if __name__ == "__main__":
+    # python -m utils.work_queue results/exp/queue.sqlite
+    print(json.dumps(WorkQueue(sys.argv[1], worker="monitor").progress(), indent=4))